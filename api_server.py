@@ -19,6 +19,9 @@ from payment_advice_extractor import PaymentAdviceExtractor
 from warsoft_client import WarsoftClient
 from reconciliation_engine import ReconciliationEngine
 from database import ReconciliationDB
+from invoice_snapshot import InvoiceSnapshot, merge_results
+from payment_reconciliation import clear_run_data
+from extraction_telemetry import summarize as summarize_telemetry
 
 load_dotenv()
 
@@ -49,6 +52,7 @@ class ReconciliationRequest(BaseModel):
     auto_mark_paid: bool = True
     start_page: int = 1
     end_page: int = 999999
+    full_rescan: bool = False
 
 
 class InvoiceSearchRequest(BaseModel):
@@ -79,7 +83,7 @@ async def start_reconciliation(request: ReconciliationRequest, background_tasks:
     os.environ['END_PAGE'] = str(request.end_page)
 
     # Start reconciliation in background
-    background_tasks.add_task(run_reconciliation, request.days_back, request.auto_mark_paid)
+    background_tasks.add_task(run_reconciliation, request.days_back, request.auto_mark_paid, request.full_rescan)
 
     return {
         "message": "Reconciliation started",
@@ -176,12 +180,22 @@ async def search_invoice(invoice_number: str):
     return result
 
 
+@app.get("/api/extraction-telemetry")
+async def get_extraction_telemetry(days: Optional[int] = None, top_senders: int = 10):
+    """p50/p95 extraction latency, tokens and cost per advice (optionally for the last `days` days)"""
+    db = ReconciliationDB()
+    rows = db.get_extraction_telemetry(days)
+    return summarize_telemetry(rows, top_senders)
+
+
 @app.delete("/api/clear")
 async def clear_data():
     """Clear all reconciliation data"""
     db = ReconciliationDB()
     db.clear_payment_advices()
     db.clear_reconciliation_results()
+    # Without its checkpoint the next run rescans the full window and ingests the cleared mail again
+    db.clear_imap_checkpoint(PaymentAdviceExtractor._mailbox_key())
 
     global reconciliation_status
     reconciliation_status["results"] = None
@@ -281,53 +295,70 @@ async def download_excel():
     )
 
 
-async def run_reconciliation(days_back: int, auto_mark_paid: bool = True):
+async def run_reconciliation(days_back: int, auto_mark_paid: bool = True, full_rescan: bool = False):
     """Background task to run reconciliation"""
     global reconciliation_status
 
     try:
         reconciliation_status["is_running"] = True
         reconciliation_status["progress"] = 10
-        reconciliation_status["status_message"] = "Extracting payment advices from emails..."
+        reconciliation_status["status_message"] = "Loading Warsoft invoice snapshot..."
 
         # Initialize components
         db = ReconciliationDB()
-        extractor = PaymentAdviceExtractor()
+        extractor = PaymentAdviceExtractor(db=db)
         warsoft = WarsoftClient()
         engine = ReconciliationEngine(db=db, warsoft=warsoft, auto_write_matched=auto_mark_paid)
 
-        # Clear previous data
-        db.clear_payment_advices()
-        db.clear_reconciliation_results()
+        # Stored advices are only dropped when this run rescans the whole window
+        full_scan = extractor.will_full_scan(full_rescan)
 
-        # Extract payment advices
+        # Load the last invoice snapshot for fast reconciliation (a stale one is refreshed in the background)
         reconciliation_status["progress"] = 20
-        payment_advices = extractor.fetch_payment_advices_from_email(days_back=days_back)
-
-        # Store payment advices
-        reconciliation_status["progress"] = 40
-        reconciliation_status["status_message"] = f"Storing {len(payment_advices)} payment advices..."
-
-        for advice in payment_advices:
-            db.insert_payment_advice(advice)
-
-        # Fetch Warsoft invoices
+        snapshot = InvoiceSnapshot(db, warsoft)
+        await asyncio.to_thread(snapshot.open, engine)
+
+        # Advices kept from earlier runs get another chance against the loaded snapshot
+        reconciliation_results = []
+        if not full_scan:
+            merge_results(reconciliation_results, await asyncio.to_thread(engine.rereconcile_not_found))
+
+        def on_full_scan():
+            # The whole window is ingested again; cleared only once the inbox search has succeeded
+            clear_run_data(db)
+            reconciliation_results.clear()
+
+        def ingest():
+            # Store and reconcile each advice as it is extracted
+            for advice in extractor.iter_payment_advices_from_email(days_back=days_back, full_rescan=full_rescan,
+                                                                    on_full_scan=on_full_scan):
+                payment_id = db.insert_payment_advice(advice)
+                if payment_id is None:
+                    continue
+                advice['id'] = payment_id
+                merge_results(reconciliation_results, snapshot.poll(engine))
+                if snapshot.needs_sync(engine, advice.get('invoice_number')):
+                    continue  # Reconciled after the targeted sync below
+                reconciliation_results.append(engine.reconcile_and_record(advice))
+                reconciliation_status["status_message"] = (
+                    f"Extracting and reconciling payment advices... {len(reconciliation_results)} reconciled")
+
+        # Stream payment advices (blocking IMAP and extraction) off the event loop in one worker thread
         reconciliation_status["progress"] = 50
-        reconciliation_status["status_message"] = "Syncing Warsoft unpaid invoices..."
-        unpaid_invoices = warsoft.fetch_all_unpaid_invoices()
-        for inv_data in unpaid_invoices:
-            inv = warsoft.parse_invoice(inv_data)
-            db.insert_warsoft_invoice(inv)
-
-        # Load invoice cache for fast reconciliation
-        reconciliation_status["progress"] = 70
-        reconciliation_status["status_message"] = "Loading invoice cache..."
-        engine.load_invoice_cache()
-
-        # Perform reconciliation
-        reconciliation_status["progress"] = 80
-        reconciliation_status["status_message"] = "Performing reconciliation..."
-        reconciliation_results = engine.reconcile_all_pending()
+        reconciliation_status["status_message"] = "Extracting and reconciling payment advices..."
+        await asyncio.to_thread(ingest)
+
+        if snapshot.targeted:
+            reconciliation_status["status_message"] = "Fetching Warsoft invoices for the remaining advices..."
+            merge_results(reconciliation_results, await asyncio.to_thread(snapshot.sync_pending, engine))
+        else:
+            # Advices an interrupted run stored but never reconciled are still PENDING
+            merge_results(reconciliation_results, await asyncio.to_thread(engine.reconcile_all_pending))
+
+        if snapshot.refreshing():
+            reconciliation_status["status_message"] = "Finishing Warsoft invoice refresh..."
+            await asyncio.to_thread(snapshot.wait)
+        merge_results(reconciliation_results, await asyncio.to_thread(snapshot.poll, engine))
 
         # Update status
         reconciliation_status["progress"] = 100
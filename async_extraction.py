@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Concurrent PDF extraction with Azure OpenAI (AsyncOpenAI)
+Extraction jobs from the mail scanner are sent concurrently, bounded by an
+adaptive (AIMD) concurrency limit and by token buckets sized to the
+deployment's RPM/TPM quota
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+from model_router import ValidationFailed
+from pdf_document import load_pdf
+from resilient_client import AdaptiveConcurrency, RetriesExhausted
+
+load_dotenv()
+
+# Put on the output queue once the event loop thread has finished
+_PIPELINE_DONE = object()
+
+
+class TokenBucket:
+    """Refills `per_minute` units per minute, bursting up to ten seconds' worth
+
+    Azure evaluates RPM/TPM quotas over short windows, so a full minute's
+    burst would still be throttled. A request larger than the bucket waits
+    for a full bucket and leaves it in debt, so the average rate still
+    matches the quota.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = max(1.0, per_minute / 6.0)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available (0 if they are now)"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount):
+        """Remove `amount` units (negative amounts give units back)"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits of one deployment
+
+    A limit of 0 disables that bucket. Callers are served in arrival order.
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.waited_seconds = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens):
+        """Wait until one request of `estimated_tokens` fits both quotas, then take it"""
+        async with self._lock:
+            while True:
+                wait = max(self.requests.wait_time(1) if self.requests else 0.0,
+                           self.tokens.wait_time(estimated_tokens) if self.tokens else 0.0)
+                if wait <= 0:
+                    break
+                self.waited_seconds += wait
+                await asyncio.sleep(wait)
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(estimated_tokens)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real usage of a request is known"""
+        if self.tokens and actual_tokens is not None:
+            self.tokens.take(actual_tokens - estimated_tokens)
+
+
+class AsyncExtractionPipeline:
+    """Runs extraction jobs (PaymentAdviceExtractor.build_extraction_job) concurrently
+
+    The job iterator (typically the IMAP scan) is consumed on a dedicated
+    thread, requests are awaited on an asyncio event loop in a background
+    thread, and records come back through a bounded queue, so run() is a
+    plain generator usable from synchronous code.
+    """
+
+    def __init__(self, payment_extractor, concurrency=None, rpm=None, tpm=None):
+        self.payment_extractor = payment_extractor
+        self.openai_extractor = payment_extractor.openai_extractor
+        # Upper bound: the adaptive limit starts here and backs off when throttled
+        self.concurrency = max(1, concurrency or int(os.getenv('EXTRACTION_CONCURRENCY', 8)))
+        self.rpm = rpm if rpm is not None else int(os.getenv('AZURE_OPENAI_RPM', 0))
+        self.tpm = tpm if tpm is not None else int(os.getenv('AZURE_OPENAI_TPM', 0))
+        # Worker processes that open PDFs while others are queued (0 = threads only)
+        self.process_workers = int(os.getenv('PDF_PROCESS_WORKERS', min(4, (os.cpu_count() or 1) - 1)))
+        self.stats = {'jobs': 0, 'requests': 0, 'rate_limited_seconds': 0.0, 'pdfs_in_processes': 0,
+                      'lowest_concurrency': self.concurrency}
+        self.deferred = []
+        self.failed = []
+        self._opening = 0
+
+    def _new_client(self):
+        # Same endpoint as the synchronous client (point it at mock_openai_server.py to test)
+        return AsyncOpenAI(base_url=os.getenv('AZURE_OPENAI_BASE_URL'),
+                           api_key=os.getenv('AZURE_OPENAI_API_KEY'), max_retries=0)
+
+    def run(self, jobs, deferred=None, failed=None):
+        """Extract every job from `jobs`
+
+        Jobs still throttled after every retry are not dropped: their IMAP
+        UIDs are appended to `deferred` (see defer_extraction_job). Jobs
+        whose extraction failed for good go to `failed` (see fail_extraction_job).
+
+        Yields:
+            dict: Payment advice records, in completion order
+        """
+        if deferred is not None:
+            self.deferred = deferred
+        if failed is not None:
+            self.failed = failed
+        output = queue.Queue(maxsize=self.concurrency * 2)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._run_loop, args=(iter(jobs), output, stop),
+                                  name='async-extraction', daemon=True)
+        print(f"⚡ Async extraction: {self.concurrency} concurrent requests, "
+              f"RPM limit {self.rpm or 'none'}, TPM limit {self.tpm or 'none'}, "
+              f"{self.process_workers or 'no'} PDF worker process(es)")
+        started = time.perf_counter()
+        thread.start()
+        try:
+            while True:
+                item = output.get()
+                if item is _PIPELINE_DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield from item
+        finally:
+            stop.set()
+            # Drain so the loop thread is never blocked on a full queue
+            while thread.is_alive():
+                try:
+                    output.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+        elapsed = time.perf_counter() - started
+        print(f"⚡ Async extraction finished: {self.stats['jobs']} PDFs, {self.stats['requests']} API calls "
+              f"in {elapsed:.1f}s ({self.stats['rate_limited_seconds']:.1f}s waiting on the rate limit, "
+              f"{self.stats['pdfs_in_processes']} PDFs opened in worker processes)")
+        print(f"   🔁 {self.openai_extractor.retry_policy.summary()}; concurrency limit went as low as "
+              f"{self.stats['lowest_concurrency']} of {self.concurrency}")
+
+    def _run_loop(self, jobs, output, stop):
+        try:
+            asyncio.run(self._extract_all(jobs, output, stop))
+        except BaseException as e:
+            output.put(e)
+        finally:
+            output.put(_PIPELINE_DONE)
+
+    async def _extract_all(self, jobs, output, stop):
+        loop = asyncio.get_running_loop()
+        client = self._new_client()
+        limiter = RateLimiter(self.rpm, self.tpm)
+        concurrency = AdaptiveConcurrency(self.concurrency)
+        # Twice as many workers as requests so decrypting the next PDFs overlaps the API calls
+        workers = self.concurrency * 2
+        pending = asyncio.Queue(maxsize=self.concurrency)
+
+        # A single thread owns the job iterator (it holds the IMAP sessions)
+        feeder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='extraction-feed')
+        # Opening PDFs is CPU-bound and holds the GIL; with a backlog it moves to worker
+        # processes (spawned: forking a process with running threads is unsafe)
+        processes = None
+        if self.process_workers > 0:
+            processes = ProcessPoolExecutor(max_workers=self.process_workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+        async def feed():
+            try:
+                while not stop.is_set():
+                    job = await loop.run_in_executor(feeder, next, jobs, None)
+                    if job is None:
+                        break
+                    await pending.put(job)
+            finally:
+                for _ in range(workers):
+                    await pending.put(None)
+
+        async def work():
+            while True:
+                job = await pending.get()
+                if job is None:
+                    return
+                if stop.is_set():
+                    continue
+                records = await self._extract_job(client, limiter, concurrency, job, processes)
+                await loop.run_in_executor(None, output.put, records)
+
+        try:
+            results = await asyncio.gather(feed(), *(work() for _ in range(workers)), return_exceptions=True)
+        finally:
+            if hasattr(jobs, 'close'):
+                await loop.run_in_executor(feeder, jobs.close)
+            feeder.shutdown()
+            if processes is not None:
+                await loop.run_in_executor(None, processes.shutdown)
+            await client.close()
+            self.stats['rate_limited_seconds'] = limiter.waited_seconds
+            self.stats['lowest_concurrency'] = concurrency.lowest
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _extract_job(self, client, limiter, concurrency, job, processes=None):
+        """Extract one job and build its payment records
+
+        A failed extraction gives no records; a throttled one is deferred to the next run.
+        """
+        self.stats['jobs'] += 1
+        try:
+            openai_result = None
+            if job['pdf_data'] is not None:
+                openai_result = await self._extract_pdf(client, limiter, concurrency, job['pdf_data'], job['from_email'],
+                                                        processes)
+            records = await asyncio.to_thread(self.payment_extractor.finish_extraction_job, job, openai_result)
+        except RetriesExhausted as e:
+            self.payment_extractor.defer_extraction_job(job, e, self.deferred)
+            return []
+        except Exception as e:
+            print(f"⚠️  Error processing email: {e}")
+            self.payment_extractor.fail_extraction_job(job, e, self.failed)
+            return []
+        if records is None:
+            self.payment_extractor.fail_extraction_job(job, 'no extraction result', self.failed)
+            return []
+        return records
+
+    async def _extract_pdf(self, client, limiter, concurrency, pdf_data, sender=None, processes=None):
+        """Async counterpart of AzureOpenAIPaymentExtractor.extract_from_pdf()
+
+        While another PDF is already being opened, this one is opened
+        (decrypted, text layer read) in one of the worker `processes`
+        instead of competing for the GIL in a thread. The telemetry wall
+        time includes waiting for a concurrency slot and the rate limit.
+        """
+        print(f"   🤖 Starting Azure OpenAI extraction (async Responses API)...")
+        extractor = self.openai_extractor
+        started = time.perf_counter()
+        prepared = result = error = None
+        try:
+            document = None
+            self._opening += 1
+            try:
+                if processes is not None and self._opening > 1:
+                    document = await asyncio.get_running_loop().run_in_executor(
+                        processes, load_pdf, pdf_data, extractor.pdf_passwords, extractor.password_hints.first(sender))
+                    self.stats['pdfs_in_processes'] += 1
+                    if document is None:
+                        extractor.note_document(None, sender)
+                        print(f"   ❌ Failed to decrypt PDF")
+                        return None
+                prepared = await asyncio.to_thread(extractor.prepare_pdf, pdf_data, sender, document)
+            finally:
+                self._opening -= 1
+            if prepared is None:
+                return None
+            if prepared['result'] is not None:
+                result = prepared['result']
+                return result
+
+            while True:
+                # One request, or one per page chunk of a long PDF, all in flight together
+                targets = prepared['chunks'] or [prepared]
+                requests = await asyncio.to_thread(lambda: [extractor.build_request(target) for target in targets])
+                responses = await asyncio.gather(
+                    *(self._create(client, limiter, concurrency, request, target['estimated_tokens'])
+                      for request, target in zip(requests, targets)),
+                    return_exceptions=True)
+                errors = [response for response in responses if isinstance(response, BaseException)]
+                for exhausted in errors:
+                    if isinstance(exhausted, RetriesExhausted):
+                        raise exhausted
+                if errors:
+                    print(f"   ❌ Azure OpenAI extraction error: {errors[0]}")
+                    error = errors[0]
+                    return None
+
+                try:
+                    # Stores the result in the cache and learns the layout (SQLite): off the loop
+                    result = await asyncio.to_thread(extractor.parse_responses, responses, prepared)
+                    return result
+                except ValidationFailed as e:
+                    # A rejected small-model result is redone once by the large deployment
+                    extractor.router.escalate(prepared, e)
+                except json.JSONDecodeError as e:
+                    print(f"   ❌ Azure OpenAI returned invalid JSON: {e}")
+                    error = e
+                    return None
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # A full telemetry batch is written to SQLite, so this runs in a thread too
+            await asyncio.to_thread(extractor.record_telemetry, pdf_data, sender, started, prepared, result, error)
+
+    async def _create(self, client, limiter, concurrency, request, estimated_tokens):
+        """Send one Responses API request within the concurrency and rate limits, with retries
+
+        Raises:
+            RetriesExhausted: Still throttled (or failing transiently) after every retry
+        """
+        async def attempt():
+            await limiter.acquire(estimated_tokens)
+            self.stats['requests'] += 1
+            return await client.responses.create(**request)
+
+        response = await self.openai_extractor.retry_policy.call_async(attempt, concurrency)
+
+        usage = getattr(response, 'usage', None)
+        if usage:
+            limiter.settle(estimated_tokens, usage.input_tokens + usage.output_tokens)
+        return response
+
+
+def _benchmark_jobs(pdf_path, count):
+    with open(pdf_path, 'rb') as f:
+        pdf_data = f.read()
+    return [{'pdf_filename': os.path.basename(pdf_path), 'pdf_data': pdf_data,
+             'message_id': f'<benchmark-{i}@localhost>', 'subject': f'Payment advice {i}',
+             'from_email': 'benchmark@localhost', 'body': ''} for i in range(count)]
+
+
+if __name__ == "__main__":
+    # Usage: python async_extraction.py <pdf> [count] [--serial]
+    # Costs tokens against a real deployment - run mock_openai_server.py and point
+    # AZURE_OPENAI_BASE_URL at it to benchmark locally.
+    if len(sys.argv) < 2:
+        print("Usage: python async_extraction.py <pdf> [count] [--serial]")
+        sys.exit(1)
+
+    from payment_advice_extractor import PaymentAdviceExtractor
+
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    count = int(args[1]) if len(args) > 1 else 20
+    extractor = PaymentAdviceExtractor()  # No database: no extraction cache, every PDF is a request
+
+    timings = []
+    if '--serial' in sys.argv:
+        started = time.perf_counter()
+        records = [record for job in _benchmark_jobs(args[0], count) for record in extractor.run_extraction_job(job) or []]
+        timings.append(('serial', time.perf_counter() - started, len(records)))
+
+    pipeline = AsyncExtractionPipeline(extractor)
+    started = time.perf_counter()
+    records = list(pipeline.run(_benchmark_jobs(args[0], count)))
+    timings.append((f'async x{pipeline.concurrency}', time.perf_counter() - started, len(records)))
+
+    print(f"\n📊 Extraction benchmark: {count} PDFs")
+    for label, seconds, record_count in timings:
+        print(f"   ⏱️  {label:<12} {seconds:8.2f}s  {count / seconds * 60:8.1f} PDFs/min  ({record_count} records)")
@@ -8,6 +8,7 @@ from datetime import datetime
 from azure.storage.blob import ContainerClient
 from urllib.parse import urlparse
 from dotenv import load_dotenv
+from http_transport import blob_transport
 
 load_dotenv()
 
@@ -28,11 +29,12 @@ class BlobStorageClient:
             self.account_url = f"https://{parsed_url.netloc}"
             self.sas_token = parsed_url.query
             
-            # Create container client
+            # Create container client (uploads share one pooled keep-alive session)
             self.container_client = ContainerClient(
                 self.account_url, 
                 self.container_name, 
-                credential=self.sas_token
+                credential=self.sas_token,
+                transport=blob_transport()
             )
             
             print(f"✅ Blob Storage client initialized")
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+End-to-end checks against the local IMAP stand-in (mock_imap_server.py)
+Builds a synthetic inbox of payment advices (PDFs with a text layer, so
+the local parser extracts them without Azure OpenAI) and other mail, then
+drives the IDLE daemon: catch-up, an incremental pass, an IDLE wake-up on
+delivery, an IDLE timeout and a UIDVALIDITY change. The search checks compare
+the server-side search criteria with the local keyword classifier. Exits
+non-zero if any check fails
+"""
+import email
+import os
+import sys
+import tempfile
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid
+from datetime import datetime, timedelta
+
+PORT = int(os.getenv('MOCK_IMAP_PORT', 11143))
+
+# Point every client at the stand-in; nothing here may reach a real service
+os.environ.update({
+    'IMAP_SERVER': '127.0.0.1', 'IMAP_PORT': str(PORT), 'IMAP_USE_SSL': 'false',
+    'GMAIL_EMAIL': 'advices@example.com', 'GMAIL_PASSWORD': 'mock',
+    'AZURE_OPENAI_API_KEY': 'mock', 'AZURE_OPENAI_BASE_URL': 'http://127.0.0.1:9/openai/v1/',
+    'AZURE_BLOB_SAS_URL': 'https://127.0.0.1:9/receipts?sv=mock',
+    'WARSOFT_ACCESS_TOKEN': '', 'ACCESS_TOKEN': '', 'IMAP_WORKERS': '1', 'EXTRACTION_CONCURRENCY': '1',
+    'MARK_PAYMENT_EMAILS_AS_READ': 'true', 'DAYS_TO_SEARCH': '30', 'MAX_EMAILS_TO_PROCESS': '100',
+})
+
+from database import ReconciliationDB
+from email_classifier import MATCH_KEYWORDS, matches_payment_keywords
+from idle_daemon import PaymentAdviceIdleDaemon
+from message_sources import ImapMessageSource
+from mock_imap_server import MockImapServer, MockMailbox
+from payment_advice_extractor import PaymentAdviceExtractor
+
+failures = []
+
+
+def check(name, ok, detail=''):
+    print(f"{'✅' if ok else '❌'} {name}{f' - {detail}' if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+def text_pdf(lines):
+    """One-page PDF whose text layer holds `lines`"""
+    def escape(text):
+        return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    stream = 'BT /F1 10 Tf 50 750 Td 14 TL ' + ' '.join(f'({escape(line)}) Tj T*' for line in lines) + ' ET'
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+               '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R '
+               '/Resources << /Font << /F1 5 0 R >> >> >>',
+               f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream',
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f'{number} 0 obj\n{body}\nendobj\n'.encode('latin-1')
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    out += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    return out
+
+
+def make_message(subject, body, sender='payments@bank.example', pdf=None, html=False, days_ago=1):
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = sender
+    message['To'] = os.environ['GMAIL_EMAIL']
+    message['Message-ID'] = make_msgid(domain='mock.example')
+    message['Date'] = format_datetime((datetime.now() - timedelta(days=days_ago)).astimezone())
+    if html:
+        message.set_content(f'<html><body><p>{body}</p></body></html>', subtype='html')
+    else:
+        message.set_content(body)
+    if pdf is not None:
+        message.add_attachment(pdf, maintype='application', subtype='pdf', filename='advice.pdf')
+    return message.as_bytes()
+
+
+def advice_message(number, **kwargs):
+    """A payment advice for invoice 23EXT1126/<number>, parsed locally with full confidence"""
+    net = 9800 + number
+    pdf = text_pdf(['Payment Advice', f'UTR No: CITIN2509{number:08d}', 'Value Date: 14-03-2025',
+                    f'23EXT1126/{number} 01-02-2025 {net + 200:,.2f} 200.00 {net:,.2f}', f'Total: {net:,.2f}'])
+    return make_message(f'Payment Advice - Ref {number}', 'Please find the remittance attached.', pdf=pdf, **kwargs)
+
+
+def inbox_messages():
+    """(raw message, is an advice) for the initial inbox"""
+    return [
+        (advice_message(1001), True),
+        (make_message('Weekly newsletter', 'Nothing about money here.'), False),
+        (advice_message(1002, html=True), True),
+        (make_message('Your order has shipped', 'Tracking attached.', sender='shop@store.example',
+                      pdf=text_pdf(['Order 42 invoice'])), False),
+        (advice_message(1003, sender='treasury@customer.example'), True),
+        (make_message('Old advice', 'payment advice', pdf=text_pdf(['x']), days_ago=90), False),
+    ]
+
+
+def search_messages():
+    """Every match keyword once in a subject and once only in a body (some with a PDF), plus misses"""
+    messages = []
+    for index, keyword in enumerate(MATCH_KEYWORDS):
+        messages.append(make_message(f'Re: {keyword.upper()} for ref {index}', 'See attached.',
+                                     pdf=text_pdf(['advice'])))
+        messages.append(make_message(f'Remittance {index}', f'Details of the {keyword} are below.', html=index % 3 == 0,
+                                     pdf=text_pdf(['advice']) if index % 2 else None))
+    messages += [
+        make_message('Weekly newsletter', 'Nothing about money here.'),
+        make_message('Your order has shipped', 'Invoice attached.', pdf=text_pdf(['Order 42'])),
+        make_message('Payment advice (old)', 'payment advice', pdf=text_pdf(['x']), days_ago=90),
+    ]
+    return messages
+
+
+def advice_count(db):
+    with db.get_connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM payment_advices').fetchone()[0]
+
+
+def check_idle_daemon(db_path):
+    mailbox = MockMailbox()
+    for raw_message, _ in inbox_messages():
+        mailbox.deliver(raw_message)
+    server = MockImapServer(PORT, mailbox).start()
+    try:
+        db = ReconciliationDB(db_path)
+        daemon = PaymentAdviceIdleDaemon(db=db)
+
+        daemon.process_new_mail()
+        check('catch-up stores the advices in the window', advice_count(db) == 3, f"{advice_count(db)} stored")
+        checkpoint = db.get_imap_checkpoint(daemon.extractor._mailbox_key())
+        check('checkpoint saved at the newest UID', checkpoint is not None and checkpoint['last_uid'] == 6,
+              f"last UID {checkpoint['last_uid'] if checkpoint else None}")
+        check('advices marked as read', all(('\\Seen' in message.flags) == is_advice for message, (_, is_advice)
+                                            in zip(mailbox.snapshot(), inbox_messages())))
+
+        results = daemon.process_new_mail()
+        check('incremental pass with no new mail extracts nothing', results == [] and advice_count(db) == 3)
+
+        mail = daemon.extractor._connect()
+        try:
+            daemon.running = True
+            check('server advertises IDLE', daemon._supports_idle(mail))
+            check('IDLE times out without new mail', daemon.wait_for_new_mail(mail, 1) is False)
+            threading.Timer(0.5, mailbox.deliver, args=(advice_message(1004),)).start()
+            started = time.monotonic()
+            woke = daemon.wait_for_new_mail(mail, 10)
+            elapsed = time.monotonic() - started
+            check('IDLE wakes up on delivery (EXISTS)', woke and elapsed < 5, f"{elapsed:.1f}s")
+        finally:
+            daemon.running = False
+            daemon.extractor._disconnect(mail)
+
+        daemon.process_new_mail()
+        check('new advice ingested after the wake-up', advice_count(db) == 4, f"{advice_count(db)} stored")
+
+        mailbox.uidvalidity += 1
+        daemon.process_new_mail()
+        check('UIDVALIDITY change re-ingests the window over cleared run data', advice_count(db) == 4,
+              f"{advice_count(db)} stored")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def check_server_search(db_path, gmail):
+    mailbox = MockMailbox()
+    for raw_message in search_messages():
+        mailbox.deliver(raw_message)
+    server = MockImapServer(PORT, mailbox, gmail=gmail).start()
+    label = 'X-GM-RAW' if gmail else 'OR tree'
+    try:
+        extractor = PaymentAdviceExtractor(db=ReconciliationDB(db_path))
+        days_back = int(os.environ['DAYS_TO_SEARCH'])
+
+        # Replay source: plain SINCE search, classified locally
+        window = {}
+        for uid, raw_message in ImapMessageSource(extractor, days_back).iter_raw():
+            window[int(uid)] = email.message_from_bytes(raw_message)
+        in_window = [message for message in mailbox.snapshot()
+                     if message.date >= (datetime.now() - timedelta(days=days_back)).date()]
+        check(f'replay source ({label} server) sees every message in the window', len(window) == len(in_window),
+              f"{len(window)} of {len(in_window)}")
+        client_side = {uid for uid, message in window.items()
+                       if matches_payment_keywords(str(message.get('Subject', '')),
+                                                   PaymentAdviceExtractor._get_email_body(message))}
+
+        mail = extractor._connect()
+        try:
+            since_date = (datetime.now() - timedelta(days=days_back)).strftime('%d-%b-%Y')
+            try:
+                server_side = {int(uid) for uid in extractor._search_uids(mail, f'SINCE {since_date}')}
+            except Exception as e:
+                check(f'{label} criteria accepted by the server', False, str(e))
+                return
+            check(f'{label} criteria accepted by the server', True)
+        finally:
+            extractor._disconnect(mail)
+
+        if gmail:
+            # The Gmail query narrows by PDF attachment, not keywords: no PDF candidate may be lost
+            with_pdf = {uid for uid in client_side if mailbox.messages[uid - 1].has_pdf()}
+            check('X-GM-RAW keeps every keyword match with a PDF', with_pdf <= server_side,
+                  f"{len(server_side)} returned, {len(with_pdf)} matches with a PDF, "
+                  f"missing {sorted(with_pdf - server_side)}")
+        else:
+            check('OR tree returns the same set as the client-side filter', server_side == client_side,
+                  f"{len(server_side)} vs {len(client_side)}; only server {sorted(server_side - client_side)}, "
+                  f"only client {sorted(client_side - server_side)}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    # Usage: python check_mock_imap.py [idle|search]
+    selected = sys.argv[1:] or ['idle', 'search']
+    with tempfile.TemporaryDirectory() as tmp:
+        if 'idle' in selected:
+            check_idle_daemon(os.path.join(tmp, 'idle.db'))
+        if 'search' in selected:
+            check_server_search(os.path.join(tmp, 'search.db'), gmail=False)
+            check_server_search(os.path.join(tmp, 'search.db'), gmail=True)
+    print(f"\n{'❌ ' + str(len(failures)) + ' check(s) failed' if failures else '✅ All checks passed'}")
+    sys.exit(1 if failures else 0)
@@ -76,7 +76,8 @@ class ReconciliationDB:
                     balance_amount DECIMAL(15,2),
                     status TEXT,
                     fetched_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    warsoft_raw_json TEXT
+                    warsoft_raw_json TEXT,
+                    content_hash TEXT
                 )
             ''')
 
@@ -95,19 +96,171 @@ class ReconciliationDB:
                     discrepancy_notes TEXT,
                     reconciled_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     reconciled_by TEXT,
+                    snapshot_version INTEGER,
                     FOREIGN KEY (payment_advice_id) REFERENCES payment_advices(id),
                     FOREIGN KEY (warsoft_invoice_id) REFERENCES warsoft_invoices(id)
                 )
             ''')
 
+            # IMAP ingestion checkpoints (one row per mailbox)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS imap_checkpoints (
+                    mailbox TEXT PRIMARY KEY,
+                    uidvalidity INTEGER,
+                    last_uid INTEGER,
+                    updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Advices whose extraction failed, per IMAP UID (the checkpoint only waits for transient failures)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS extraction_failures (
+                    mailbox TEXT NOT NULL,
+                    uidvalidity INTEGER NOT NULL,
+                    uid INTEGER NOT NULL,
+                    attempts INTEGER DEFAULT 0,
+                    transient BOOLEAN,
+                    gave_up BOOLEAN DEFAULT 0,
+                    last_error TEXT,
+                    updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (mailbox, uidvalidity, uid)
+                )
+            ''')
+
+            # Per-sender outcomes of past classification/extraction (email_classifier)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sender_reputation (
+                    sender TEXT PRIMARY KEY,
+                    advices INTEGER DEFAULT 0,
+                    failures INTEGER DEFAULT 0,
+                    non_advices INTEGER DEFAULT 0,
+                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # OpenAI extraction results keyed by decrypted-PDF hash + prompt version + deployment
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS extraction_cache (
+                    pdf_sha256 TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    deployment TEXT NOT NULL,
+                    result_json TEXT NOT NULL,
+                    input_tokens INTEGER,
+                    output_tokens INTEGER,
+                    cost REAL,
+                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (pdf_sha256, prompt_version, deployment)
+                )
+            ''')
+
+            # Learned PDF layouts per sender domain + page anchors (layout_templates.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS layout_templates (
+                    fingerprint TEXT PRIMARY KEY,
+                    sender_domain TEXT,
+                    anchors TEXT,
+                    template_json TEXT NOT NULL,
+                    hits INTEGER DEFAULT 0,
+                    misses INTEGER DEFAULT 0,
+                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Which candidate PDF password (index, not the password) opened each sender's PDFs (pdf_document.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS pdf_password_hints (
+                    sender TEXT PRIMARY KEY,
+                    password_index INTEGER NOT NULL,
+                    updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Per sender: small-model extractions and how many were escalated (model_router.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS model_route_stats (
+                    sender TEXT PRIMARY KEY,
+                    small_requests INTEGER DEFAULT 0,
+                    escalations INTEGER DEFAULT 0,
+                    updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # One row per PDF extraction: latency, tokens, cost, path taken and outcome (extraction_telemetry.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS extraction_telemetry (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender TEXT,
+                    pdf_sha256 TEXT,
+                    pdf_bytes INTEGER,
+                    page_count INTEGER,
+                    pages_sent INTEGER,
+                    path TEXT,
+                    outcome TEXT NOT NULL,
+                    wall_ms REAL,
+                    requests INTEGER,
+                    input_tokens INTEGER,
+                    output_tokens INTEGER,
+                    cost REAL,
+                    invoices INTEGER,
+                    deployment TEXT,
+                    error TEXT,
+                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # One row per Warsoft invoice refresh; warsoft_invoices holds the latest version (invoice_snapshot.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS invoice_snapshots (
+                    version INTEGER PRIMARY KEY AUTOINCREMENT,
+                    invoices INTEGER,
+                    upserts INTEGER,
+                    deletes INTEGER,
+                    added INTEGER,
+                    changed INTEGER,
+                    unchanged INTEGER,
+                    pages INTEGER,
+                    pages_unchanged INTEGER,
+                    complete BOOLEAN,
+                    fetch_seconds REAL,
+                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # SHA-256 of each Warsoft page's invoices and the invoice numbers on it, as of the last sync
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS warsoft_page_hashes (
+                    page_no INTEGER PRIMARY KEY,
+                    sha256 TEXT NOT NULL,
+                    invoice_numbers TEXT NOT NULL,
+                    updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Columns added after a table was first created (CREATE TABLE IF NOT EXISTS skips existing tables)
+            self._add_missing_columns(cursor, 'reconciliation_results', {'snapshot_version': 'INTEGER'})
+            self._add_missing_columns(cursor, 'warsoft_invoices', {'content_hash': 'TEXT'})
+            self._add_missing_columns(cursor, 'invoice_snapshots', {
+                'added': 'INTEGER', 'changed': 'INTEGER', 'unchanged': 'INTEGER',
+                'pages': 'INTEGER', 'pages_unchanged': 'INTEGER'})
+
             # Create indexes for faster lookups
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_payment_invoice ON payment_advices(invoice_number)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_payment_status ON payment_advices(status)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_warsoft_invoice_num ON warsoft_invoices(invoice_number)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_recon_status ON reconciliation_results(match_status)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_date ON extraction_telemetry(created_date)')
 
             print("✅ Database initialized successfully")
 
+    @staticmethod
+    def _add_missing_columns(cursor, table, columns):
+        """ALTER TABLE ADD COLUMN for each of `columns` (name -> type) the table does not have yet"""
+        existing = {row['name'] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        for name, column_type in columns.items():
+            if name not in existing:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
     def check_payment_advice_exists(self, invoice_number, payment_amount, email_subject):
         """Check if a payment advice already exists to prevent duplicates
 
@@ -210,8 +363,8 @@ class ReconciliationDB:
                 INSERT INTO reconciliation_results 
                 (payment_advice_id, warsoft_invoice_id, invoice_number, match_status,
                  amount_match, amount_difference, date_match, confidence_score,
-                 discrepancy_notes, reconciled_by)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 discrepancy_notes, reconciled_by, snapshot_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 recon_data.get('payment_advice_id'),
                 recon_data.get('warsoft_invoice_id'),
@@ -222,10 +375,18 @@ class ReconciliationDB:
                 recon_data.get('date_match'),
                 recon_data.get('confidence_score'),
                 recon_data.get('discrepancy_notes'),
-                recon_data.get('reconciled_by', 'SYSTEM')
+                recon_data.get('reconciled_by', 'SYSTEM'),
+                recon_data.get('snapshot_version')
             ))
             return cursor.lastrowid
 
+    def delete_reconciliation_results(self, payment_advice_id):
+        """Delete the reconciliation results of one payment advice (before it is reconciled again)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM reconciliation_results WHERE payment_advice_id = ?', (payment_advice_id,))
+            return cursor.rowcount
+
     def get_pending_payment_advices(self):
         """Get all pending payment advices"""
         with self.get_connection() as conn:
@@ -233,6 +394,30 @@ class ReconciliationDB:
             cursor.execute('SELECT * FROM payment_advices WHERE status = "PENDING"')
             return cursor.fetchall()
 
+    def get_pending_invoice_numbers(self):
+        """Get the distinct invoice numbers of PENDING payment advices"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT DISTINCT invoice_number FROM payment_advices
+                WHERE status = "PENDING" AND invoice_number IS NOT NULL AND invoice_number != ''
+            ''')
+            return cursor.fetchall()
+
+    def get_not_found_payment_advices(self):
+        """Get id and invoice number of every payment advice whose invoice was not found in Warsoft"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, invoice_number FROM payment_advices WHERE status = "NOT_FOUND"')
+            return cursor.fetchall()
+
+    def get_payment_advice(self, payment_id):
+        """Get one payment advice by id"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM payment_advices WHERE id = ?', (payment_id,))
+            return cursor.fetchone()
+
     def get_warsoft_invoice_by_number(self, invoice_number):
         """Get Warsoft invoice by number"""
         with self.get_connection() as conn:
@@ -240,6 +425,17 @@ class ReconciliationDB:
             cursor.execute('SELECT * FROM warsoft_invoices WHERE invoice_number = ?', (invoice_number,))
             return cursor.fetchone()
 
+    def mark_warsoft_invoice_paid(self, invoice_number):
+        """Mark a snapshot invoice paid once a payment for it was written to Warsoft
+
+        content_hash is kept, so a sync only overwrites the mark if Warsoft
+        changed the invoice; a complete sync removes it once Warsoft drops it.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE warsoft_invoices SET status = 'paid' WHERE invoice_number = ?", (invoice_number,))
+            return cursor.rowcount
+
     def get_all_warsoft_invoices(self):
         """Get all Warsoft invoices (for in-memory caching)"""
         with self.get_connection() as conn:
@@ -247,12 +443,337 @@ class ReconciliationDB:
             cursor.execute('SELECT * FROM warsoft_invoices')
             return cursor.fetchall()
 
+    def get_warsoft_invoice_hashes(self):
+        """Get invoice_number -> content_hash of every stored Warsoft invoice"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT invoice_number, content_hash FROM warsoft_invoices')
+            return {row['invoice_number']: row['content_hash'] for row in cursor.fetchall()}
+
+    def get_warsoft_page_hashes(self):
+        """Get page_no -> row (sha256, invoice_numbers JSON) as of the last sync"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM warsoft_page_hashes')
+            return {row['page_no']: row for row in cursor.fetchall()}
+
+    def apply_invoice_snapshot(self, upserts, removed, pages, stats, last_page=None, fetch_seconds=None):
+        """Store a Warsoft sync as a new snapshot version, in one transaction
+
+        Only the invoices that changed are written: `upserts` (added or
+        changed; row ids are kept, so reconciliation results still join - an
+        invoice Warsoft renumbered matches its row by invoice_id) and
+        `removed` (paid since - only pass these after a complete fetch).
+
+        Args:
+            upserts: Parsed invoices (WarsoftClient.parse_invoice) with their content_hash
+            removed: Invoice numbers to delete
+            pages: (page_no, sha256, invoice_numbers JSON) of the pages that changed
+            stats: added, changed, unchanged, pages, pages_unchanged and complete of the sync
+            last_page: Last page with data; stored hashes of later pages are dropped
+
+        Returns:
+            dict: version, base_version (the previous one), invoices, and `rows`
+                  (the upserted warsoft_invoices rows)
+        """
+        columns = ('invoice_id', 'invoice_number', 'customer_name', 'invoice_date', 'sub_total', 'cgst', 'sgst',
+                   'igst', 'total_amount', 'balance_amount', 'status', 'warsoft_raw_json', 'content_hash')
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT MAX(version) AS version FROM invoice_snapshots')
+            base_version = cursor.fetchone()['version']
+
+            cursor.executemany(f'''
+                INSERT INTO warsoft_invoices ({', '.join(columns)}, fetched_date)
+                VALUES ({', '.join('?' for _ in columns)}, CURRENT_TIMESTAMP)
+                ON CONFLICT(invoice_number) DO UPDATE SET
+                    {', '.join(f'{column} = excluded.{column}' for column in columns[2:])},
+                    fetched_date = CURRENT_TIMESTAMP
+                ON CONFLICT(invoice_id) DO UPDATE SET
+                    {', '.join(f'{column} = excluded.{column}' for column in columns[1:])},
+                    fetched_date = CURRENT_TIMESTAMP
+            ''', [tuple(invoice.get(column) for column in columns) for invoice in upserts])
+            cursor.executemany('DELETE FROM warsoft_invoices WHERE invoice_number = ?',
+                               [(number,) for number in removed])
+
+            cursor.executemany('''
+                INSERT OR REPLACE INTO warsoft_page_hashes (page_no, sha256, invoice_numbers, updated_date)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ''', pages)
+            if last_page is not None:
+                cursor.execute('DELETE FROM warsoft_page_hashes WHERE page_no > ?', (last_page,))
+
+            cursor.execute('''
+                INSERT INTO invoice_snapshots (invoices, upserts, deletes, added, changed, unchanged,
+                                               pages, pages_unchanged, complete, fetch_seconds)
+                VALUES ((SELECT COUNT(*) FROM warsoft_invoices), ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (len(upserts), len(removed), stats['added'], stats['changed'], stats['unchanged'],
+                  stats['pages'], stats['pages_unchanged'], stats['complete'], fetch_seconds))
+            version = cursor.lastrowid
+            cursor.execute('SELECT invoices FROM invoice_snapshots WHERE version = ?', (version,))
+            invoice_count = cursor.fetchone()['invoices']
+
+            rows = []
+            numbers = [invoice['invoice_number'] for invoice in upserts]
+            for offset in range(0, len(numbers), 500):
+                batch = numbers[offset:offset + 500]
+                cursor.execute(f"SELECT * FROM warsoft_invoices WHERE invoice_number IN ({', '.join('?' for _ in batch)})",
+                               batch)
+                rows.extend(cursor.fetchall())
+            return {'version': version, 'base_version': base_version, 'invoices': invoice_count, 'rows': rows}
+
+    def get_latest_invoice_snapshot(self):
+        """Get the newest invoice snapshot (None before the first sync)
+
+        age_seconds is the age of that version; complete_age_seconds the age
+        of the newest complete one (None if no fetch was complete yet), since
+        partial versions (targeted syncs, page errors) never delete invoices.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT *, (julianday('now') - julianday(created_date)) * 86400 AS age_seconds,
+                       (SELECT (julianday('now') - julianday(MAX(created_date))) * 86400
+                        FROM invoice_snapshots WHERE complete = 1) AS complete_age_seconds
+                FROM invoice_snapshots ORDER BY version DESC LIMIT 1
+            ''')
+            return cursor.fetchone()
+
     def update_payment_status(self, payment_id, status):
         """Update payment advice status"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('UPDATE payment_advices SET status = ? WHERE id = ?', (status, payment_id))
 
+    def get_imap_checkpoint(self, mailbox):
+        """Get the stored UIDVALIDITY / last processed UID for a mailbox"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM imap_checkpoints WHERE mailbox = ?', (mailbox,))
+            return cursor.fetchone()
+
+    def save_imap_checkpoint(self, mailbox, uidvalidity, last_uid):
+        """Insert or update the ingestion checkpoint for a mailbox"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO imap_checkpoints (mailbox, uidvalidity, last_uid, updated_date)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (mailbox, uidvalidity, last_uid))
+
+    def clear_imap_checkpoint(self, mailbox):
+        """Forget the checkpoint so the next run rescans the full window"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM imap_checkpoints WHERE mailbox = ?', (mailbox,))
+            return cursor.rowcount
+
+    def record_extraction_failure(self, mailbox, uidvalidity, uid, error, transient, gave_up=False):
+        """Count one failed extraction of a message
+
+        Returns:
+            int: Failed attempts recorded for the message so far
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO extraction_failures (mailbox, uidvalidity, uid, attempts, transient, gave_up,
+                                                 last_error, updated_date)
+                VALUES (?, ?, ?, 1, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(mailbox, uidvalidity, uid) DO UPDATE SET
+                    attempts = attempts + 1,
+                    transient = excluded.transient,
+                    gave_up = MAX(gave_up, excluded.gave_up),
+                    last_error = excluded.last_error,
+                    updated_date = CURRENT_TIMESTAMP
+            ''', (mailbox, uidvalidity, uid, transient, gave_up, error))
+            cursor.execute('''
+                SELECT attempts FROM extraction_failures WHERE mailbox = ? AND uidvalidity = ? AND uid = ?
+            ''', (mailbox, uidvalidity, uid))
+            return cursor.fetchone()['attempts']
+
+    def give_up_extraction_failure(self, mailbox, uidvalidity, uid):
+        """Mark a message whose extraction kept failing as abandoned"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE extraction_failures SET gave_up = 1, updated_date = CURRENT_TIMESTAMP
+                WHERE mailbox = ? AND uidvalidity = ? AND uid = ?
+            ''', (mailbox, uidvalidity, uid))
+
+    def clear_extraction_failures(self, mailbox, uidvalidity, uids):
+        """Forget retried failures of messages that have now been extracted"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                DELETE FROM extraction_failures
+                WHERE mailbox = ? AND uidvalidity = ? AND uid = ? AND gave_up = 0
+            ''', [(mailbox, uidvalidity, uid) for uid in uids])
+
+    def get_extraction_failures(self, mailbox=None):
+        """Get failed extractions, abandoned ones first"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if mailbox:
+                cursor.execute('''
+                    SELECT * FROM extraction_failures WHERE mailbox = ? ORDER BY gave_up DESC, updated_date DESC
+                ''', (mailbox,))
+            else:
+                cursor.execute('SELECT * FROM extraction_failures ORDER BY gave_up DESC, updated_date DESC')
+            return cursor.fetchall()
+
+    def get_sender_reputation(self):
+        """Get all sender reputation rows"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM sender_reputation')
+            return cursor.fetchall()
+
+    def update_sender_reputation(self, deltas):
+        """Add outcome counts to sender reputation rows
+
+        Args:
+            deltas: dict of sender -> {'advices': n, 'failures': n, 'non_advices': n}
+        """
+        rows = [(sender, d.get('advices', 0), d.get('failures', 0), d.get('non_advices', 0))
+                for sender, d in deltas.items()]
+        if not rows:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO sender_reputation (sender, advices, failures, non_advices, last_seen)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(sender) DO UPDATE SET
+                    advices = advices + excluded.advices,
+                    failures = failures + excluded.failures,
+                    non_advices = non_advices + excluded.non_advices,
+                    last_seen = CURRENT_TIMESTAMP
+            ''', rows)
+
+    def get_extraction_cache(self, pdf_sha256, prompt_version, deployment):
+        """Get a cached OpenAI extraction result"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM extraction_cache
+                WHERE pdf_sha256 = ? AND prompt_version = ? AND deployment = ?
+            ''', (pdf_sha256, prompt_version, deployment))
+            return cursor.fetchone()
+
+    def save_extraction_cache(self, pdf_sha256, prompt_version, deployment, result_json,
+                              input_tokens=None, output_tokens=None, cost=None):
+        """Insert or update a cached OpenAI extraction result"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO extraction_cache
+                (pdf_sha256, prompt_version, deployment, result_json, input_tokens, output_tokens, cost, created_date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (pdf_sha256, prompt_version, deployment, result_json, input_tokens, output_tokens, cost))
+
+    def clear_extraction_cache(self, keep_prompt_version=None):
+        """Delete cached extractions, optionally keeping one prompt version"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if keep_prompt_version:
+                cursor.execute('DELETE FROM extraction_cache WHERE prompt_version != ?', (keep_prompt_version,))
+            else:
+                cursor.execute('DELETE FROM extraction_cache')
+            return cursor.rowcount
+
+    def get_layout_templates(self):
+        """Get all learned layout templates"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM layout_templates')
+            return cursor.fetchall()
+
+    def save_layout_template(self, fingerprint, sender_domain, anchors, template_json):
+        """Insert or refine a layout template, keeping its hit/miss counts"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO layout_templates (fingerprint, sender_domain, anchors, template_json)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(fingerprint) DO UPDATE SET
+                    template_json = excluded.template_json,
+                    updated_date = CURRENT_TIMESTAMP
+            ''', (fingerprint, sender_domain, anchors, template_json))
+
+    def record_layout_template_use(self, fingerprint, hit):
+        """Count one successful (hit) or rejected (miss) application of a template"""
+        column = 'hits' if hit else 'misses'
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'UPDATE layout_templates SET {column} = {column} + 1 WHERE fingerprint = ?',
+                           (fingerprint,))
+
+    def get_pdf_password_hints(self):
+        """Get the PDF password hint of every sender"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM pdf_password_hints')
+            return cursor.fetchall()
+
+    def save_pdf_password_hint(self, sender, password_index):
+        """Insert or update the PDF password hint of a sender"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO pdf_password_hints (sender, password_index, updated_date)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+            ''', (sender, password_index))
+
+    def get_model_route_stats(self):
+        """Get the small-model routing outcomes of every sender"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM model_route_stats')
+            return cursor.fetchall()
+
+    def update_model_route_stats(self, deltas):
+        """Add small-model extractions and escalations to sender rows
+
+        Args:
+            deltas: dict of sender -> {'small': n, 'escalated': n}
+        """
+        rows = [(sender, d.get('small', 0), d.get('escalated', 0)) for sender, d in deltas.items()]
+        if not rows:
+            return
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO model_route_stats (sender, small_requests, escalations, updated_date)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(sender) DO UPDATE SET
+                    small_requests = small_requests + excluded.small_requests,
+                    escalations = escalations + excluded.escalations,
+                    updated_date = CURRENT_TIMESTAMP
+            ''', rows)
+
+    def insert_extraction_telemetry(self, rows):
+        """Insert extraction telemetry records (dicts keyed by column name)"""
+        columns = ('sender', 'pdf_sha256', 'pdf_bytes', 'page_count', 'pages_sent', 'path', 'outcome', 'wall_ms',
+                   'requests', 'input_tokens', 'output_tokens', 'cost', 'invoices', 'deployment', 'error')
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(f'''
+                INSERT INTO extraction_telemetry ({', '.join(columns)})
+                VALUES ({', '.join('?' for _ in columns)})
+            ''', [tuple(row.get(column) for column in columns) for row in rows])
+
+    def get_extraction_telemetry(self, days=None):
+        """Get extraction telemetry records, optionally only those of the last `days` days"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            if days:
+                cursor.execute("SELECT * FROM extraction_telemetry WHERE created_date >= datetime('now', ?)",
+                               (f'-{int(days)} days',))
+            else:
+                cursor.execute('SELECT * FROM extraction_telemetry')
+            return cursor.fetchall()
+
     def get_reconciliation_summary(self):
         """Get reconciliation summary statistics"""
         with self.get_connection() as conn:
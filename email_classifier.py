@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Email classifier for payment advices
+Keyword matching plus a persisted sender reputation that lets known bank
+senders fast-path the keyword checks
+"""
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parseaddr
+from functools import lru_cache
+
+# Keywords used to quickly detect payment advice emails
+PAYMENT_KEYWORDS = [
+    'payment advice', 'payment confirmation', 'payment receipt',
+    'fund transfer', 'neft', 'rtgs', 'imps', 'upi',
+    'transaction confirmation', 'credit advice', 'debit advice',
+    'remittance advice', 'payment processed', 'amount credited',
+    'utr', 'transaction reference', 'payment reference',
+    'advice for', 'payee advice', 'payment remittance', 'remittance',
+    'transaction advice', 'fund transfer advice'
+]
+
+# Keywords that do not contain another keyword - same matches, fewer scans
+MATCH_KEYWORDS = tuple(keyword for keyword in PAYMENT_KEYWORDS
+                       if not any(other != keyword and other in keyword for other in PAYMENT_KEYWORDS))
+
+# Sender verdicts
+TRUSTED = 'trusted'
+NOISE = 'noise'
+UNKNOWN = 'unknown'
+
+# Outcomes recorded per message
+ADVICE = 'advices'
+FAILED = 'failures'
+NOT_ADVICE = 'non_advices'
+
+
+def matches_payment_keywords(subject, body):
+    """True if the subject or body mentions any payment keyword (case-insensitive)
+
+    Checks the short subject first, then one lower-cased copy of the
+    body. CPython's substring search beats a compiled alternation here (see
+    the benchmark below), so this stays a keyword loop.
+    """
+    subject = str(subject).lower()
+    for keyword in MATCH_KEYWORDS:
+        if keyword in subject:
+            return True
+    body = str(body).lower()
+    for keyword in MATCH_KEYWORDS:
+        if keyword in body:
+            return True
+    return False
+
+
+@lru_cache(maxsize=4096)
+def _parse_sender(from_header):
+    return parseaddr(from_header)[1].strip().lower()
+
+
+def sender_address(from_header):
+    """Normalise a From header to a lower-case address ('' if none)"""
+    return _parse_sender(str(from_header or ''))
+
+
+class SenderReputation:
+    """Per-sender counts of extracted advices, failed extractions and non-advices
+
+    Counts are kept in memory for lookups and written back to the
+    sender_reputation table by flush(). Thread-safe for the IMAP workers.
+    NOISE does not drop anything: mail from such senders is still classified
+    from its body, so a sender that starts sending advices is picked up
+    (and the verdict lapses after SENDER_NOISE_TTL_DAYS without an outcome).
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self.enabled = os.getenv('SENDER_REPUTATION', 'true').lower() == 'true'
+        self.trust_min_advices = int(os.getenv('SENDER_TRUST_MIN_ADVICES', 3))
+        self.noise_min_messages = int(os.getenv('SENDER_NOISE_MIN_MESSAGES', 20))
+        self.noise_ttl_seconds = float(os.getenv('SENDER_NOISE_TTL_DAYS', 30)) * 86400
+        self.scores = {}
+        self.last_seen = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """(Re)load all sender rows from the database"""
+        if self.db is None:
+            return 0
+        scores = {}
+        last_seen = {}
+        for row in self.db.get_sender_reputation():
+            scores[row['sender']] = {ADVICE: row['advices'] or 0, FAILED: row['failures'] or 0,
+                                     NOT_ADVICE: row['non_advices'] or 0}
+            last_seen[row['sender']] = _timestamp(row['last_seen'])
+        with self._lock:
+            self.scores = scores
+            self.last_seen = last_seen
+        return len(scores)
+
+    def verdict(self, from_header):
+        """TRUSTED for senders of valid advices, NOISE for recent senders of non-advices only
+
+        Failed extractions do not count towards NOISE: an outage or a bank
+        that also sends statements must not silence a real advice sender.
+        """
+        if not self.enabled:
+            return UNKNOWN
+        sender = sender_address(from_header)
+        score = self.scores.get(sender)
+        if not score:
+            return UNKNOWN
+        # Trusted while at most 1 in 5 extractions from the sender failed
+        if score[ADVICE] >= self.trust_min_advices and score[FAILED] * 4 <= score[ADVICE]:
+            return TRUSTED
+        if score[ADVICE] == 0 and score[NOT_ADVICE] >= self.noise_min_messages and \
+                time.time() - self.last_seen.get(sender, 0) < self.noise_ttl_seconds:
+            return NOISE
+        return UNKNOWN
+
+    def record(self, from_header, outcome):
+        """Count one ADVICE / FAILED / NOT_ADVICE outcome for the sender"""
+        sender = sender_address(from_header)
+        if not sender:
+            return
+        with self._lock:
+            for counts in (self.scores, self._pending):
+                score = counts.setdefault(sender, {ADVICE: 0, FAILED: 0, NOT_ADVICE: 0})
+                score[outcome] += 1
+            self.last_seen[sender] = time.time()
+
+    def record_extraction(self, from_header, payment_data_list):
+        """Record ADVICE if extraction produced an invoice number, FAILED otherwise"""
+        found = any(payment.get('invoice_number') for payment in payment_data_list or [])
+        self.record(from_header, ADVICE if found else FAILED)
+
+    def flush(self):
+        """Persist outcomes recorded since the last flush"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if self.db is not None and pending:
+            self.db.update_sender_reputation(pending)
+        return len(pending)
+
+
+def _timestamp(value):
+    """Epoch seconds of a SQLite CURRENT_TIMESTAMP value (UTC), 0 if missing"""
+    try:
+        return datetime.strptime(str(value), '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return 0.0
+
+
+def _legacy_is_payment_advice(subject, body):
+    """The previous implementation, kept for the benchmark below"""
+    text = f"{subject} {body}".lower()
+    return any(keyword in text for keyword in PAYMENT_KEYWORDS)
+
+
+def _synthetic_corpus(count):
+    subjects = ['Weekly newsletter', 'Your order has shipped', 'Payment Advice - Ref 8812',
+                'Meeting notes', 'NEFT credit for invoice 23EXT1126/1572', 'Re: quotation']
+    filler = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 40
+    corpus = []
+    for i in range(count):
+        body = filler if i % 3 else filler + ' The amount credited to your account today.'
+        corpus.append((subjects[i % len(subjects)], body))
+    return corpus
+
+
+def _time_classifier(classify, corpus, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for subject, body in corpus:
+            classify(subject, body)
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    # Usage: python email_classifier.py [message source spec, see message_sources.py]
+    messages = []
+    if len(sys.argv) > 1:
+        from message_sources import open_message_source
+        from payment_advice_extractor import PaymentAdviceExtractor
+        with open_message_source(sys.argv[1]) as source:
+            messages = [msg for _, msg in source.iter_messages()]
+        corpus = [(str(msg.get('Subject', '')), PaymentAdviceExtractor._get_email_body(msg)) for msg in messages]
+    else:
+        corpus = _synthetic_corpus(2000)
+
+    rounds = max(1, 20000 // max(1, len(corpus)))
+    alternation = re.compile('|'.join(re.escape(k) for k in sorted(PAYMENT_KEYWORDS, key=len, reverse=True)))
+    candidates = [
+        ('any(keyword in text)', _legacy_is_payment_advice),
+        ('compiled regex', lambda s, b: alternation.search(f"{s} {b}".lower()) is not None),
+        ('matches_payment_keywords', matches_payment_keywords),
+    ]
+    calls = len(corpus) * rounds
+
+    print(f"📊 Classifier benchmark: {len(corpus)} messages x {rounds} rounds")
+    baseline = None
+    for label, classify in candidates:
+        seconds = _time_classifier(classify, corpus, rounds)
+        baseline = baseline or seconds
+        agree = sum(classify(s, b) == _legacy_is_payment_advice(s, b) for s, b in corpus)
+        print(f"   ⏱️  {label:<26} {seconds / calls * 1e6:8.2f} µs/msg  "
+              f"({baseline / seconds:.2f}x, agrees on {agree}/{len(corpus)})")
+
+    if messages:
+        # What the TRUSTED fast path costs next to the body decode it can make unnecessary
+        reputation = SenderReputation()
+        started = time.perf_counter()
+        for msg in messages:
+            PaymentAdviceExtractor._get_email_body(msg)
+        decode = (time.perf_counter() - started) / len(messages)
+        started = time.perf_counter()
+        for msg in messages:
+            reputation.verdict(msg.get('From', ''))
+        lookup = (time.perf_counter() - started) / len(messages)
+        print(f"   ⏱️  body decode {decode * 1e6:8.2f} µs/msg vs sender verdict {lookup * 1e6:6.2f} µs/msg")
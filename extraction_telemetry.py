@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Extraction telemetry
+Records one row per PDF extraction in the extraction_telemetry table: wall
+time, tokens, cost, page count, PDF size, the path that produced the result
+(cache, layout template, local parser or LLM) and the outcome. Summaries
+(p50/p95 latency, cost per advice, slowest senders) are used to size the
+Azure OpenAI quota.
+"""
+import math
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+
+SUCCESS = 'success'
+FAILED = 'failed'
+DEFERRED = 'deferred'
+UNDECRYPTABLE = 'undecryptable'
+
+# Path of a PDF that went to the model (the others are prepared['source'] values)
+LLM = 'llm'
+
+
+class ExtractionTelemetry:
+    """Buffers extraction records and writes them to extraction_telemetry in batches
+
+    Thread-safe for the async pipeline and chunk workers. Call flush() at
+    the end of a run.
+    """
+
+    def __init__(self, db=None, batch_size=50):
+        self.db = db
+        self.enabled = db is not None and os.getenv('EXTRACTION_TELEMETRY', 'true').lower() == 'true'
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def record(self, **fields):
+        """Buffer one extraction (columns of extraction_telemetry)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending.append(fields)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write buffered records; returns how many were written"""
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if self.db is not None and rows:
+            self.db.insert_extraction_telemetry(rows)
+        return len(rows)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of `values` (None if there are none)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _latency(rows):
+    wall = [row['wall_ms'] for row in rows if row['wall_ms'] is not None]
+    return {'count': len(rows), 'p50_ms': percentile(wall, 0.5), 'p95_ms': percentile(wall, 0.95)}
+
+
+def summarize(rows, top_senders=10):
+    """Summarise telemetry rows
+
+    Returns:
+        dict: pdfs, outcomes, latency (overall and per path), token and cost
+              totals, cost per successfully extracted advice, tokens per LLM
+              PDF and the `top_senders` senders with the highest p95 latency
+    """
+    rows = [dict(row) for row in rows]
+    llm_rows = [row for row in rows if row['path'] == LLM]
+    advices = sum(1 for row in rows if row['outcome'] == SUCCESS)
+    cost = sum(row['cost'] or 0 for row in rows)
+    llm_tokens = [(row['input_tokens'] or 0) + (row['output_tokens'] or 0)
+                  for row in llm_rows if row['input_tokens'] is not None]
+
+    by_path = defaultdict(list)
+    by_sender = defaultdict(list)
+    for row in rows:
+        by_path[row['path'] or 'none'].append(row)
+        by_sender[row['sender'] or 'unknown'].append(row)
+
+    senders = []
+    for sender, sender_rows in by_sender.items():
+        stats = _latency(sender_rows)
+        stats.update(sender=sender, failures=sum(1 for row in sender_rows if row['outcome'] != SUCCESS))
+        senders.append(stats)
+    senders.sort(key=lambda stats: stats['p95_ms'] or 0, reverse=True)
+
+    return {
+        'pdfs': len(rows),
+        'outcomes': dict(Counter(row['outcome'] for row in rows)),
+        'latency': _latency(rows),
+        'paths': {path: _latency(path_rows) for path, path_rows in sorted(by_path.items())},
+        'llm_requests': sum(row['requests'] or 0 for row in llm_rows),
+        'input_tokens': sum(row['input_tokens'] or 0 for row in rows),
+        'output_tokens': sum(row['output_tokens'] or 0 for row in rows),
+        'cost': round(cost, 6),
+        'advices': advices,
+        'cost_per_advice': round(cost / advices, 6) if advices else None,
+        'tokens_per_llm_pdf': {'mean': round(sum(llm_tokens) / len(llm_tokens)) if llm_tokens else None,
+                               'p95': percentile(llm_tokens, 0.95)},
+        'slowest_senders': senders[:top_senders]
+    }
+
+
+def _ms(value):
+    return f"{value:.0f} ms" if value is not None else '-'
+
+
+def print_summary(summary, title="EXTRACTION TELEMETRY"):
+    print(f"\n{'=' * 60}")
+    print(title)
+    print(f"{'=' * 60}")
+    outcomes = ', '.join(f"{count} {outcome}" for outcome, count in sorted(summary['outcomes'].items()))
+    print(f"📄 {summary['pdfs']} PDFs ({outcomes or 'none'})")
+    print(f"⏱️  Latency p50 {_ms(summary['latency']['p50_ms'])}, p95 {_ms(summary['latency']['p95_ms'])}")
+    for path, stats in summary['paths'].items():
+        print(f"   {path:<10} {stats['count']:6} PDFs   p50 {_ms(stats['p50_ms']):>10}   p95 {_ms(stats['p95_ms']):>10}")
+    tokens = summary['tokens_per_llm_pdf']
+    print(f"📊 Tokens: {summary['input_tokens']} input + {summary['output_tokens']} output in "
+          f"{summary['llm_requests']} requests (per LLM PDF: mean {tokens['mean'] or '-'}, p95 {tokens['p95'] or '-'})")
+    per_advice = f"${summary['cost_per_advice']:.4f}" if summary['cost_per_advice'] is not None else '-'
+    print(f"💵 Cost: ${summary['cost']:.4f} for {summary['advices']} advices ({per_advice} per advice)")
+    if summary['slowest_senders']:
+        print(f"🐢 Slowest senders (p95):")
+        for stats in summary['slowest_senders']:
+            print(f"   {stats['sender']:<40} {stats['count']:5} PDFs   p95 {_ms(stats['p95_ms']):>10}   "
+                  f"{stats['failures']} not extracted")
+
+
+if __name__ == "__main__":
+    # Usage: python extraction_telemetry.py [days]
+    from database import ReconciliationDB
+
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    rows = ReconciliationDB().get_extraction_telemetry(days)
+    print_summary(summarize(rows), f"EXTRACTION TELEMETRY ({f'last {days} days' if days else 'all time'})")
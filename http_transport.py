@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Shared HTTP transport for the Warsoft, Zoho and Blob Storage clients
+One pooled keep-alive session per endpoint, so paging hundreds of Warsoft
+pages or pushing hundreds of payments reuses a few TCP/TLS connections
+instead of opening one per request. Sessions ask for gzip/deflate and
+apply per-endpoint timeouts. With HTTP2=true (and the h2 package) the
+Warsoft and Zoho sessions use an httpx client speaking HTTP/2, which
+multiplexes concurrent requests over one connection.
+"""
+import os
+import sys
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# Read timeouts in seconds per endpoint, overridable with <NAME>_TIMEOUT
+DEFAULT_TIMEOUTS = {'warsoft': 30, 'zoho': 30, 'blob': 60}
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def timeout(name):
+    """(connect, read) timeout for an endpoint"""
+    connect = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+    read = float(os.getenv(f'{name.upper()}_TIMEOUT', DEFAULT_TIMEOUTS.get(name, 30)))
+    return connect, read
+
+
+def pool_size(name):
+    """Keep-alive connections per host; Warsoft gets one per page-fetch worker"""
+    size = int(os.getenv('HTTP_POOL_SIZE', 10))
+    if name == 'warsoft':
+        size = max(size, int(os.getenv('WARSOFT_FETCH_WORKERS', '1')))
+    return size
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401 - httpx needs it for HTTP/2
+        import httpx  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class HttpSession:
+    """Pooled keep-alive requests.Session with a default timeout
+
+    get()/post() take the same arguments as requests.get()/post().
+    """
+
+    http_version = 'HTTP/1.1'
+
+    def __init__(self, name):
+        self.name = name
+        self.timeout = timeout(name)
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        size = pool_size(name)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=size, pool_block=False)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        self.requests += 1
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def connections(self):
+        """Connections opened so far (each one paid a TCP/TLS handshake)"""
+        adapters = {id(adapter): adapter for adapter in self.session.adapters.values()}
+        return sum(adapter.poolmanager.pools[key].num_connections
+                   for adapter in adapters.values() for key in adapter.poolmanager.pools.keys())
+
+    def close(self):
+        self.session.close()
+
+
+class _Http2Response:
+    """requests-style view of an httpx response (status_code, text, json(), raise_for_status())"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.content
+        self.text = response.text
+        self.url = str(response.url)
+
+    def json(self):
+        return self._response.json()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class Http2Session(HttpSession):
+    """HttpSession on an httpx HTTP/2 client; httpx errors are raised as the requests exceptions callers catch"""
+
+    http_version = 'HTTP/2'
+
+    def __init__(self, name):
+        import httpx
+        self.name = name
+        self.timeout = timeout(name)
+        size = pool_size(name)
+        self.client = httpx.Client(http2=True, headers={'Accept-Encoding': 'gzip, deflate'},
+                                   limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+                                   timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]))
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        import httpx
+        request_timeout = kwargs.pop('timeout', None)
+        if isinstance(request_timeout, tuple):
+            kwargs['timeout'] = httpx.Timeout(request_timeout[1], connect=request_timeout[0])
+        elif request_timeout is not None:
+            kwargs['timeout'] = request_timeout
+        self.requests += 1
+        try:
+            return _Http2Response(self.client.request(method, url, **kwargs))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.RequestException(str(e)) from e
+
+    def connections(self):
+        pool = getattr(getattr(self.client, '_transport', None), '_pool', None)
+        return len(pool.connections) if pool is not None else 0
+
+    def close(self):
+        self.client.close()
+
+
+def http_session(name):
+    """The shared session for an endpoint ('warsoft', 'zoho', 'blob'), created on first use"""
+    with _lock:
+        session = _sessions.get(name)
+        if session is None:
+            use_http2 = name != 'blob' and os.getenv('HTTP2', 'false').lower() == 'true'
+            if use_http2 and not http2_available():
+                print("⚠️  HTTP2=true but httpx[http2] is not installed; using HTTP/1.1 keep-alive")
+                use_http2 = False
+            session = Http2Session(name) if use_http2 else HttpSession(name)
+            _sessions[name] = session
+        return session
+
+
+def blob_transport():
+    """azure-core transport for ContainerClient on the shared 'blob' session"""
+    from azure.core.pipeline.transport import RequestsTransport
+    session = http_session('blob')
+    connect, read = session.timeout
+    return RequestsTransport(session=session.session, session_owner=False,
+                             connection_timeout=connect, read_timeout=read)
+
+
+def close_all():
+    """Close every shared session (their connections are reopened on next use)"""
+    with _lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+if __name__ == "__main__":
+    # Usage: python http_transport.py <url> [requests]
+    # POSTs {"pageNo": n} (e.g. to mock_warsoft_server.py) with a new connection per
+    # request and then over the shared session, and compares the time
+    if len(sys.argv) < 2:
+        print("Usage: python http_transport.py <url> [requests]")
+        sys.exit(1)
+
+    url = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    timings = []
+
+    started = time.perf_counter()
+    for page_no in range(1, count + 1):
+        requests.post(url, json={'pageNo': page_no}, timeout=timeout('warsoft')).raise_for_status()
+    timings.append(('per request', time.perf_counter() - started, count))
+
+    session = http_session('warsoft')
+    started = time.perf_counter()
+    for page_no in range(1, count + 1):
+        session.post(url, json={'pageNo': page_no}).raise_for_status()
+    timings.append((f'pooled {session.http_version}', time.perf_counter() - started, session.connections()))
+
+    print(f"\n📊 {count} requests to {url}")
+    for label, seconds, connections in timings:
+        print(f"   ⏱️  {label:<18} {seconds:8.2f}s  {seconds / count * 1000:7.1f} ms/request  "
+              f"{connections} connection(s)")
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+IMAP IDLE daemon - continuous payment advice ingestion
+Holds an IDLE session on the inbox and reconciles each new advice within
+seconds of arrival against a warm in-memory Warsoft invoice cache, kept
+current by background snapshot refreshes (invoice_snapshot.py)
+"""
+import os
+import select
+import ssl
+import sys
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+from database import ReconciliationDB
+from invoice_snapshot import InvoiceSnapshot
+from payment_advice_extractor import PaymentAdviceExtractor
+from payment_reconciliation import clear_run_data
+from reconciliation_engine import ReconciliationEngine
+from warsoft_client import WarsoftClient
+
+load_dotenv()
+
+# RFC 2177: servers may drop an IDLE session after 30 minutes of inactivity
+IDLE_RENEW_SECONDS = 29 * 60
+
+
+class PaymentAdviceIdleDaemon:
+    def __init__(self, db=None, extractor=None, warsoft=None, reconciler=None):
+        self.db = db if db is not None else ReconciliationDB()
+        self.extractor = extractor if extractor is not None else PaymentAdviceExtractor(db=self.db)
+        self.warsoft = warsoft if warsoft is not None else WarsoftClient()
+        self.reconciler = reconciler if reconciler is not None else ReconciliationEngine(self.db, self.warsoft)
+        self.days_back = int(os.getenv('DAYS_TO_SEARCH', 365))
+        self.idle_renew_seconds = int(os.getenv('IMAP_IDLE_RENEW_SECONDS', IDLE_RENEW_SECONDS))
+        self.poll_seconds = int(os.getenv('IMAP_IDLE_POLL_SECONDS', 60))
+        self.cache_refresh_seconds = int(os.getenv('INVOICE_CACHE_REFRESH_SECONDS', 1800))
+        self.snapshot = InvoiceSnapshot(self.db, self.warsoft, ttl_seconds=self.cache_refresh_seconds)
+        self.running = False
+
+    def refresh_invoice_cache(self, force=False):
+        """Keep the in-memory invoice cache on the newest snapshot
+
+        The first call loads the last snapshot (`force` also refreshes it
+        first). Later calls start a background refresh once the snapshot
+        is older than INVOICE_CACHE_REFRESH_SECONDS and switch to a version
+        that has finished, re-reconciling NOT_FOUND advices.
+
+        Returns:
+            bool: True if the cache was (re)loaded
+        """
+        if force or not self.snapshot.opened:
+            cache_count = self.snapshot.open(self.reconciler, force_refresh=force and self.warsoft.enabled)
+            print(f"   ⚡ {cache_count} invoices in memory")
+            return True
+
+        loaded = self.snapshot.version
+        results = self.snapshot.poll(self.reconciler)
+        if results:
+            self.reconciler.print_upload_summary(results)
+        if self.warsoft.enabled:
+            self.snapshot.refresh_if_stale()
+        return self.snapshot.version != loaded
+
+    def process_new_mail(self):
+        """Extract, store and reconcile every advice newer than the IMAP checkpoint
+
+        Returns:
+            list: Reconciliation results for the advices stored in this pass
+        """
+        self.refresh_invoice_cache()
+
+        results = []
+
+        def on_full_scan():
+            # No checkpoint or a UIDVALIDITY change: the whole window is ingested again, as in main()
+            clear_run_data(self.db)
+            results.clear()
+
+        for payment in self.extractor.iter_payment_advices_from_email(self.days_back, on_full_scan=on_full_scan):
+            try:
+                payment_id = self.db.insert_payment_advice(payment)
+            except Exception as e:
+                print(f"   ⚠️  Error storing payment: {e}")
+                continue
+            if payment_id is None:
+                continue
+
+            payment['id'] = payment_id
+            if self.snapshot.needs_sync(self.reconciler, payment.get('invoice_number')):
+                continue  # Reconciled after the targeted sync below
+            results.append(self.reconciler.reconcile_and_record(payment))
+
+        if self.snapshot.targeted:
+            results.extend(self.snapshot.sync_pending(self.reconciler))
+
+        if results:
+            print(f"\n✅ [{datetime.now():%H:%M:%S}] Reconciled {len(results)} new payment(s)")
+            self.reconciler.print_upload_summary(results)
+        return results
+
+    @staticmethod
+    def _announces_new_mail(line):
+        return line.rstrip().upper().endswith((b' EXISTS', b' RECENT'))
+
+    @staticmethod
+    def _buffered(mail):
+        """Whether imaplib's buffered reader (mail.file) holds data not returned by readline() yet
+
+        Several lines can arrive in one packet (e.g. "+ idling" followed by
+        "* 3 EXISTS"); readline() returns the first and keeps the rest in the
+        buffer, where select() on the socket cannot see it. peek() on the
+        socket switched to non-blocking returns the buffer without waiting.
+        """
+        sock = mail.sock
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(mail.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False  # Buffer empty and nothing on the socket
+        finally:
+            sock.settimeout(timeout)
+
+    @classmethod
+    def _readable(cls, mail, timeout):
+        """Wait until a readline() on the IMAP connection will not block"""
+        if cls._buffered(mail):
+            return True
+        sock = mail.sock
+        if getattr(sock, 'pending', None) and sock.pending():
+            return True  # Already decrypted by the SSL layer
+        readable, _, _ = select.select([sock], [], [], max(0, timeout))
+        return bool(readable)
+
+    def wait_for_new_mail(self, mail, timeout):
+        """Run one IDLE command until new mail arrives or `timeout` seconds pass
+
+        Returns:
+            bool: True if the server announced new messages (EXISTS/RECENT)
+        """
+        tag = mail._new_tag()
+        mail.send(tag + b' IDLE\r\n')
+
+        # Mail that arrived while we were busy is announced before the continuation
+        new_mail = False
+        while True:
+            line = mail.readline()
+            if not line:
+                raise mail.abort('connection closed while starting IDLE')
+            if line.startswith(b'+'):
+                break
+            if line.startswith(tag):
+                raise mail.error(f"IDLE rejected: {line.decode(errors='replace').strip()}")
+            new_mail = new_mail or self._announces_new_mail(line)
+
+        deadline = time.monotonic() + timeout
+        while self.running and not new_mail:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self._readable(mail, min(remaining, 1)):
+                continue
+            line = mail.readline()
+            if not line:
+                raise mail.abort('connection closed during IDLE')
+            if line.startswith(b'* BYE'):
+                raise mail.abort(line.decode(errors='replace').strip())
+            new_mail = self._announces_new_mail(line)
+
+        mail.send(b'DONE\r\n')
+        while True:
+            line = mail.readline()
+            if not line:
+                raise mail.abort('connection closed while ending IDLE')
+            if line.startswith(tag):
+                break
+        return new_mail
+
+    @staticmethod
+    def _supports_idle(mail):
+        """Check the server's CAPABILITY list for IDLE (RFC 2177)"""
+        typ, data = mail.capability()
+        return typ == 'OK' and b'IDLE' in b' '.join(data or []).upper().split()
+
+    def run(self):
+        """Catch up on the inbox, then reconcile new advices as they arrive"""
+        self.running = True
+        print("=" * 70)
+        print("📡 PAYMENT ADVICE IDLE DAEMON")
+        print("=" * 70)
+
+        self.refresh_invoice_cache()
+
+        backoff = 5
+        while self.running:
+            mail = None
+            try:
+                mail = self.extractor._connect()
+                use_idle = self._supports_idle(mail)
+
+                # Pick up anything that arrived before this session (first start or reconnect)
+                print("\n📧 Catching up on the inbox...")
+                self.process_new_mail()
+
+                if use_idle:
+                    print(f"\n💤 Waiting for new mail (IMAP IDLE, renewed every {self.idle_renew_seconds}s)...")
+                else:
+                    print(f"\n💤 Server has no IDLE support - polling every {self.poll_seconds}s")
+                backoff = 5
+
+                while self.running:
+                    if use_idle:
+                        new_mail = self.wait_for_new_mail(mail, self.idle_renew_seconds)
+                    else:
+                        time.sleep(self.poll_seconds)
+                        mail.noop()
+                        new_mail = True  # Incremental scan is cheap when nothing arrived
+
+                    if new_mail:
+                        print(f"\n📬 [{datetime.now():%H:%M:%S}] New mail - checking for payment advices")
+                        self.process_new_mail()
+                    else:
+                        self.refresh_invoice_cache()
+            except KeyboardInterrupt:
+                self.running = False
+            except Exception as e:
+                print(f"❌ IDLE session failed: {e} - reconnecting in {backoff}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 300)
+            finally:
+                if mail is not None:
+                    self.extractor._disconnect(mail)
+
+        print("👋 IDLE daemon stopped")
+
+    def stop(self):
+        """Ask run() to return after the current IDLE wait (within about a second)"""
+        self.running = False
+
+
+def main():
+    daemon = PaymentAdviceIdleDaemon()
+    if not daemon.warsoft.enabled:
+        print("\n❌ Warsoft API is not configured. Please set credentials in .env file")
+        print("📋 Required: WARSOFT_ACCESS_TOKEN (or ACCESS_TOKEN)")
+        sys.exit(1)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        print("\n👋 IDLE daemon stopped")
+
+
+if __name__ == "__main__":
+    main()
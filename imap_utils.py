@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+IMAP helpers for batched UID FETCH
+Parses raw imaplib FETCH responses (including literals) into per-message dicts
+"""
+import base64
+import quopri
+import re
+from email.header import decode_header
+from urllib.parse import unquote
+
+_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+
+
+def chunked(items, size):
+    """Yield successive lists of at most `size` items"""
+    size = max(1, int(size))
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def uid_set(uids):
+    """Build a compact IMAP sequence set (e.g. '1:5,9,12:13') from UIDs"""
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(f"{lo}:{hi}" if lo != hi else str(lo) for lo, hi in ranges)
+
+
+class _FetchTokenizer:
+    """Tokenizer over imaplib's FETCH data list
+
+    imaplib returns a list mixing plain bytes and (header, literal) tuples, where
+    the header ends with `{size}` and the literal carries the raw bytes.
+    """
+
+    def __init__(self, data):
+        self.chunks = []
+        for item in data:
+            if isinstance(item, tuple):
+                head, literal = item
+                match = _LITERAL_RE.search(head)
+                if match:
+                    self.chunks.append(('text', head[:match.start()]))
+                    self.chunks.append(('literal', literal))
+                else:
+                    self.chunks.append(('text', head))
+                    self.chunks.append(('text', literal))
+            elif item is not None:
+                self.chunks.append(('text', item))
+        self.chunk_idx = 0
+        self.pos = 0
+
+    def _current(self):
+        while self.chunk_idx < len(self.chunks):
+            kind, value = self.chunks[self.chunk_idx]
+            if kind == 'literal':
+                return kind, value
+            if self.pos < len(value):
+                return kind, value
+            self.chunk_idx += 1
+            self.pos = 0
+        return None, None
+
+    def _skip_space(self):
+        while True:
+            kind, value = self._current()
+            if kind != 'text':
+                return
+            while self.pos < len(value) and value[self.pos:self.pos + 1] in (b' ', b'\r', b'\n'):
+                self.pos += 1
+            if self.pos < len(value):
+                return
+
+    def at_end(self):
+        self._skip_space()
+        kind, _ = self._current()
+        return kind is None
+
+    def peek(self):
+        self._skip_space()
+        kind, value = self._current()
+        if kind is None:
+            return None
+        if kind == 'literal':
+            return 'literal'
+        return value[self.pos:self.pos + 1]
+
+    def next_token(self):
+        """Return ('(', None), (')', None), ('literal', bytes), ('string', str) or ('atom', str)"""
+        self._skip_space()
+        kind, value = self._current()
+        if kind is None:
+            return None, None
+        if kind == 'literal':
+            self.chunk_idx += 1
+            self.pos = 0
+            return 'literal', value
+
+        char = value[self.pos:self.pos + 1]
+        if char in (b'(', b')'):
+            self.pos += 1
+            return char.decode(), None
+
+        if char == b'"':
+            self.pos += 1
+            out = bytearray()
+            while self.pos < len(value):
+                c = value[self.pos:self.pos + 1]
+                if c == b'\\':
+                    out += value[self.pos + 1:self.pos + 2]
+                    self.pos += 2
+                    continue
+                if c == b'"':
+                    self.pos += 1
+                    break
+                out += c
+                self.pos += 1
+            return 'string', out.decode('utf-8', errors='replace')
+
+        # Atom - brackets may contain spaces/parens, e.g. BODY[HEADER.FIELDS (SUBJECT)]
+        start = self.pos
+        depth = 0
+        while self.pos < len(value):
+            c = value[self.pos:self.pos + 1]
+            if c == b'[':
+                depth += 1
+            elif c == b']':
+                depth -= 1
+            elif depth == 0 and c in (b' ', b'(', b')', b'\r', b'\n'):
+                break
+            self.pos += 1
+        return 'atom', value[start:self.pos].decode('utf-8', errors='replace')
+
+
+def _read_value(tokenizer):
+    kind, value = tokenizer.next_token()
+    if kind == '(':
+        items = []
+        while tokenizer.peek() not in (b')', None):
+            items.append(_read_value(tokenizer))
+        tokenizer.next_token()  # consume ')'
+        return items
+    if kind == 'atom' and value.upper() == 'NIL':
+        return None
+    return value
+
+
+def parse_fetch_response(data):
+    """Parse the data list returned by `mail.uid('FETCH', ...)`
+
+    Returns:
+        list: One dict per message with upper-cased item names as keys, e.g.
+              {'SEQ': '12', 'UID': '345', 'BODY[]': b'...'}. Literals stay as bytes,
+              quoted strings and atoms are str, NIL is None, lists are nested lists.
+    """
+    tokenizer = _FetchTokenizer(data or [])
+    messages = []
+    while not tokenizer.at_end():
+        kind, seq = tokenizer.next_token()
+        if kind != 'atom':
+            continue
+        if tokenizer.peek() != b'(':
+            continue  # Not a FETCH response line (e.g. stray untagged data)
+        tokenizer.next_token()
+        message = {'SEQ': seq}
+        while tokenizer.peek() not in (b')', None):
+            k_kind, key = tokenizer.next_token()
+            if k_kind != 'atom':
+                continue
+            message[key.upper()] = _read_value(tokenizer)
+        tokenizer.next_token()  # consume ')'
+        messages.append(message)
+    return messages
+
+
+def as_bytes(value):
+    """Coerce a parsed FETCH value (literal bytes or quoted string) to bytes"""
+    if value is None:
+        return b''
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8', errors='replace')
+
+
+def _param_dict(values):
+    """Turn an IMAP parameter list ("NAME" "value" ...) into a lower-cased dict"""
+    params = {}
+    if isinstance(values, list):
+        for key, value in zip(values[0::2], values[1::2]):
+            if isinstance(key, (str, bytes)) and value is not None:
+                key = key.decode() if isinstance(key, bytes) else key
+                value = value.decode('utf-8', errors='replace') if isinstance(value, bytes) else value
+                params[key.lower()] = value
+    return params
+
+
+def decode_mime_words(value):
+    """Decode RFC 2047 (=?utf-8?B?...?=) and RFC 2231 (utf-8''...) encoded values"""
+    if not value:
+        return value
+    if "''" in value:
+        charset, _, encoded = value.partition("''")
+        try:
+            return unquote(encoded, encoding=charset or 'utf-8', errors='ignore')
+        except LookupError:
+            return unquote(encoded)
+    try:
+        decoded = ""
+        for decoded_part, charset in decode_header(value):
+            if isinstance(decoded_part, bytes):
+                decoded += decoded_part.decode(charset or 'utf-8', errors='ignore')
+            else:
+                decoded += decoded_part
+        return decoded
+    except Exception:
+        return value
+
+
+def _walk_bodystructure(structure, section, parts):
+    if not isinstance(structure, list) or not structure:
+        return
+
+    # Multipart: one nested list per child, followed by the subtype
+    if isinstance(structure[0], list):
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            _walk_bodystructure(child, f"{section}.{index}" if section else str(index), parts)
+        return
+
+    section = section or '1'
+    maintype = str(structure[0] or '').lower()
+    subtype = str(structure[1] or '').lower() if len(structure) > 1 else ''
+    params = _param_dict(structure[2] if len(structure) > 2 else None)
+    encoding = str(structure[5] or '7bit').lower() if len(structure) > 5 else '7bit'
+    try:
+        size = int(structure[6]) if len(structure) > 6 and structure[6] is not None else 0
+    except (TypeError, ValueError):
+        size = 0
+
+    if maintype == 'text':
+        ext_index = 8
+    elif maintype == 'message' and subtype == 'rfc822':
+        ext_index = 10
+    else:
+        ext_index = 7
+
+    disposition = None
+    disposition_params = {}
+    if len(structure) > ext_index + 1 and isinstance(structure[ext_index + 1], list):
+        disposition_field = structure[ext_index + 1]
+        disposition = str(disposition_field[0] or '').lower() or None
+        disposition_params = _param_dict(disposition_field[1] if len(disposition_field) > 1 else None)
+
+    filename = (disposition_params.get('filename') or disposition_params.get('filename*')
+                or params.get('name') or params.get('name*'))
+
+    parts.append({
+        'section': section,
+        'content_type': f"{maintype}/{subtype}",
+        'params': params,
+        'encoding': encoding,
+        'size': size,
+        'disposition': disposition,
+        'filename': decode_mime_words(filename) if filename else None,
+    })
+
+    # Recurse into attached messages (forwarded advices)
+    if maintype == 'message' and subtype == 'rfc822' and len(structure) > 8 and isinstance(structure[8], list):
+        nested = structure[8]
+        if nested and isinstance(nested[0], list):
+            _walk_bodystructure(nested, section, parts)
+        else:
+            _walk_bodystructure(nested, f"{section}.1", parts)
+
+
+def parse_bodystructure(structure):
+    """Flatten a parsed BODYSTRUCTURE into its leaf parts
+
+    Returns:
+        list: Dicts with section, content_type, params, encoding, size,
+              disposition and filename for every non-multipart part
+    """
+    parts = []
+    _walk_bodystructure(structure, '', parts)
+    return parts
+
+
+def decode_transfer_encoding(data, encoding):
+    """Decode a raw BODY[<section>] payload using its Content-Transfer-Encoding
+
+    Tolerates truncated partial fetches (BODY[<section>]<0.N>).
+    """
+    data = as_bytes(data)
+    encoding = (encoding or '').lower()
+    try:
+        if encoding == 'base64':
+            compact = re.sub(rb'[^A-Za-z0-9+/=]', b'', data)
+            compact = compact[:len(compact) - (len(compact) % 4)]
+            return base64.b64decode(compact)
+        if encoding == 'quoted-printable':
+            return quopri.decodestring(data)
+    except Exception:
+        return b''
+    return data
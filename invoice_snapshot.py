@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Persistent, versioned Warsoft invoice snapshot (stale-while-revalidate)
+warsoft_invoices survives between runs and every refresh is recorded as a
+new version in invoice_snapshots. A run reconciles straight away against
+the last snapshot; if it is older than INVOICE_SNAPSHOT_TTL_SECONDS a
+background thread crawls Warsoft and applies upserts and deletes, and the
+run switches to the new version between two advices. Each result records
+the snapshot version it was matched against, and advices that were
+NOT_FOUND are reconciled again once their invoice appears.
+
+Syncs are deltas: each page's invoices and each invoice's normalized
+fields are hashed, so pages that came back identical are not even parsed
+and only added, changed and removed invoices are written to the database
+and the engine cache.
+
+With WARSOFT_SYNC_MODE=targeted a run fetches no full crawl up front:
+advices whose invoice is not in the snapshot wait as PENDING, and
+sync_pending() streams pages only until all their invoice numbers are
+found (or WARSOFT_TARGETED_PAGE_BUDGET pages), leaving the rest to a
+full refresh that the pending advices wait for.
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# parse_invoice fields that define an invoice's content (content_hash)
+HASHED_FIELDS = ('invoice_number', 'customer_name', 'invoice_date', 'sub_total', 'cgst', 'sgst', 'igst',
+                 'total_amount', 'balance_amount', 'status')
+
+
+def _sha256(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def page_hash(invoices):
+    """SHA-256 of a page's raw invoices (key order does not matter)"""
+    return _sha256(invoices)
+
+
+def content_hash(invoice):
+    """SHA-256 of a parsed invoice's normalized fields"""
+    return _sha256([invoice.get(field) for field in HASHED_FIELDS])
+
+
+class InvoiceSnapshot:
+    """Keeps a ReconciliationEngine's invoice cache on the newest snapshot version
+
+    Only refresh() runs on the background thread; the engine cache is
+    swapped (and NOT_FOUND advices re-reconciled) by poll(), on the thread
+    that reconciles.
+    """
+
+    def __init__(self, db, warsoft, ttl_seconds=None):
+        self.db = db
+        self.warsoft = warsoft
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else \
+            int(os.getenv('INVOICE_SNAPSHOT_TTL_SECONDS', 6 * 3600))
+        # full: refresh every page when stale; targeted: fetch pages only for the advices' invoice numbers
+        self.targeted = os.getenv('WARSOFT_SYNC_MODE', 'full').lower() == 'targeted'
+        self.page_budget = int(os.getenv('WARSOFT_TARGETED_PAGE_BUDGET', 10))
+        self.version = None  # Version loaded into the engine
+        self.opened = False
+        self._deltas = []  # Versions written by refresh() that poll() has not applied yet
+        self._thread = None
+        self._started = None  # time.monotonic() of the last background refresh
+        self._lock = threading.Lock()
+
+    def is_stale(self, snapshot):
+        """Whether the last complete fetch (get_latest_invoice_snapshot row) is older than the TTL
+
+        Partial versions (targeted syncs, fetches with page errors) do not
+        count: they never remove paid invoices.
+        """
+        return snapshot is None or snapshot['complete_age_seconds'] is None or \
+            snapshot['complete_age_seconds'] > self.ttl_seconds
+
+    def refresh(self, verbose=False):
+        """Fetch every unpaid invoice and store what changed as a new snapshot version
+
+        A page whose hash matches the last sync is skipped without parsing.
+        Invoices of the other pages are parsed and compared by content_hash.
+        Invoices missing from a complete fetch are removed.
+
+        Returns:
+            dict: version, invoices, added, changed, removed, unchanged, pages,
+                  pages_unchanged (None if Warsoft is not configured)
+        """
+        if not self.warsoft.enabled:
+            return None
+        started = time.perf_counter()
+        pages = self.warsoft.fetch_all_unpaid_invoice_pages(verbose=verbose)
+        return self._store(pages, self.warsoft.last_fetch_complete, started)
+
+    def targeted_sync(self, invoice_numbers):
+        """Fetch pages only until every one of `invoice_numbers` is found or the page budget runs out
+
+        Pages are streamed from page 1 and checked against the set as they
+        arrive. What changed on the fetched pages is stored as a new
+        snapshot version like refresh() does; invoices are only removed if
+        paging happened to reach the last page.
+
+        Returns:
+            dict: refresh() stats plus `unresolved`, the numbers not found
+                  (None if Warsoft is not configured)
+        """
+        if not self.warsoft.enabled:
+            return None
+        wanted = {number for number in invoice_numbers if number}
+        print(f"\n🎯 Targeted Warsoft sync: looking for {len(wanted)} invoice number(s) "
+              f"in at most {self.page_budget} pages")
+        started = time.perf_counter()
+        pages = []
+        found = set()
+        for page_no, raw_invoices in self.warsoft.iter_unpaid_invoice_pages(max_pages=self.page_budget):
+            pages.append((page_no, raw_invoices))
+            found.update(number for number in (invoice.get('invoiceNumber') for invoice in raw_invoices)
+                         if number in wanted)
+            if found >= wanted:
+                print(f"   🎯 All {len(wanted)} found by page {page_no}")
+                break
+        stats = self._store(pages, self.warsoft.last_fetch_complete, started)
+        stats['unresolved'] = sorted(wanted - found)
+        if stats['unresolved']:
+            reason = 'not unpaid in Warsoft' if stats['complete'] else f'not in the first {len(pages)} pages'
+            print(f"   ⚠️  {len(stats['unresolved'])} invoice number(s) {reason}")
+        return stats
+
+    def _store(self, pages, complete, started):
+        """Diff fetched (page_no, raw invoices) against the last sync and store the changes as a new version"""
+        known = self.db.get_warsoft_invoice_hashes()
+        known_pages = self.db.get_warsoft_page_hashes()
+        current = set()
+        upserts = []
+        changed_pages = []
+        stats = {'added': 0, 'changed': 0, 'unchanged': 0, 'pages': len(pages), 'pages_unchanged': 0,
+                 'complete': complete}
+
+        for page_no, raw_invoices in pages:
+            digest = page_hash(raw_invoices)
+            stored = known_pages.get(page_no)
+            if stored is not None and stored['sha256'] == digest:
+                numbers = json.loads(stored['invoice_numbers'])
+                if all(number in known for number in numbers):
+                    stats['pages_unchanged'] += 1
+                    stats['unchanged'] += len(set(numbers) - current)
+                    current.update(numbers)
+                    continue
+
+            numbers = []
+            for invoice_raw in raw_invoices:
+                try:
+                    invoice = self.warsoft.parse_invoice(invoice_raw)
+                except Exception as e:
+                    print(f"   ⚠️  Error parsing invoice {invoice_raw.get('invoiceNumber')}: {e}")
+                    continue
+                number = invoice.get('invoice_number')
+                if not number:
+                    continue
+                numbers.append(number)
+                if number in current:
+                    continue  # Also on an earlier page (the list shifted while paging)
+                current.add(number)
+                invoice['content_hash'] = content_hash(invoice)
+                if number not in known:
+                    stats['added'] += 1
+                elif known[number] != invoice['content_hash']:
+                    stats['changed'] += 1
+                else:
+                    stats['unchanged'] += 1
+                    continue
+                upserts.append(invoice)
+            changed_pages.append((page_no, digest, json.dumps(numbers)))
+
+        removed = [number for number in known if number not in current] if complete else []
+        last_page = pages[-1][0] if pages else 0
+        delta = self.db.apply_invoice_snapshot(upserts, removed, changed_pages, stats,
+                                               last_page=last_page if complete else None,
+                                               fetch_seconds=time.perf_counter() - started)
+        delta['removed'] = removed
+        with self._lock:
+            self._deltas.append(delta)
+
+        stats.update(version=delta['version'], invoices=delta['invoices'], removed=len(removed))
+        print(f"✅ Invoice snapshot v{stats['version']}: {stats['invoices']} unpaid invoices - "
+              f"{stats['added']} added, {stats['changed']} changed, {stats['removed']} removed, "
+              f"{stats['unchanged']} unchanged ({stats['pages_unchanged']} of {stats['pages']} pages unchanged) "
+              f"in {time.perf_counter() - started:.1f}s")
+        if not complete:
+            print("   ⚠️  Partial fetch (page errors or a page limit): no invoices were removed")
+        return stats
+
+    def refresh_in_background(self):
+        """Start refresh() on a daemon thread unless one is running; returns True if started"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._thread = threading.Thread(target=self._background_refresh, name='invoice-snapshot', daemon=True)
+            self._thread.start()
+            self._started = time.monotonic()
+        return True
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"❌ Background invoice refresh failed: {e} (still reconciling against v{self.version})")
+
+    def refreshing(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def open(self, engine, force_refresh=False):
+        """Load the last snapshot into the engine and revalidate it
+
+        Without any snapshot yet (or with force_refresh) the refresh runs
+        first, in this thread. Otherwise reconciliation can start at once
+        and a stale snapshot is refreshed in the background. In targeted
+        mode nothing is fetched here (see sync_pending).
+
+        Returns:
+            int: Invoices in the engine cache
+        """
+        snapshot = self.db.get_latest_invoice_snapshot()
+        if self.targeted and not force_refresh:
+            print(f"🎯 Targeted sync mode: invoice snapshot " +
+                  (f"v{snapshot['version']} ({complete_fetch_age(snapshot)})" if snapshot else "empty") +
+                  " - invoices missing from it are fetched for the advices that need them")
+        elif snapshot is None or force_refresh:
+            print("📥 No invoice snapshot yet - fetching from Warsoft first" if snapshot is None
+                  else "📥 Refreshing the invoice snapshot before reconciling")
+            self.refresh(verbose=True)
+            snapshot = self.db.get_latest_invoice_snapshot()
+        elif self.is_stale(snapshot):
+            print(f"📦 Invoice snapshot v{snapshot['version']} is stale ({complete_fetch_age(snapshot)}) "
+                  f"- reconciling against it while it is refreshed in the background")
+            self.refresh_in_background()
+        else:
+            print(f"📦 Invoice snapshot v{snapshot['version']} is fresh ({complete_fetch_age(snapshot)}, "
+                  f"TTL {self.ttl_seconds / 60:.0f} min) - no refresh needed")
+
+        self.version = snapshot['version'] if snapshot is not None else None
+        self.opened = True
+        return engine.load_invoice_cache(self.version)
+
+    def needs_sync(self, engine, invoice_number):
+        """Targeted mode: whether an advice must wait for sync_pending (its invoice is not in the cache)"""
+        return self.targeted and bool(invoice_number) and invoice_number not in engine.invoice_cache
+
+    def sync_pending(self, engine):
+        """Targeted mode: fetch the invoices of PENDING advices, then reconcile those advices
+
+        Invoice numbers still unresolved when the page budget runs out are
+        fetched by a full refresh. While a refresh is in flight (that one or
+        one started earlier) the advices stay PENDING until it has finished,
+        so they are not reconciled as NOT_FOUND against a partial cache. A
+        full refresh also starts in the background once the last complete
+        fetch is past the TTL (only that one removes paid invoices).
+
+        Returns:
+            list: Reconciliation results (including NOT_FOUND advices reconciled again)
+        """
+        numbers = {row['invoice_number'] for row in self.db.get_pending_invoice_numbers()} - \
+            set(engine.invoice_cache)
+        results = []
+        if numbers and self.warsoft.enabled:
+            if not self.refreshing():
+                stats = self.targeted_sync(numbers)
+                results.extend(self.poll(engine))
+                if stats['unresolved'] and not stats['complete']:
+                    print("   📥 Fetching the rest with a full refresh")
+                    self.refresh_in_background()
+            if self.refreshing():
+                print("   ⏳ Waiting for the invoice refresh before reconciling the pending advices...")
+                self.wait()
+                results.extend(self.poll(engine))
+        results.extend(engine.reconcile_all_pending())
+        if self.warsoft.enabled and self.refresh_if_stale():
+            print("📥 Last complete Warsoft fetch is past the TTL - refreshing every page in the background")
+        return results
+
+    def refresh_if_stale(self):
+        """Start a background refresh if the last complete fetch has passed its TTL
+
+        At most once per TTL, so a crawl that keeps coming back partial
+        (page errors, END_PAGE) is not restarted as soon as it ends.
+        """
+        if self._started is not None and time.monotonic() - self._started < self.ttl_seconds:
+            return False
+        if self.is_stale(self.db.get_latest_invoice_snapshot()):
+            return self.refresh_in_background()
+        return False
+
+    def poll(self, engine):
+        """Bring the engine up to snapshot versions that finished since the last call
+
+        Each version's added/changed and removed invoices are applied to the
+        engine cache; if the engine is not on the version a delta was made
+        from, the cache is reloaded instead. NOT_FOUND advices whose invoice
+        was added or changed are reconciled again.
+
+        Returns:
+            list: Results of the advices reconciled again
+        """
+        with self._lock:
+            deltas, self._deltas = self._deltas, []
+        numbers = set()
+        for delta in deltas:
+            if engine.snapshot_version is not None and delta['version'] <= engine.snapshot_version:
+                continue
+            print(f"\n🔄 Switching to invoice snapshot v{delta['version']}")
+            if numbers is not None and engine.snapshot_version == delta['base_version']:
+                engine.apply_invoice_changes(delta['rows'], delta['removed'], delta['version'])
+                numbers.update(row['invoice_number'] for row in delta['rows'])
+            else:
+                engine.load_invoice_cache(delta['version'])
+                numbers = None
+            self.version = delta['version']
+        if numbers is not None and not numbers:
+            return []
+        return engine.rereconcile_not_found(numbers)
+
+    def wait(self, timeout=None):
+        """Wait for a running background refresh to finish; returns False if it is still running"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return not self.refreshing()
+
+
+def complete_fetch_age(snapshot):
+    """'last complete fetch 12 min ago' for a get_latest_invoice_snapshot row"""
+    age = snapshot['complete_age_seconds']
+    return f"last complete fetch {age / 60:.0f} min ago" if age is not None else "no complete fetch yet"
+
+
+def merge_results(results, updated):
+    """Replace results in `results` (in place) by their re-reconciled versions from `updated`"""
+    by_payment = {result['payment_advice_id']: result for result in updated}
+    results[:] = [by_payment.pop(result['payment_advice_id'], result) for result in results] + \
+        list(by_payment.values())
+    return results
+
+
+if __name__ == "__main__":
+    # Usage: python invoice_snapshot.py [--refresh | --find <invoice_number> ...]
+    # Shows the newest snapshot; --refresh fetches a new version now, --find
+    # runs a targeted sync for the given invoice numbers
+    from database import ReconciliationDB
+    from warsoft_client import WarsoftClient
+
+    db = ReconciliationDB()
+    snapshot_manager = InvoiceSnapshot(db, WarsoftClient())
+    if '--refresh' in sys.argv:
+        snapshot_manager.refresh(verbose=False)
+    elif '--find' in sys.argv:
+        snapshot_manager.targeted_sync(sys.argv[sys.argv.index('--find') + 1:])
+    latest = db.get_latest_invoice_snapshot()
+    if latest is None:
+        print("📦 No invoice snapshot yet (run with --refresh)")
+    else:
+        state = 'stale' if snapshot_manager.is_stale(latest) else 'fresh'
+        print(f"📦 Invoice snapshot v{latest['version']}: {latest['invoices']} invoices, "
+              f"{latest['age_seconds'] / 60:.0f} min old, {complete_fetch_age(latest)} "
+              f"({state}, TTL {snapshot_manager.ttl_seconds / 60:.0f} min), "
+              f"{latest['added'] or 0} added, {latest['changed'] or 0} changed, {latest['deletes']} removed, "
+              f"{'complete' if latest['complete'] else 'partial'} fetch in {latest['fetch_seconds'] or 0:.1f}s")
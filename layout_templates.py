@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Per-sender layout templates for payment advice PDFs
+Fingerprints a PDF's layout (sender domain + page-1 text anchors), learns
+where each field sits from successful OpenAI extractions, and re-applies
+that layout to later PDFs from the same source without calling the model
+"""
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from email_classifier import sender_address
+from pdf_text_parser import (DATE_RE, INVOICE_RE, MONTHS, UTR_RE, amount_matches, amounts_in, date_matches, dates_in,
+                             invoice_rows)
+
+# Label lines of page 1 that make up the layout signature
+ANCHOR_COUNT = 8
+
+DATE_FIELDS = ('transaction_date', 'payment_date')
+AMOUNT_FIELDS = ('total_payment_amount',)
+REFERENCE_FIELDS = ('bank_reference_number', 'utr_number')
+ROW_AMOUNT_FIELDS = ('bill_amount', 'tds_amount', 'net_payment_amount')
+# Usually the same on every advice of one layout, so kept verbatim if they have no label
+CONSTANT_FIELDS = ('bank_name',)
+# Only the same on every advice of a layout if the value is part of the fingerprint
+# (a bank domain sends advices for many remitters)
+ANCHORED_CONSTANT_FIELDS = ('customer_name',)
+
+# Month and weekday words change from advice to advice, so they are left out of anchors
+DATE_WORDS = set(MONTHS) | {
+    'january', 'february', 'march', 'april', 'june', 'july', 'august', 'sept', 'september',
+    'october', 'november', 'december', 'mon', 'tue', 'tues', 'wed', 'thu', 'thur', 'thurs', 'fri',
+    'sat', 'sun', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'}
+
+# Start of the next label on a line ("... Branch: Mumbai", "... UTR No: ..."), where a text value ends
+NEXT_LABEL_RE = re.compile(r'\s+(?:[A-Za-z]+\s+(?:No|Name|Number|Date|Code|ID|Ref)\.?|[A-Za-z]+)\s*:', re.IGNORECASE)
+
+
+def sender_domain(from_header):
+    """Lower-case domain of a From header ('' if none)"""
+    return sender_address(from_header).rpartition('@')[2]
+
+
+def _label(text):
+    """Letters only, lower-cased, single-spaced"""
+    return ' '.join(re.sub(r'[^a-z]+', ' ', text.lower()).split())
+
+
+def _label_pattern(label):
+    return re.compile(r'[^a-z]+'.join(re.escape(word) for word in label.split()), re.IGNORECASE)
+
+
+def _normalize_invoice_number(value):
+    return re.sub(r'\s+', '', str(value or '')).upper()
+
+
+def _to_float(value):
+    try:
+        return float(str(value).replace(',', '').strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def layout_anchors(pages):
+    """Label text of the first page (before any ':'), without amounts, dates or invoice rows
+
+    Dates and month/weekday words are removed too, so lines such as
+    "Statement for March 2025" give the same anchor every month.
+    """
+    anchors = []
+    for line in (pages[0] if pages else '').split('\n'):
+        if INVOICE_RE.search(line):
+            continue
+        words = _label(DATE_RE.sub(' ', line.split(':')[0])).split()
+        label = ' '.join(word for word in words if word not in DATE_WORDS)
+        if len(label) >= 4 and label not in anchors:
+            anchors.append(label)
+            if len(anchors) >= ANCHOR_COUNT:
+                break
+    return anchors
+
+
+def layout_fingerprint(domain, anchors):
+    return hashlib.sha256(f"{domain}|{'|'.join(anchors)}".encode('utf-8')).hexdigest()[:16]
+
+
+def _field_kind(field):
+    if field in DATE_FIELDS:
+        return 'date'
+    if field in AMOUNT_FIELDS:
+        return 'amount'
+    if field in REFERENCE_FIELDS:
+        return 'reference'
+    return 'text'
+
+
+def _value_offsets(line, kind, value):
+    """Offsets in `line` where `value` appears"""
+    if kind == 'date':
+        return [offset for offset, date in date_matches(line) if date == value]
+    if kind == 'amount':
+        target = _to_float(value)
+        return [offset for offset, amount in amount_matches(line) if target is not None and abs(amount - target) < 0.005]
+    index = line.lower().find(str(value).lower())
+    return [index] if index >= 0 else []
+
+
+def _read_value(rest, kind):
+    """The value that follows a label on its line
+
+    References are a single token (a UTR where there is one); other text
+    ends at a column gap or the next label on the line.
+    """
+    if kind == 'date':
+        dates = dates_in(rest)
+        return dates[0] if dates else None
+    if kind == 'amount':
+        amounts = amounts_in(rest)
+        return amounts[0] if amounts else None
+    rest = rest.strip(' :-#.\t')
+    if kind == 'reference':
+        match = UTR_RE.match(rest)
+        if match:
+            return match.group(1)
+        token = rest.split()[0] if rest.split() else ''
+        return token if re.search(r'\d', token) else None
+    value = re.split(r'\s{2,}|\t', rest)[0]
+    match = NEXT_LABEL_RE.search(value)
+    if match:
+        value = value[:match.start()]
+    return value.strip(' :-') or None
+
+
+def _learn_common_field(lines, field, value, anchors=()):
+    kind = _field_kind(field)
+    for line in lines:
+        if field in AMOUNT_FIELDS and INVOICE_RE.search(line):
+            continue  # On a single-invoice advice the total is also the row's net amount
+        for offset in _value_offsets(line, kind, value):
+            # The last few words before the value are its label ("UTR No", "Value Date")
+            label = ' '.join(_label(line[:offset]).split()[-3:])
+            if label:
+                return {'label': label, 'kind': kind}
+    if field in CONSTANT_FIELDS:
+        return {'constant': value}
+    if field in ANCHORED_CONSTANT_FIELDS and _label(str(value)) and \
+            any(_label(str(value)) in anchor for anchor in anchors):
+        return {'constant': value}
+    return None
+
+
+def learn_template(pages, result):
+    """Derive a template from a PDF's text and its (OpenAI) extraction result
+
+    Returns:
+        dict: {'columns': {field: index in the row's dates/amounts},
+               'common': {field: {'label', 'kind'} or {'constant'}}},
+              or None if the result cannot be located in the text layer
+    """
+    text = '\n'.join(pages)
+    invoices = result.get('invoices') or []
+    if not invoices:
+        return None
+
+    rows = {}
+    for number, row in invoice_rows(text):
+        rows.setdefault(_normalize_invoice_number(number), row)
+
+    votes = {}
+    for invoice in invoices:
+        row = rows.get(_normalize_invoice_number(invoice.get('invoice_number')))
+        if row is None:
+            return None  # The model found an invoice the text layer does not show
+        amounts = amounts_in(row)
+        for field in ROW_AMOUNT_FIELDS:
+            target = _to_float(invoice.get(field))
+            if target is None:
+                continue
+            for index, amount in enumerate(amounts):
+                if abs(amount - target) < 0.005:
+                    votes.setdefault(field, Counter())[index] += 1
+                    break
+        if invoice.get('invoice_date') in dates_in(row):
+            votes.setdefault('invoice_date', Counter())[dates_in(row).index(invoice['invoice_date'])] += 1
+
+    if 'net_payment_amount' not in votes:
+        return None
+    template = {'columns': {field: counter.most_common(1)[0][0] for field, counter in votes.items()},
+                'common': {}}
+
+    lines = text.split('\n')
+    anchors = layout_anchors(pages)
+    for field, value in (result.get('common_details') or {}).items():
+        if value in (None, ''):
+            continue
+        spec = _learn_common_field(lines, field, value, anchors)
+        if spec:
+            template['common'][field] = spec
+    return template
+
+
+def apply_template(template, pages):
+    """Extract a PDF with a learned template
+
+    Returns:
+        dict: Result in the OpenAI extractor's shape, or None if the PDF does
+              not fit the template (missing columns or labels, amounts that
+              do not add up)
+    """
+    text = '\n'.join(pages)
+    invoices = []
+    seen = set()
+    for number, row in invoice_rows(text):
+        row_dates = dates_in(row)
+        amounts = amounts_in(row)
+        invoice = {'invoice_number': number, 'net_payment_amount': None, 'bill_amount': None,
+                   'tds_amount': None, 'invoice_date': None}
+        if not amounts and number in seen:
+            continue  # Repeated in a header or footer
+        for field, index in template['columns'].items():
+            source = row_dates if field == 'invoice_date' else amounts
+            if index >= len(source):
+                return None  # A learned column is missing: not this layout
+            invoice[field] = source[index]
+        seen.add(number)
+        if invoice['bill_amount'] is not None and invoice['tds_amount'] is not None and \
+                abs(invoice['bill_amount'] - invoice['tds_amount'] - invoice['net_payment_amount']) >= 0.015:
+            return None
+        invoices.append(invoice)
+    if not invoices:
+        return None
+
+    common = {}
+    for field, spec in template['common'].items():
+        if 'constant' in spec:
+            common[field] = spec['constant']
+            continue
+        value = None
+        pattern = _label_pattern(spec['label'])
+        for line in text.split('\n'):
+            match = pattern.search(line)
+            if match:
+                value = _read_value(line[match.end():], spec['kind'])
+                if value is not None:
+                    break
+        if value is None:
+            return None
+        common[field] = value
+
+    total = common.get('total_payment_amount')
+    if total is not None and abs(sum(inv['net_payment_amount'] for inv in invoices) - total) >= 1:
+        return None
+    return {'invoices': invoices, 'common_details': common}
+
+
+def _same_value(kind, a, b):
+    if kind == 'amount':
+        a, b = _to_float(a), _to_float(b)
+        return a is not None and b is not None and abs(a - b) < 0.005
+    return ' '.join(str(a).split()).lower() == ' '.join(str(b).split()).lower()
+
+
+def _same_extraction(a, b, fields=()):
+    """True if two results agree on the invoice numbers and net amounts, and on
+    the common details `fields` of `a`"""
+    def key(result):
+        return sorted((_normalize_invoice_number(inv.get('invoice_number')), round(_to_float(inv.get('net_payment_amount')) or 0, 2))
+                      for inv in result.get('invoices') or [])
+    if key(a) != key(b):
+        return False
+    common_a, common_b = a.get('common_details') or {}, b.get('common_details') or {}
+    return all(_same_value(_field_kind(field), common_a.get(field), common_b.get(field)) for field in fields)
+
+
+class LayoutTemplateStore:
+    """Learned templates keyed by layout fingerprint, persisted in layout_templates
+
+    Thread-safe for the async extraction workers.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self.enabled = os.getenv('LAYOUT_TEMPLATES', 'true').lower() == 'true'
+        self.templates = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """(Re)load all templates from the database"""
+        if self.db is None:
+            return 0
+        templates = {}
+        for row in self.db.get_layout_templates():
+            templates[row['fingerprint']] = {'domain': row['sender_domain'], 'template': json.loads(row['template_json']),
+                                             'hits': row['hits'] or 0, 'misses': row['misses'] or 0}
+        with self._lock:
+            self.templates = templates
+        return len(templates)
+
+    def fingerprint(self, sender, pages):
+        """Layout fingerprint of a PDF from `sender`, or None without a sender domain"""
+        domain = sender_domain(sender)
+        if not domain:
+            return None
+        return layout_fingerprint(domain, layout_anchors(pages))
+
+    def match(self, sender, pages):
+        """Apply the template learned for this sender and layout
+
+        Returns:
+            dict: The extraction result on a template hit, None on a miss
+                  (no template yet, or the PDF did not fit it)
+        """
+        if not self.enabled:
+            return None
+        fingerprint = self.fingerprint(sender, pages)
+        entry = self.templates.get(fingerprint) if fingerprint else None
+        if entry is None:
+            return None
+
+        result = apply_template(entry['template'], pages)
+        hit = result is not None
+        with self._lock:
+            entry['hits' if hit else 'misses'] += 1
+        if self.db is not None:
+            self.db.record_layout_template_use(fingerprint, hit)
+        return result
+
+    def learn(self, sender, pages, result):
+        """Learn (or refine) the template for this sender and layout from a model result
+
+        Only stored if re-applying it to the same PDF reproduces the result,
+        including every common detail the template reads.
+
+        Returns:
+            bool: True if a template was stored
+        """
+        if not self.enabled or not result:
+            return False
+        fingerprint = self.fingerprint(sender, pages)
+        if not fingerprint:
+            return False
+
+        template = learn_template(pages, result)
+        if template is None:
+            return False
+        reproduced = apply_template(template, pages)
+        if reproduced is None or not _same_extraction(reproduced, result, template['common']):
+            return False
+
+        domain = sender_domain(sender)
+        with self._lock:
+            entry = self.templates.setdefault(fingerprint, {'domain': domain, 'template': None, 'hits': 0, 'misses': 0})
+            if entry['template'] == template:
+                return False
+            refined = entry['template'] is not None
+            entry['template'] = template
+        if self.db is not None:
+            self.db.save_layout_template(fingerprint, domain, json.dumps(layout_anchors(pages)), json.dumps(template))
+        print(f"   🧩 {'Refined' if refined else 'Learned'} layout template for {domain} ({fingerprint})")
+        return True
+
+
+if __name__ == "__main__":
+    # Usage: python layout_templates.py [<pdf> <sender>]
+    from database import ReconciliationDB
+    store = LayoutTemplateStore(ReconciliationDB())
+
+    if len(sys.argv) > 2:
+        from pdf_text_parser import extract_text
+        with open(sys.argv[1], 'rb') as f:
+            pages = extract_text(f.read())
+        fingerprint = store.fingerprint(sys.argv[2], pages)
+        print(f"🧩 Fingerprint {fingerprint} - anchors: {layout_anchors(pages)}")
+        print(json.dumps(store.match(sys.argv[2], pages), indent=2))
+        sys.exit(0)
+
+    print(f"🧩 {len(store.templates)} layout template(s)")
+    for fingerprint, entry in sorted(store.templates.items(), key=lambda item: item[1]['domain'] or ''):
+        print(f"   {fingerprint}  {entry['domain']:<30} {entry['hits']:5} hits {entry['misses']:5} misses  "
+              f"columns {entry['template']['columns']}")
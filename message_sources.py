@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Message sources for payment advice ingestion
+Yields raw RFC 822 messages from IMAP, an mbox file, a Maildir or a
+directory of .eml files so ingestion can be replayed and benchmarked offline
+"""
+import email
+import mailbox
+import os
+import sys
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from pathlib import Path
+from imap_utils import chunked
+
+
+class MessageSource(ABC):
+    """Base class: iterate (key, raw_bytes) pairs and parsed messages"""
+
+    name = 'source'
+
+    @abstractmethod
+    def iter_raw(self):
+        """Yield (key, raw RFC 822 bytes) for every message in the source"""
+
+    def iter_messages(self):
+        """Yield (key, email.message.Message), parsed like the IMAP path does"""
+        for key, raw_message in self.iter_raw():
+            yield key, email.message_from_bytes(raw_message)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name})"
+
+
+class ImapMessageSource(MessageSource):
+    """Full messages from the configured IMAP inbox (SINCE `days_back` days)
+
+    Reuses the extractor's connection, search and batched FETCH helpers. The
+    search is a plain SINCE without the server-side keyword filter, so a
+    replay sees every message the classifier would. It does not prescreen or
+    fetch by section - use the extractor's own
+    iter_payment_advices_from_email() for production ingestion.
+    """
+
+    name = 'imap'
+
+    def __init__(self, extractor, days_back=7, max_emails=None):
+        self.extractor = extractor
+        self.days_back = days_back
+        self.max_emails = max_emails if max_emails is not None else int(os.getenv('MAX_EMAILS_TO_PROCESS', 100))
+
+    def iter_raw(self):
+        mail = self.extractor._connect()
+        try:
+            since_date = (datetime.now() - timedelta(days=self.days_back)).strftime('%d-%b-%Y')
+            uids = self.extractor._search_uids(mail, f'SINCE {since_date}', narrow=False)[::-1][:self.max_emails]
+            for batch in chunked(uids, int(os.getenv('IMAP_FETCH_BATCH_SIZE', 50))):
+                yield from self.extractor._fetch_messages_batch(mail, batch)
+        finally:
+            self.extractor._disconnect(mail)
+
+
+class MboxMessageSource(MessageSource):
+    """Messages from a single mbox file (e.g. a Google Takeout export)"""
+
+    def __init__(self, path):
+        self.name = str(path)
+        self.mbox = mailbox.mbox(path, create=False)
+
+    def iter_raw(self):
+        for key in self.mbox.iterkeys():
+            yield key, self.mbox.get_bytes(key)
+
+    def close(self):
+        self.mbox.close()
+
+
+class MaildirMessageSource(MessageSource):
+    """Messages from a Maildir (cur/ and new/)"""
+
+    def __init__(self, path):
+        self.name = str(path)
+        self.maildir = mailbox.Maildir(path, factory=None, create=False)
+
+    def iter_raw(self):
+        for key in sorted(self.maildir.iterkeys()):
+            yield key, self.maildir.get_bytes(key)
+
+    def close(self):
+        self.maildir.close()
+
+
+class EmlDirectoryMessageSource(MessageSource):
+    """Every *.eml file below a directory, in path order"""
+
+    def __init__(self, path):
+        self.name = str(path)
+        self.path = Path(path)
+        if not self.path.is_dir():
+            raise ValueError(f"Not a directory: {path}")
+
+    def iter_raw(self):
+        for eml_path in sorted(self.path.rglob('*.eml')):
+            yield str(eml_path.relative_to(self.path)), eml_path.read_bytes()
+
+
+def open_message_source(spec, extractor=None, days_back=7):
+    """Build a MessageSource from a spec string
+
+    Args:
+        spec: 'imap', 'mbox:<file>', 'maildir:<dir>', 'eml:<dir>', or a bare
+              path (a directory with cur/new is a Maildir, any other
+              directory holds .eml files, a file is an mbox)
+        extractor: PaymentAdviceExtractor providing the IMAP connection (imap only)
+        days_back: IMAP search window (imap only)
+
+    Returns:
+        MessageSource: The opened source
+    """
+    kind, sep, path = spec.partition(':')
+    if not sep or kind not in ('mbox', 'maildir', 'eml'):
+        kind, path = None, spec
+
+    if spec == 'imap':
+        if extractor is None:
+            raise ValueError("An extractor is required for the IMAP source")
+        return ImapMessageSource(extractor, days_back)
+
+    if kind is None:
+        p = Path(path)
+        if not p.exists():
+            raise ValueError(f"Message source not found: {path}")
+        if p.is_dir():
+            kind = 'maildir' if (p / 'cur').is_dir() and (p / 'new').is_dir() else 'eml'
+        else:
+            kind = 'mbox'
+
+    if kind == 'mbox':
+        return MboxMessageSource(path)
+    if kind == 'maildir':
+        return MaildirMessageSource(path)
+    return EmlDirectoryMessageSource(path)
+
+
+def benchmark_source(source):
+    """Measure read, parse and classification throughput of a source
+
+    Classification runs the same header + body heuristic as the IMAP path,
+    without calling OpenAI.
+
+    Returns:
+        dict: Counts, bytes and per-stage seconds
+    """
+    from payment_advice_extractor import PaymentAdviceExtractor
+
+    stats = {'messages': 0, 'bytes': 0, 'advices': 0, 'with_pdf': 0,
+             'read_seconds': 0.0, 'parse_seconds': 0.0, 'classify_seconds': 0.0}
+
+    raw_iter = source.iter_raw()
+    while True:
+        started = time.perf_counter()
+        try:
+            _, raw_message = next(raw_iter)
+        except StopIteration:
+            stats['read_seconds'] += time.perf_counter() - started
+            break
+        parsed_at = time.perf_counter()
+        stats['read_seconds'] += parsed_at - started
+
+        email_message = email.message_from_bytes(raw_message)
+        classified_at = time.perf_counter()
+        stats['parse_seconds'] += classified_at - parsed_at
+
+        subject = str(email_message.get('Subject', ''))
+        body = PaymentAdviceExtractor._get_email_body(email_message)
+        is_advice = PaymentAdviceExtractor.is_payment_advice_email(subject, body)
+        stats['classify_seconds'] += time.perf_counter() - classified_at
+
+        stats['messages'] += 1
+        stats['bytes'] += len(raw_message)
+        if is_advice:
+            stats['advices'] += 1
+            if any(part.get_content_type() == 'application/pdf' or
+                   (part.get_filename() or '').lower().endswith('.pdf') for part in email_message.walk()):
+                stats['with_pdf'] += 1
+
+    return stats
+
+
+def _print_benchmark(source, stats):
+    count = stats['messages'] or 1
+    megabytes = stats['bytes'] / (1024 * 1024)
+    print(f"\n📊 BENCHMARK: {source!r}")
+    print(f"   📧 Messages: {stats['messages']} ({megabytes:.1f} MB)")
+    print(f"   💰 Classified as payment advice: {stats['advices']} ({stats['with_pdf']} with a PDF)")
+    for stage in ('read', 'parse', 'classify'):
+        seconds = stats[f'{stage}_seconds']
+        rate = stats['messages'] / seconds if seconds else float('inf')
+        print(f"   ⏱️  {stage:<8} {seconds:8.3f}s  {rate:10.0f} msg/s  {seconds / count * 1000:7.3f} ms/msg")
+    total = stats['read_seconds'] + stats['parse_seconds'] + stats['classify_seconds']
+    if total:
+        print(f"   ⚡ Total: {total:.3f}s - {stats['messages'] / total:.0f} msg/s, {megabytes / total:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    # Usage: python message_sources.py <imap|mbox:file|maildir:dir|eml:dir|path> [--extract]
+    if len(sys.argv) < 2:
+        print("Usage: python message_sources.py <imap|mbox:FILE|maildir:DIR|eml:DIR|PATH> [--extract]")
+        sys.exit(1)
+
+    spec = sys.argv[1]
+    extractor = None
+    if spec == 'imap' or '--extract' in sys.argv:
+        from payment_advice_extractor import PaymentAdviceExtractor
+        extractor = PaymentAdviceExtractor()
+
+    with open_message_source(spec, extractor, int(os.getenv('DAYS_TO_SEARCH', 365))) as source:
+        if '--extract' in sys.argv:
+            # Full replay through OpenAI extraction (costs tokens)
+            started = time.perf_counter()
+            advices = list(extractor.iter_payment_advices_from_source(source))
+            print(f"\n✅ Replayed {source!r}: {len(advices)} payment records in {time.perf_counter() - started:.1f}s")
+            print(f"💵 OpenAI cost: ${extractor.openai_extractor.get_total_cost():.4f}")
+        else:
+            _print_benchmark(source, benchmark_source(source))
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the IMAP inbox
+Serves a mailbox loaded from a message source (.eml directory, mbox or
+Maildir - see message_sources.py) over plain-text IMAP (IMAP_USE_SSL=false).
+Handles what the extractor and the IDLE daemon use: LOGIN, SELECT/STATUS
+with UIDVALIDITY/UIDNEXT, UID SEARCH (SINCE, UID, SUBJECT, BODY, OR and,
+with --gmail, X-GM-RAW), UID FETCH (full messages, BODYSTRUCTURE, header
+fields and partial sections), UID STORE and IDLE with EXISTS pushed as
+mail is delivered. Not a general IMAP server
+"""
+import email
+import re
+import select
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+_ATOM_RE = re.compile(rb'[^\s()"\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?')
+_SECTION_RE = re.compile(r'^BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)(?:\.(\d+))?>)?$', re.IGNORECASE)
+
+
+def tokenize(line):
+    """Split an IMAP command into atoms, quoted strings (str) and nested lists"""
+    stack = [[]]
+    pos = 0
+    while pos < len(line):
+        char = line[pos:pos + 1]
+        if char.isspace():
+            pos += 1
+        elif char == b'(':
+            stack.append([])
+            pos += 1
+        elif char == b')':
+            items = stack.pop()
+            stack[-1].append(items)
+            pos += 1
+        elif char == b'"':
+            out = bytearray()
+            pos += 1
+            while pos < len(line) and line[pos:pos + 1] != b'"':
+                if line[pos:pos + 1] == b'\\':
+                    pos += 1
+                out += line[pos:pos + 1]
+                pos += 1
+            pos += 1
+            stack[-1].append(('string', out.decode('utf-8', errors='replace')))
+        else:
+            match = _ATOM_RE.match(line, pos)
+            stack[-1].append(match.group().decode('utf-8', errors='replace'))
+            pos = match.end()
+    return stack[0]
+
+
+def _value(token):
+    return token[1] if isinstance(token, tuple) else token
+
+
+def quote(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _params(pairs):
+    pairs = [(key, value) for key, value in pairs if value is not None]
+    if not pairs:
+        return 'NIL'
+    return '(' + ' '.join(f"{quote(key.upper())} {quote(value)}" for key, value in pairs) + ')'
+
+
+def _raw_body(part):
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, str):
+        return payload.encode('utf-8', errors='surrogateescape')
+    return part.as_bytes()
+
+
+def bodystructure(part):
+    """BODYSTRUCTURE of a parsed message (part), in the form imap_utils.parse_bodystructure reads"""
+    maintype, subtype = part.get_content_maintype(), part.get_content_subtype()
+    if part.get_content_type() == 'message/rfc822':
+        nested = part.get_payload(0)
+        raw = nested.as_bytes()
+        lines = raw.count(b'\n')
+        return f'("message" "rfc822" NIL NIL NIL "7bit" {len(raw)} NIL {bodystructure(nested)} {lines})'
+    if part.is_multipart():
+        return '(' + ''.join(bodystructure(child) for child in part.get_payload()) + f' {quote(subtype)})'
+
+    body = _raw_body(part)
+    fields = [quote(maintype), quote(subtype), _params(part.get_params()[1:] if part.get_params() else []),
+              quote(part.get('Content-ID')), 'NIL', quote(part.get('Content-Transfer-Encoding', '7bit').lower()),
+              str(len(body))]
+    if maintype == 'text':
+        fields.append(str(body.count(b'\n')))
+    fields.append('NIL')  # MD5
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_param('filename', header='Content-Disposition')
+        fields.append(f"({quote(disposition)} {_params([('filename', filename)])})")
+    else:
+        fields.append('NIL')
+    fields.append('NIL')  # Language
+    return '(' + ' '.join(fields) + ')'
+
+
+def section_part(message, section):
+    """The part addressed by a numeric section ("2", "1.2"), numbered like bodystructure()"""
+    part = message
+    for number in section.split('.'):
+        number = int(number)
+        if part.get_content_type() == 'message/rfc822':
+            part = part.get_payload(0)
+        if part.is_multipart():
+            part = part.get_payload()[number - 1]
+        elif number != 1:
+            raise IndexError(section)
+    return part
+
+
+class MockMessage:
+    def __init__(self, uid, raw):
+        self.uid = uid
+        self.raw = raw
+        self.message = email.message_from_bytes(raw)
+        self.flags = set()
+        try:
+            self.date = parsedate_to_datetime(self.message['Date']).date()
+        except (TypeError, ValueError):
+            self.date = datetime.now().date()
+
+    def text(self):
+        """Decoded text parts (what servers match BODY against)"""
+        chunks = []
+        for part in self.message.walk():
+            if part.get_content_maintype() == 'text':
+                payload = part.get_payload(decode=True) or b''
+                chunks.append(payload.decode(part.get_content_charset() or 'utf-8', errors='ignore'))
+        return ' '.join(chunks)
+
+    def has_pdf(self):
+        return any((part.get_filename() or '').lower().endswith('.pdf') for part in self.message.walk())
+
+
+class MockMailbox:
+    """The single INBOX: messages by UID, and a condition IDLE sessions wait on"""
+
+    def __init__(self, uidvalidity=None):
+        self.uidvalidity = uidvalidity or int(time.time())
+        self.uidnext = 1
+        self.messages = []
+        self.changed = threading.Condition()
+
+    def deliver(self, raw):
+        """Append a message (raw RFC 822 bytes); IDLE sessions are told at once"""
+        with self.changed:
+            self.messages.append(MockMessage(self.uidnext, raw))
+            self.uidnext += 1
+            self.changed.notify_all()
+            return self.uidnext - 1
+
+    def snapshot(self):
+        with self.changed:
+            return list(self.messages)
+
+
+class MockImapHandler(socketserver.StreamRequestHandler):
+    mailbox = None
+    gmail = False
+    stats = {'connections': 0, 'commands': 0, 'idles': 0}
+    lock = threading.Lock()
+
+    def send(self, data):
+        self.wfile.write(data if isinstance(data, bytes) else data.encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        with self.lock:
+            MockImapHandler.stats['connections'] += 1
+        self.selected = False
+        self.known = 0
+        self.send(f"* OK [CAPABILITY {self.capabilities()}] Mock IMAP ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tokens = tokenize(line.rstrip(b'\r\n'))
+            if len(tokens) < 2:
+                self.send(b'* BAD Empty command\r\n')
+                continue
+            tag, command, args = tokens[0], str(tokens[1]).upper(), tokens[2:]
+            with self.lock:
+                MockImapHandler.stats['commands'] += 1
+            try:
+                if self.dispatch(tag, command, args) is False:
+                    return
+            except Exception as e:
+                self.send(f"{tag} BAD {type(e).__name__}: {e}\r\n")
+
+    def capabilities(self):
+        return 'IMAP4rev1 IDLE' + (' X-GM-EXT-1' if self.gmail else '')
+
+    def dispatch(self, tag, command, args):
+        if command == 'CAPABILITY':
+            self.send(f"* CAPABILITY {self.capabilities()}\r\n{tag} OK CAPABILITY completed\r\n")
+        elif command == 'LOGIN':
+            self.send(f"{tag} OK LOGIN completed\r\n")
+        elif command in ('SELECT', 'EXAMINE'):
+            messages = self.mailbox.snapshot()
+            self.selected = True
+            self.known = len(messages)
+            self.send(f"* FLAGS (\\Seen)\r\n* {len(messages)} EXISTS\r\n* 0 RECENT\r\n"
+                      f"* OK [UIDVALIDITY {self.mailbox.uidvalidity}] UIDs valid\r\n"
+                      f"* OK [UIDNEXT {self.mailbox.uidnext}] Predicted next UID\r\n"
+                      f"{tag} OK [READ-WRITE] {command} completed\r\n")
+        elif command == 'STATUS':
+            messages = self.mailbox.snapshot()
+            self.send(f"* STATUS INBOX (MESSAGES {len(messages)} UIDVALIDITY {self.mailbox.uidvalidity} "
+                      f"UIDNEXT {self.mailbox.uidnext})\r\n{tag} OK STATUS completed\r\n")
+        elif command == 'NOOP':
+            self.announce()
+            self.send(f"{tag} OK NOOP completed\r\n")
+        elif command == 'UID':
+            self.uid_command(tag, str(args[0]).upper(), args[1:])
+        elif command == 'IDLE':
+            self.idle(tag)
+        elif command == 'CLOSE':
+            self.selected = False
+            self.send(f"{tag} OK CLOSE completed\r\n")
+        elif command == 'LOGOUT':
+            self.send(f"* BYE Mock IMAP logging out\r\n{tag} OK LOGOUT completed\r\n")
+            return False
+        else:
+            self.send(f"{tag} BAD Unsupported command {command}\r\n")
+
+    def announce(self):
+        """Report messages delivered since the client last heard (EXISTS)"""
+        count = len(self.mailbox.snapshot())
+        if count != self.known:
+            self.known = count
+            self.send(f"* {count} EXISTS\r\n")
+
+    def idle(self, tag):
+        with self.lock:
+            MockImapHandler.stats['idles'] += 1
+        self.send(b'+ idling\r\n')
+        while True:
+            self.announce()
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b'DONE':
+                    break
+            with self.mailbox.changed:
+                if len(self.mailbox.messages) == self.known:
+                    self.mailbox.changed.wait(0.2)
+        self.send(f"{tag} OK IDLE terminated\r\n")
+
+    def uid_command(self, tag, command, args):
+        messages = self.mailbox.snapshot()
+        if command == 'SEARCH':
+            matcher = self.parse_search(list(args), messages)
+            uids = [str(message.uid) for message in messages if matcher(message)]
+            self.send(f"* SEARCH {' '.join(uids)}\r\n{tag} OK SEARCH completed\r\n".replace('SEARCH \r\n', 'SEARCH\r\n'))
+        elif command == 'FETCH':
+            wanted = self.uid_matcher(str(args[0]), messages)
+            items = args[1] if isinstance(args[1], list) else args[1:]
+            for seq, message in enumerate(messages, 1):
+                if wanted(message):
+                    self.send_fetch(seq, message, [str(item) for item in items])
+            self.send(f"{tag} OK FETCH completed\r\n")
+        elif command == 'STORE':
+            wanted = self.uid_matcher(str(args[0]), messages)
+            flags = args[2] if isinstance(args[2], list) else [args[2]]
+            for seq, message in enumerate(messages, 1):
+                if wanted(message):
+                    message.flags.update(str(flag) for flag in flags)
+                    self.send(f"* {seq} FETCH (UID {message.uid} FLAGS ({' '.join(sorted(message.flags))}))\r\n")
+            self.send(f"{tag} OK STORE completed\r\n")
+        else:
+            self.send(f"{tag} BAD Unsupported UID command {command}\r\n")
+
+    @staticmethod
+    def uid_matcher(spec, messages):
+        """Predicate for a UID set; "n:*" includes the newest message even below n, as RFC 3501 says"""
+        highest = max((message.uid for message in messages), default=0)
+        ranges = []
+        for item in spec.split(','):
+            low, _, high = item.partition(':')
+            low = highest if low == '*' else int(low)
+            high = low if not high else (highest if high == '*' else int(high))
+            ranges.append((min(low, high), max(low, high)))
+        return lambda message: any(low <= message.uid <= high for low, high in ranges)
+
+    def parse_search(self, tokens, messages):
+        """Predicate for search criteria (all keys must match)"""
+        keys = []
+        while tokens:
+            keys.append(self._search_key(tokens, messages))
+        return lambda message: all(key(message) for key in keys)
+
+    def _search_key(self, tokens, messages):
+        token = tokens.pop(0)
+        if isinstance(token, list):
+            return self.parse_search(list(token), messages)
+        key = _value(token).upper()
+        if key == 'ALL':
+            return lambda message: True
+        if key == 'OR':
+            left, right = self._search_key(tokens, messages), self._search_key(tokens, messages)
+            return lambda message: left(message) or right(message)
+        if key == 'NOT':
+            inner = self._search_key(tokens, messages)
+            return lambda message: not inner(message)
+        if key in ('SINCE', 'BEFORE', 'ON'):
+            day = datetime.strptime(_value(tokens.pop(0)), '%d-%b-%Y').date()
+            return {'SINCE': lambda message: message.date >= day,
+                    'BEFORE': lambda message: message.date < day,
+                    'ON': lambda message: message.date == day}[key]
+        if key == 'UID':
+            return self.uid_matcher(_value(tokens.pop(0)), messages)
+        if key in ('SUBJECT', 'FROM'):
+            needle = _value(tokens.pop(0)).lower()
+            return lambda message: needle in str(message.message.get(key.title(), '')).lower()
+        if key in ('BODY', 'TEXT'):
+            needle = _value(tokens.pop(0)).lower()
+            if key == 'TEXT':
+                return lambda message: needle in f"{message.message.get('Subject', '')} {message.text()}".lower()
+            return lambda message: needle in message.text().lower()
+        if key in ('SEEN', 'UNSEEN'):
+            return lambda message: ('\\Seen' in message.flags) == (key == 'SEEN')
+        if key == 'X-GM-RAW' and self.gmail:
+            return self._gmail_raw(_value(tokens.pop(0)))
+        raise ValueError(f"Unsupported search key {key}")
+
+    @staticmethod
+    def _gmail_raw(query):
+        """The subset of Gmail search used here: has:attachment, filename:<ext>, plain words"""
+        checks = []
+        for term in query.lower().split():
+            if term == 'has:attachment':
+                checks.append(lambda message: any(part.get_filename() for part in message.message.walk()))
+            elif term.startswith('filename:'):
+                suffix = term.partition(':')[2]
+                checks.append(lambda message, suffix=suffix: any(
+                    (part.get_filename() or '').lower().endswith(suffix) for part in message.message.walk()))
+            else:
+                checks.append(lambda message, word=term: word in
+                              f"{message.message.get('Subject', '')} {message.text()}".lower())
+        return lambda message: all(check(message) for check in checks)
+
+    def send_fetch(self, seq, message, items):
+        out = [f"* {seq} FETCH (UID {message.uid}".encode()]
+        for item in items:
+            name = item.upper()
+            if name == 'UID':
+                continue
+            if name == 'FLAGS':
+                out.append(f" FLAGS ({' '.join(sorted(message.flags))})".encode())
+            elif name == 'BODYSTRUCTURE':
+                out.append(f" BODYSTRUCTURE {bodystructure(message.message)}".encode())
+            elif name in ('RFC822', 'BODY[]', 'BODY.PEEK[]'):
+                out.append(self._literal('BODY[]' if name != 'RFC822' else 'RFC822', message.raw))
+            else:
+                match = _SECTION_RE.match(item)
+                if not match:
+                    raise ValueError(f"Unsupported FETCH item {item}")
+                section, origin, length = match.group(1), match.group(2), match.group(3)
+                data = self._section(message, section)
+                key = f"BODY[{section}]"
+                if origin is not None:
+                    start = int(origin)
+                    data = data[start:start + int(length)] if length else data[start:]
+                    key += f"<{origin}>"
+                out.append(self._literal(key, data))
+        out.append(b")\r\n")
+        self.send(b''.join(out))
+
+    @staticmethod
+    def _literal(key, data):
+        return f" {key} {{{len(data)}}}\r\n".encode() + data
+
+    @staticmethod
+    def _section(message, section):
+        upper = section.upper()
+        if not section:
+            return message.raw
+        if upper == 'HEADER':
+            return message.raw.split(b'\r\n\r\n', 1)[0].split(b'\n\n', 1)[0] + b'\r\n\r\n'
+        if upper.startswith('HEADER.FIELDS'):
+            names = re.findall(r'[\w-]+', upper.partition('(')[2])
+            lines = [f"{name}: {value}" for name, value in message.message.items() if name.upper() in names]
+            return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8', errors='replace')
+        if upper == 'TEXT':
+            return _raw_body(message.message) if not message.message.is_multipart() else \
+                message.message.as_bytes().split(b'\n\n', 1)[-1]
+        part = section_part(message.message, section)
+        if part.is_multipart() or part.get_content_type() == 'message/rfc822':
+            return part.as_bytes().split(b'\n\n', 1)[-1]
+        return _raw_body(part)
+
+
+class MockImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=1143, mailbox=None, gmail=False):
+        handler = type('Handler', (MockImapHandler,), {'mailbox': mailbox or MockMailbox(), 'gmail': gmail})
+        super().__init__(('127.0.0.1', port), handler)
+        self.mailbox = handler.mailbox
+
+    def start(self):
+        """Serve on a background thread; returns the server"""
+        threading.Thread(target=self.serve_forever, name='mock-imap', daemon=True).start()
+        return self
+
+
+def load_mailbox(spec, mailbox=None):
+    """Deliver every message of a message source spec (see open_message_source) to the mailbox"""
+    from message_sources import open_message_source
+    mailbox = mailbox or MockMailbox()
+    with open_message_source(spec) as source:
+        for _, raw_message in source.iter_raw():
+            mailbox.deliver(raw_message)
+    return mailbox
+
+
+def serve(port=1143, spec=None, gmail=False):
+    """Run the stand-in until interrupted (IMAP_SERVER=127.0.0.1 IMAP_PORT=<port> IMAP_USE_SSL=false)"""
+    mailbox = load_mailbox(spec) if spec else MockMailbox()
+    server = MockImapServer(port, mailbox, gmail)
+    print(f"🧪 Mock IMAP on 127.0.0.1:{port} ({len(mailbox.messages)} messages"
+          f"{', Gmail extensions' if gmail else ''}) - set IMAP_USE_SSL=false")
+    print(f"   ⌨️  Type a path to an .eml file (or a directory of them) and Enter to deliver it")
+    server.start()
+    try:
+        for line in sys.stdin:
+            path = line.strip()
+            if path:
+                before = len(mailbox.messages)
+                load_mailbox(path, mailbox)
+                print(f"   📬 Delivered {len(mailbox.messages) - before} message(s)")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        stats = MockImapHandler.stats
+        print(f"🧪 {stats['commands']} commands over {stats['connections']} connections, {stats['idles']} IDLE(s)")
+
+
+if __name__ == "__main__":
+    # Usage: python mock_imap_server.py [port] [message source] [--gmail]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    serve(int(args[0]) if args else 1143, args[1] if len(args) > 1 else None, '--gmail' in sys.argv)
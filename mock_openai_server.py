@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Local mock of the Azure OpenAI Responses endpoint
+Answers POST .../responses with a canned payment advice after a fixed
+latency (plus an optional delay per 1K input tokens, like a real model
+reading a long PDF). It can throttle like a deployment (429 + Retry-After):
+above an RPM quota, above a number of concurrent requests, or at random
+for a fraction of requests. Per-model profiles make one deployment
+faster but sometimes incomplete, to benchmark model routing. The
+extraction paths can thus be exercised and benchmarked without Azure
+"""
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_RESULT = {
+    'invoices': [{
+        'invoice_number': '23EXT1126/1572',
+        'net_payment_amount': '8644.00',
+        'bill_amount': '8820.41',
+        'tds_amount': '176.41',
+        'invoice_date': '2025-01-15'
+    }],
+    'common_details': {
+        'transaction_date': '2025-02-01',
+        'payment_date': '2025-02-01',
+        'bank_name': 'Mock Bank',
+        'bank_reference_number': 'MOCKN52025112997504684',
+        'customer_name': 'Mock Customer Pvt Ltd'
+    }
+}
+
+
+class MockResponsesHandler(BaseHTTPRequestHandler):
+    latency = 2.0
+    latency_per_1k_tokens = 0.0
+    rpm = 0
+    max_concurrent = 0
+    throttle_rate = 0.0
+    # model -> (latency factor, share of responses with the invoice rows missing)
+    model_profiles = {}
+    recent_requests = deque()
+    in_flight = 0
+    stats = {'requests': 0, 'throttled': 0, 'peak_concurrent': 0, 'incomplete': 0, 'models': {}}
+    lock = threading.Lock()
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _retry_after(self):
+        """Seconds until another request fits the RPM quota (0 if it fits now); call with `lock` held"""
+        if not self.rpm:
+            return 0
+        now = time.monotonic()
+        while self.recent_requests and now - self.recent_requests[0] >= 60:
+            self.recent_requests.popleft()
+        if len(self.recent_requests) >= self.rpm:
+            return 60 - (now - self.recent_requests[0])
+        self.recent_requests.append(now)
+        return 0
+
+    def do_POST(self):
+        request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.rstrip('/').endswith('/responses'):
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+
+        with self.lock:
+            MockResponsesHandler.stats['requests'] += 1
+            retry_after = self._retry_after()
+            if not retry_after and self.max_concurrent and self.in_flight >= self.max_concurrent:
+                retry_after = 1
+            if not retry_after and random.random() < self.throttle_rate:
+                retry_after = 1
+            if retry_after:
+                MockResponsesHandler.stats['throttled'] += 1
+            else:
+                MockResponsesHandler.in_flight += 1
+                MockResponsesHandler.stats['peak_concurrent'] = max(self.stats['peak_concurrent'], self.in_flight)
+        if retry_after:
+            self._send_json(429, {'error': {'code': '429', 'message': 'Rate limit exceeded'}},
+                            {'Retry-After': str(int(retry_after) + 1)})
+            return
+
+        try:
+            self._respond(request_body)
+        finally:
+            with self.lock:
+                MockResponsesHandler.in_flight -= 1
+
+    def _respond(self, request_body):
+        request = json.loads(request_body or b'{}')
+        model = request.get('model', 'mock')
+        latency_factor, failure_rate = self.model_profiles.get(model, (1.0, 0.0))
+        input_tokens = len(request_body) // 4
+        time.sleep((self.latency + self.latency_per_1k_tokens * input_tokens / 1000) * latency_factor)
+        result = MOCK_RESULT
+        with self.lock:
+            MockResponsesHandler.stats['models'][model] = self.stats['models'].get(model, 0) + 1
+            if random.random() < failure_rate:
+                MockResponsesHandler.stats['incomplete'] += 1
+                result = {'invoices': [], 'common_details': MOCK_RESULT['common_details']}
+        output_text = json.dumps(result)
+        output_tokens = len(output_text) // 4
+        self._send_json(200, {
+            'id': f'resp_{uuid.uuid4().hex}',
+            'object': 'response',
+            'created_at': int(time.time()),
+            'model': model,
+            'status': 'completed',
+            'output': [{
+                'id': f'msg_{uuid.uuid4().hex}',
+                'type': 'message',
+                'role': 'assistant',
+                'status': 'completed',
+                'content': [{'type': 'output_text', 'text': output_text, 'annotations': []}]
+            }],
+            'parallel_tool_calls': True,
+            'tool_choice': 'auto',
+            'tools': [],
+            'usage': {
+                'input_tokens': input_tokens,
+                'input_tokens_details': {'cached_tokens': 0},
+                'output_tokens': output_tokens,
+                'output_tokens_details': {'reasoning_tokens': 0},
+                'total_tokens': input_tokens + output_tokens
+            }
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_model_profile(spec):
+    """'gpt-4o-mini=0.3:0.1' -> ('gpt-4o-mini', (0.3, 0.1)): latency factor, share of incomplete results"""
+    model, _, profile = spec.partition('=')
+    factor, _, failure_rate = profile.partition(':')
+    return model, (float(factor or 1.0), float(failure_rate or 0.0))
+
+
+def serve(port=8765, latency=2.0, rpm=0, latency_per_1k_tokens=0.0, max_concurrent=0, throttle_rate=0.0,
+          model_profiles=None):
+    """Run the mock until interrupted (AZURE_OPENAI_BASE_URL=http://127.0.0.1:<port>/openai/v1/)"""
+    MockResponsesHandler.latency = latency
+    MockResponsesHandler.latency_per_1k_tokens = latency_per_1k_tokens
+    MockResponsesHandler.rpm = rpm
+    MockResponsesHandler.max_concurrent = max_concurrent
+    MockResponsesHandler.throttle_rate = throttle_rate
+    MockResponsesHandler.model_profiles = dict(model_profiles or {})
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockResponsesHandler)
+    print(f"🧪 Mock Azure OpenAI Responses API on http://127.0.0.1:{port}/openai/v1/")
+    print(f"   ⏱️  Latency {latency}s per request + {latency_per_1k_tokens}s per 1K input tokens, "
+          f"RPM limit {rpm or 'none'}")
+    print(f"   🚦 Throttles above {max_concurrent or 'unlimited'} concurrent requests "
+          f"and {throttle_rate:.0%} of requests at random")
+    for model, (factor, failure_rate) in MockResponsesHandler.model_profiles.items():
+        print(f"   🧠 {model}: latency x{factor}, {failure_rate:.0%} of results miss their invoices")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"🧪 {MockResponsesHandler.stats['requests']} requests, {MockResponsesHandler.stats['throttled']} throttled, "
+              f"peak {MockResponsesHandler.stats['peak_concurrent']} concurrent, "
+              f"{MockResponsesHandler.stats['incomplete']} incomplete results, by model {MockResponsesHandler.stats['models']}")
+
+
+if __name__ == "__main__":
+    # Usage: python mock_openai_server.py [port] [latency_seconds] [rpm] [seconds_per_1k_input_tokens]
+    #                                     [max_concurrent] [throttle_rate]
+    #                                     [--model <name>=<latency_factor>[:<incomplete_rate>] ...]
+    args, profiles = [], {}
+    argv = sys.argv[1:]
+    while argv:
+        arg = argv.pop(0)
+        if arg == '--model' and argv:
+            model, profile = parse_model_profile(argv.pop(0))
+            profiles[model] = profile
+        else:
+            args.append(arg)
+    serve(int(args[0]) if len(args) > 0 else 8765,
+          float(args[1]) if len(args) > 1 else 2.0,
+          int(args[2]) if len(args) > 2 else 0,
+          float(args[3]) if len(args) > 3 else 0.0,
+          int(args[4]) if len(args) > 4 else 0,
+          float(args[5]) if len(args) > 5 else 0.0,
+          profiles)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Warsoft invoice API
+Serves POST .../UnPaidinvoicedata with a fixed number of pages of
+generated unpaid invoices (then empty pages) after a fixed latency, and
+accepts POST .../Push. Lets WarsoftClient paging be exercised and
+benchmarked without the real API
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def mock_invoice(page_no, index):
+    """Deterministic unpaid invoice number `index` of page `page_no`"""
+    total = 1000 + (page_no * 37 + index * 11) % 90000
+    return {
+        'invoicedate': f"2024-{1 + page_no % 12:02d}-{1 + index % 28:02d}",
+        'invoiceNumber': f"{page_no % 99}EXT2425/{index + 1}",
+        'invoiceStatus': 'overdue',
+        'cusotmerName': f"Mock Customer {index % 50} Pvt Ltd.",
+        'subTotal': round(total / 1.12, 2),
+        'cgst': round(total * 0.06 / 1.12, 2),
+        'sgst': round(total * 0.06 / 1.12, 2),
+        'igst': 0,
+        'total': total,
+        'balance': total
+    }
+
+
+class MockWarsoftHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API, so clients can reuse connections
+    protocol_version = 'HTTP/1.1'
+    pages = 100
+    per_page = 250
+    latency = 0.5
+    stats = {'connections': 0, 'requests': 0, 'pushes': 0, 'peak_concurrent': 0}
+    in_flight = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        # One handler per TCP connection
+        super().setup()
+        with self.lock:
+            MockWarsoftHandler.stats['connections'] += 1
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        path = self.path.rstrip('/').lower()
+        with self.lock:
+            MockWarsoftHandler.stats['requests'] += 1
+            MockWarsoftHandler.in_flight += 1
+            MockWarsoftHandler.stats['peak_concurrent'] = max(self.stats['peak_concurrent'], self.in_flight)
+        try:
+            time.sleep(self.latency)
+            if path.endswith('/unpaidinvoicedata'):
+                page_no = int(request.get('pageNo', 1))
+                invoices = [mock_invoice(page_no, index) for index in range(self.per_page)] \
+                    if 1 <= page_no <= self.pages else []
+                self._send_json(200, {'unpaidInvoices': invoices})
+            elif path.endswith('/push'):
+                with self.lock:
+                    MockWarsoftHandler.stats['pushes'] += 1
+                self._send_json(200, {'status': 'success'})
+            else:
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+        finally:
+            with self.lock:
+                MockWarsoftHandler.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8766, pages=100, per_page=250, latency=0.5):
+    """Run the stand-in until interrupted
+    (WARSOFT_READ_URL=http://127.0.0.1:<port>/api/ClientInvoice/UnPaidinvoicedata)"""
+    MockWarsoftHandler.pages = pages
+    MockWarsoftHandler.per_page = per_page
+    MockWarsoftHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockWarsoftHandler)
+    print(f"🧪 Mock Warsoft API on http://127.0.0.1:{port}/api/ClientInvoice/UnPaidinvoicedata")
+    print(f"   📄 {pages} pages x {per_page} invoices, {latency}s per request")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"🧪 {MockWarsoftHandler.stats['requests']} requests ({MockWarsoftHandler.stats['pushes']} pushes) "
+              f"over {MockWarsoftHandler.stats['connections']} connections, "
+              f"peak {MockWarsoftHandler.stats['peak_concurrent']} concurrent")
+
+
+if __name__ == "__main__":
+    # Usage: python mock_warsoft_server.py [port] [pages] [invoices_per_page] [latency_seconds]
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8766,
+          int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+          int(sys.argv[3]) if len(sys.argv) > 3 else 250,
+          float(sys.argv[4]) if len(sys.argv) > 4 else 0.5)
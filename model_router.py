@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Per-document model routing for Azure OpenAI extraction
+Picks a deployment for each PDF from cheap features - pages sent, whether
+it has a text layer, how many invoice rows the text shows and how often
+the sender's advices needed escalating - so one-page, single-invoice
+advices go to a small fast model and long or scanned remittances to a
+larger one. A small-model result that fails validation is escalated to
+the large deployment.
+"""
+import os
+import re
+import sys
+import threading
+from email_classifier import sender_address
+from pdf_text_parser import INVOICE_RE
+
+SMALL = 'small'
+LARGE = 'large'
+
+# Fewer text characters than this per page means a scanned (image-only) PDF
+MIN_TEXT_CHARS_PER_PAGE = 50
+
+
+class ValidationFailed(Exception):
+    """A small-model result failed validation; the PDF should be re-sent to the large deployment"""
+
+    def __init__(self, problems):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+
+def _amount(value):
+    try:
+        return float(str(value).replace(',', '').strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def _invoice_number(value):
+    return re.sub(r'\s+', '', str(value or '')).upper()
+
+
+def document_features(prepared):
+    """Cheap routing features of a prepared PDF (see AzureOpenAIPaymentExtractor.prepare_pdf)
+
+    Returns:
+        dict: pages (sent to the model), text_layer (False for scanned PDFs),
+              invoice_numbers (distinct ones in the text layer of those pages)
+    """
+    pages = prepared.get('pages') or []
+    indices = prepared.get('page_indices') or range(len(pages))
+    sent = [pages[index] for index in indices if index < len(pages)]
+    chars = sum(len(page.strip()) for page in sent)
+    numbers = {f"{match.group(1)}/{match.group(2)}".upper()
+               for page in sent for match in INVOICE_RE.finditer(page)}
+    page_count = prepared.get('pages_sent') or prepared.get('page_count') or len(sent)
+    return {
+        'pages': page_count,
+        'text_layer': bool(sent) and chars >= MIN_TEXT_CHARS_PER_PAGE * len(sent),
+        'invoice_numbers': sorted(numbers)
+    }
+
+
+def validate_result(result, features=None):
+    """Problems found in an extraction result ([] if it looks complete and consistent)
+
+    Checks that every invoice has a well-formed number and a net amount,
+    that bill - TDS = net where all three are given, that the invoices add
+    up to the stated total, and that no invoice number shown in the text
+    layer is missing.
+    """
+    invoices = (result or {}).get('invoices') or []
+    if not invoices:
+        return ['no invoices']
+
+    problems = []
+    nets = []
+    for invoice in invoices:
+        number = _invoice_number(invoice.get('invoice_number'))
+        if not INVOICE_RE.fullmatch(number):
+            problems.append(f"malformed invoice number {invoice.get('invoice_number')!r}")
+        net = _amount(invoice.get('net_payment_amount'))
+        if net is None:
+            problems.append(f"no net amount for {number or 'an invoice'}")
+            continue
+        nets.append(net)
+        bill, tds = _amount(invoice.get('bill_amount')), _amount(invoice.get('tds_amount'))
+        if bill is not None and tds is not None and abs(bill - tds - net) >= 1:
+            problems.append(f"{number}: bill {bill} - TDS {tds} != net {net}")
+
+    total = _amount(((result or {}).get('common_details') or {}).get('total_payment_amount'))
+    if total is not None and nets and abs(sum(nets) - total) >= 1:
+        problems.append(f"invoices add up to {sum(nets):.2f}, total is {total:.2f}")
+
+    if features and features.get('invoice_numbers'):
+        found = {_invoice_number(invoice.get('invoice_number')) for invoice in invoices}
+        missing = [number for number in features['invoice_numbers'] if number not in found]
+        if missing:
+            problems.append(f"missed {len(missing)} invoice(s) shown in the text layer ({', '.join(missing[:3])})")
+    return problems
+
+
+class ModelRouter:
+    """Chooses the small or large deployment per PDF and escalates failed small-model results
+
+    Routing is active only when AZURE_OPENAI_SMALL_DEPLOYMENT and
+    AZURE_OPENAI_LARGE_DEPLOYMENT name different deployments (both default
+    to AZURE_OPENAI_DEPLOYMENT_NAME). Per-sender escalation counts are kept
+    in memory and written to model_route_stats by flush(). Thread-safe for
+    the async pipeline.
+    """
+
+    def __init__(self, default_deployment, db=None):
+        self.db = db
+        self.deployments = {SMALL: os.getenv('AZURE_OPENAI_SMALL_DEPLOYMENT') or default_deployment,
+                            LARGE: os.getenv('AZURE_OPENAI_LARGE_DEPLOYMENT') or default_deployment}
+        self.enabled = os.getenv('MODEL_ROUTING', 'true').lower() == 'true' and \
+            self.deployments[SMALL] != self.deployments[LARGE]
+        self.small_max_pages = int(os.getenv('MODEL_ROUTER_SMALL_MAX_PAGES', 2))
+        self.small_max_invoices = int(os.getenv('MODEL_ROUTER_SMALL_MAX_INVOICES', 5))
+        self.max_escalation_rate = float(os.getenv('MODEL_ROUTER_MAX_ESCALATION_RATE', 0.3))
+        self.min_history = int(os.getenv('MODEL_ROUTER_MIN_HISTORY', 3))
+        # Benchmarks pin every PDF to one tier (SMALL or LARGE)
+        self.forced = None
+        self.history = {}
+        self.stats = {SMALL: 0, LARGE: 0, 'escalated': 0}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """(Re)load per-sender small-model outcomes from the database"""
+        if self.db is None:
+            return 0
+        history = {row['sender']: {'small': row['small_requests'] or 0, 'escalated': row['escalations'] or 0}
+                   for row in self.db.get_model_route_stats()}
+        with self._lock:
+            self.history = history
+        return len(history)
+
+    def escalation_rate(self, sender):
+        """Share of the sender's small-model extractions that were escalated (None without enough history)"""
+        score = self.history.get(sender_address(sender)) if sender else None
+        if not score or score['small'] < self.min_history:
+            return None
+        return score['escalated'] / score['small']
+
+    def choose(self, features, sender=None):
+        """(tier, reason) for a PDF with these features"""
+        if self.forced:
+            return self.forced, 'forced'
+        if not features['text_layer']:
+            return LARGE, 'no text layer (scanned)'
+        if features['pages'] > self.small_max_pages:
+            return LARGE, f"{features['pages']} pages"
+        if len(features['invoice_numbers']) > self.small_max_invoices:
+            return LARGE, f"{len(features['invoice_numbers'])} invoice rows"
+        rate = self.escalation_rate(sender)
+        if rate is not None and rate > self.max_escalation_rate:
+            return LARGE, f"{rate:.0%} of this sender's advices needed escalating"
+        return SMALL, (f"{features['pages']} page(s), text layer, "
+                       f"{len(features['invoice_numbers'])} invoice row(s)")
+
+    def route(self, prepared):
+        """Set prepared['deployment'] (and each chunk's) for a PDF that needs the model"""
+        if not self.enabled:
+            self._assign(prepared, LARGE)
+            return
+        features = document_features(prepared)
+        tier, reason = self.choose(features, prepared.get('sender'))
+        prepared['features'] = features
+        self._assign(prepared, tier)
+        with self._lock:
+            self.stats[tier] += 1
+        print(f"   🧭 Routing to {tier} model ({self.deployments[tier]}): {reason}")
+
+    def _assign(self, prepared, tier):
+        prepared['tier'] = tier
+        prepared['deployment'] = self.deployments[tier]
+        for chunk in prepared.get('chunks') or []:
+            chunk['deployment'] = prepared['deployment']
+
+    def check(self, result, prepared):
+        """Validate a small-model result
+
+        Raises:
+            ValidationFailed: The result should be escalated to the large deployment
+        """
+        if not self.enabled or prepared.get('tier') != SMALL:
+            return
+        problems = validate_result(result, prepared.get('features'))
+        if problems:
+            raise ValidationFailed(problems)
+
+    def escalate(self, prepared, error):
+        """Switch a prepared PDF to the large deployment after a failed small-model result"""
+        with self._lock:
+            self.stats['escalated'] += 1
+        prepared['escalated'] = True
+        self._assign(prepared, LARGE)
+        print(f"   ⤴️  Small model result rejected ({error}); escalating to {prepared['deployment']}")
+
+    def record(self, prepared):
+        """Count a finished small-model extraction (escalated or not) for the PDF's sender"""
+        sender = sender_address(prepared.get('sender'))
+        if not self.enabled or not sender or not (prepared.get('tier') == SMALL or prepared.get('escalated')):
+            return
+        escalated = 1 if prepared.get('escalated') else 0
+        with self._lock:
+            for counts in (self.history, self._pending):
+                score = counts.setdefault(sender, {'small': 0, 'escalated': 0})
+                score['small'] += 1
+                score['escalated'] += escalated
+
+    def flush(self):
+        """Persist sender outcomes recorded since the last flush"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if self.db is not None and pending:
+            self.db.update_model_route_stats(pending)
+        return len(pending)
+
+    def summary(self):
+        if not self.enabled:
+            return f"off (all PDFs to {self.deployments[LARGE]})"
+        return (f"{self.stats[SMALL]} PDFs to {self.deployments[SMALL]}, {self.stats[LARGE]} to "
+                f"{self.deployments[LARGE]}, {self.stats['escalated']} escalated")
+
+
+def benchmark(pdf_paths):
+    """Extract each PDF with routing and with the large deployment only; compare time, cost and results
+
+    Run it against mock_openai_server.py with per-model profiles, e.g.
+    --model gpt-4o-mini=0.3:0.1 --model gpt-4o=1.0
+    """
+    import time
+    from openai_extractor import AzureOpenAIPaymentExtractor
+
+    pdfs = []
+    for path in pdf_paths:
+        with open(path, 'rb') as f:
+            pdfs.append(f.read())
+
+    # No database (no cache) and no local parsing or templates: every PDF reaches the model
+    extractor = AzureOpenAIPaymentExtractor()
+    extractor.local_parser_enabled = False
+    extractor.layout_templates.enabled = False
+    router = extractor.router
+    if not router.enabled:
+        print("⚠️  Routing is off: set AZURE_OPENAI_SMALL_DEPLOYMENT and AZURE_OPENAI_LARGE_DEPLOYMENT")
+
+    runs = {}
+    for label, forced in (('routed', None), ('large only', LARGE)):
+        router.forced = forced
+        before_cost, before_stats = extractor.total_cost, dict(router.stats)
+        started = time.perf_counter()
+        results = [extractor.extract_from_pdf(pdf_data) for pdf_data in pdfs]
+        runs[label] = {
+            'seconds': time.perf_counter() - started,
+            'cost': extractor.total_cost - before_cost,
+            'small': router.stats[SMALL] - before_stats[SMALL],
+            'escalated': router.stats['escalated'] - before_stats['escalated'],
+            'invoices': [sorted(_invoice_number(inv.get('invoice_number')) for inv in (result or {}).get('invoices') or [])
+                         for result in results]
+        }
+    router.forced = None
+
+    print(f"\n{'=' * 60}")
+    print(f"MODEL ROUTING BENCHMARK: {len(pdfs)} PDFs")
+    print(f"{'=' * 60}")
+    for label, run in runs.items():
+        print(f"   {label:<11} {run['seconds']:8.2f}s  ${run['cost']:.4f}  "
+              f"{run['small']} to the small model, {run['escalated']} escalated")
+    same = sum(a == b for a, b in zip(runs['routed']['invoices'], runs['large only']['invoices']))
+    print(f"   {'✅' if same == len(pdfs) else '⚠️ '} Invoices match on {same} of {len(pdfs)} PDFs")
+
+
+if __name__ == "__main__":
+    # Usage: python model_router.py <pdf> [<pdf> ...] [--benchmark]
+    # Without --benchmark only the routing decision is shown (no API calls)
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not paths:
+        print("Usage: python model_router.py <pdf> [<pdf> ...] [--benchmark]")
+        sys.exit(1)
+    if '--benchmark' in sys.argv:
+        benchmark(paths)
+        sys.exit(0)
+
+    from pdf_document import open_pdf
+    from pdf_text_parser import relevant_pages
+    router = ModelRouter(os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME', 'gpt-4o-mini'))
+    passwords = [os.getenv('PDF_PASSWORD_1', '253538'), os.getenv('PDF_PASSWORD_2', '502000')]
+    for path in paths:
+        with open(path, 'rb') as f:
+            document = open_pdf(f.read(), passwords)
+        if document is None:
+            print(f"❌ {path}: encrypted, no configured password opens it")
+            continue
+        # Routing sees the pages left after page pruning, as in prepare_pdf
+        keep = relevant_pages(document.text()) or list(range(document.page_count or 0))
+        prepared = {'pages': document.text(), 'page_count': document.page_count,
+                    'page_indices': keep, 'pages_sent': len(keep)}
+        features = document_features(prepared)
+        tier, reason = router.choose(features)
+        print(f"🧭 {path}: {tier} ({router.deployments[tier]}) - {reason}; features {features}")
@@ -6,17 +6,128 @@ Uses Responses API as per Microsoft Learn documentation
 """
 import os
 import base64
+import hashlib
 import json
-import io
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from dotenv import load_dotenv
-import PyPDF2
+from email_classifier import sender_address
+from extraction_telemetry import DEFERRED, FAILED, LLM, SUCCESS, UNDECRYPTABLE, ExtractionTelemetry
+from layout_templates import LayoutTemplateStore
+from model_router import LARGE, SMALL, ModelRouter, ValidationFailed
+from pdf_document import PasswordHints, mask_password, open_pdf
+from pdf_text_parser import parse_advice_text, relevant_pages
+from resilient_client import RetriesExhausted, RetryPolicy
 
 load_dotenv()
 
+# Detailed extraction prompt
+EXTRACTION_PROMPT = """You are a financial document processing AI. Extract ALL payment details from this payment advice PDF.
+
+IMPORTANT: This PDF may contain MULTIPLE invoices across MULTIPLE PAGES. Extract EACH invoice as a separate entry.
+
+Return ONLY a valid JSON object with this structure:
+
+{
+  "invoices": [
+    {
+      "invoice_number": "invoice number (formats: ##EXT####/####, ##HB####/####, ##HBT####/####)",
+      "net_payment_amount": "final amount paid after TDS for THIS invoice (number only)",
+      "bill_amount": "gross amount before TDS for THIS invoice (number only)",
+      "tds_amount": "TDS deducted for THIS invoice (number only)",
+      "invoice_date": "YYYY-MM-DD format"
+    }
+  ],
+  "common_details": {
+    "transaction_date": "YYYY-MM-DD (date at top of document - payment date)",
+    "payment_date": "YYYY-MM-DD format",
+    "bank_name": "name of the bank",
+    "bank_reference_number": "UTR/reference/transaction ID (alphanumeric, 10-25 chars)",
+    "customer_name": "remitter/customer/payer name",
+    "utr_number": "UTR number if different from bank_reference_number",
+    "total_payment_amount": "total of all invoices combined (if shown)"
+  }
+}
+
+CRITICAL EXTRACTION RULES:
+
+1. MULTIPLE INVOICES ACROSS PAGES: 
+   - SCAN ALL PAGES of the PDF - invoices may be on page 1, 2, 3, etc.
+   - If the PDF has tables spanning multiple pages, extract EACH row as a separate invoice
+   - Each invoice should have its OWN: invoice_number, net_payment_amount, bill_amount, tds_amount, invoice_date
+   - Look for table structures with columns like: Invoice No, Date, Bill Amt, TDS, Amount, etc.
+   - DO NOT STOP after the first page - continue extracting from ALL pages
+
+2. Invoice numbers: Look for formats like "23EXT1126/1572", "11HB234/5678", "15HBT567/8901"
+   - If invoice split across lines (e.g., "23EXT1126/\\n1572"), combine them as "23EXT1126/1572"
+   - Common prefixes: EXT, HB, HBT
+   - Invoice numbers may appear on ANY page of the PDF
+
+3. Amounts (extract as numbers only, no currency symbols, no commas):
+   - net_payment_amount: Final payment after TDS (often labeled "Amount", "Net Paid", "Current Net Paid")
+   - bill_amount: Gross amount before TDS (often labeled "Bill Amt", "Invoice Amount", "Amt")
+   - tds_amount: TDS deducted (labeled "TDS")
+   - Example: "8,644.00" should be "8644.00"
+
+4. Dates (convert all to YYYY-MM-DD):
+   - transaction_date: Payment/advice date at the TOP of the document (page 1)
+   - invoice_date: Date specific to each invoice (usually in the table row)
+
+5. Bank reference: Look for long alphanumeric codes like:
+   - CITIN25657707761, HSBCN52025112997504684, SBIN525331564590
+   - Or labeled as "UTR", "Reference Number", "Transaction ID"
+
+6. Customer name: Look for "Remitter Name", "From", "Sender", "Payer", "Customer Name"
+
+Be thorough - extract EVERY invoice from EVERY page in the document as a separate entry in the invoices array."""
+
+def _row_key(invoice):
+    """Identity of an invoice row for de-duplicating chunk results"""
+    def amount(value):
+        try:
+            return round(float(str(value).replace(',', '')), 2)
+        except (TypeError, ValueError):
+            return None
+    return (re.sub(r'\s+', '', str(invoice.get('invoice_number') or '')).upper(),
+            amount(invoice.get('net_payment_amount')), amount(invoice.get('bill_amount')),
+            amount(invoice.get('tds_amount')))
+
+
+def merge_chunk_results(results):
+    """Merge the results of a PDF extracted in page chunks
+
+    Invoice rows are kept in page order without duplicates (a row near a
+    chunk boundary can be returned twice). common_details come from the
+    first chunk (page 1); fields it lacks are filled from later chunks.
+
+    Returns:
+        tuple: (merged result, number of duplicate rows removed)
+    """
+    invoices, seen, duplicates = [], set(), 0
+    common = {}
+    for result in results:
+        for invoice in result.get('invoices') or []:
+            key = _row_key(invoice)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            invoices.append(invoice)
+        for field, value in (result.get('common_details') or {}).items():
+            if common.get(field) in (None, '') and value not in (None, ''):
+                common[field] = value
+    return {'invoices': invoices, 'common_details': common}, duplicates
+
+
+# Cached extraction results are only reused for the exact same prompt
+EXTRACTION_PROMPT_VERSION = hashlib.sha256(EXTRACTION_PROMPT.encode('utf-8')).hexdigest()[:16]
+
 
 class AzureOpenAIPaymentExtractor:
-    def __init__(self):
+    def __init__(self, db=None):
         api_key = os.getenv('AZURE_OPENAI_API_KEY')
         base_url = os.getenv('AZURE_OPENAI_BASE_URL')
 
@@ -26,234 +137,442 @@ class AzureOpenAIPaymentExtractor:
             raise ValueError(
                 "AZURE_OPENAI_BASE_URL not found in .env file (format: https://YOUR-RESOURCE-NAME.openai.azure.com/openai/v1/)")
 
+        # Retries are done by RetryPolicy, which tells throttling from permanent errors
         self.client = OpenAI(
             base_url=base_url,
-            api_key=api_key
+            api_key=api_key,
+            max_retries=0
         )
+        self.retry_policy = RetryPolicy()
+        # Per-PDF latency/tokens/cost/outcome rows (extraction_telemetry table; needs a database)
+        self.telemetry = ExtractionTelemetry(db)
         # This should be your deployment name, not the model name
         self.deployment_name = os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME', 'gpt-4o-mini')
         self.total_cost = 0.0
+        # parse_responses runs on several threads at once in the async pipeline
+        self._stats_lock = threading.Lock()
 
         # GPT-4o mini pricing (per 1M tokens)
         self.input_cost_per_1m = 0.150
         self.output_cost_per_1m = 0.600
 
+        # Small or large deployment per PDF, with escalation of rejected small-model results
+        self.router = ModelRouter(self.deployment_name, db)
+        self.prices = {self.router.deployments[SMALL]: (self.input_cost_per_1m, self.output_cost_per_1m)}
+        if self.router.enabled:
+            self.prices[self.router.deployments[LARGE]] = (
+                float(os.getenv('AZURE_OPENAI_LARGE_INPUT_COST_PER_1M', 2.50)),
+                float(os.getenv('AZURE_OPENAI_LARGE_OUTPUT_COST_PER_1M', 10.00)))
+
         # PDF passwords from .env
         self.pdf_passwords = [
             os.getenv('PDF_PASSWORD_1', '253538'),
             os.getenv('PDF_PASSWORD_2', '502000')
         ]
+        self.password_hints = PasswordHints(db)
+
+        # Optional ReconciliationDB backing the content-hash extraction cache
+        self.db = db
+        self.cache_enabled = db is not None and os.getenv('EXTRACTION_CACHE', 'true').lower() == 'true'
+        self.cache_hits = 0
+        self.saved_cost = 0.0
+
+        # Deterministic text-layer parser; the model is only called below this confidence
+        self.local_parser_enabled = os.getenv('LOCAL_PDF_PARSER', 'true').lower() == 'true'
+        self.local_min_confidence = float(os.getenv('LOCAL_PARSER_MIN_CONFIDENCE', 0.8))
+        self.local_hits = 0
+
+        # Layouts learned per sender from successful extractions (layout_templates.py)
+        self.layout_templates = LayoutTemplateStore(db)
+        self.template_hits = 0
+
+        # Send only the pages with invoices/references; counters measure the effect on input tokens
+        self.page_pruning_enabled = os.getenv('PDF_PAGE_PRUNING', 'true').lower() == 'true'
+        self.pruning_stats = {'requests': 0, 'pages_total': 0, 'pages_sent': 0, 'input_tokens': 0}
+
+        # Long PDFs are split into page groups extracted concurrently (0 = never split)
+        self.chunk_pages = int(os.getenv('EXTRACTION_CHUNK_PAGES', 10))
+        self.chunk_workers = int(os.getenv('EXTRACTION_CHUNK_WORKERS', 4))
 
         print(f"✅ Azure OpenAI Payment Extractor initialized (Responses API)")
         print(f"   🌐 Base URL: {base_url}")
         print(f"   📦 Deployment: {self.deployment_name}")
+        if self.router.enabled:
+            print(f"   🧭 Model routing: {self.router.deployments[SMALL]} / {self.router.deployments[LARGE]}")
+
+    def open_document(self, pdf_data, sender=None):
+        """Parse a PDF once, decrypting it if needed (pdf_document.open_pdf)
+
+        The password that opened this sender's last PDF is tried first.
+
+        Returns:
+            PdfDocument | None: None if the PDF could not be decrypted
+        """
+        document = open_pdf(pdf_data, self.pdf_passwords, self.password_hints.first(sender))
+        self.note_document(document, sender)
+        return document
+
+    def note_document(self, document, sender=None):
+        """Log how a PDF was opened and remember the password that worked for its sender"""
+        if document is None:
+            print(f"   🔒 PDF is password-protected")
+            print(f"   ❌ Could not decrypt PDF with provided passwords")
+        elif document.error:
+            print(f"   ⚠️  Error checking PDF encryption: {document.error}")
+        elif document.encrypted:
+            password = ([''] + self.pdf_passwords)[document.password_index]
+            print(f"   🔒 PDF is password-protected, decrypted with password: {mask_password(password)}")
+            self.password_hints.record(sender, document.password_index)
+        else:
+            print(f"   ℹ️  PDF is not encrypted")
 
-    def decrypt_pdf(self, pdf_data):
+    def decrypt_pdf(self, pdf_data, sender=None):
         """Decrypt password-protected PDF
 
         Args:
             pdf_data: Binary PDF data (encrypted)
+            sender: From header of the email, used to try its last password first
 
         Returns:
             bytes: Decrypted PDF data or original if not encrypted
         """
-        try:
-            # Try to read the PDF
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_data))
-
-            # Check if encrypted
-            if pdf_reader.is_encrypted:
-                print(f"   🔒 PDF is password-protected, attempting to decrypt...")
-
-                # Try empty password first, then configured passwords
-                candidate_passwords = [''] + self.pdf_passwords
-
-                for password in candidate_passwords:
-                    try:
-                        if pdf_reader.decrypt(password):
-                            masked = password[:3] + '***' if password else '<empty>'
-                            print(f"   ✅ PDF decrypted successfully with password: {masked}")
+        document = self.open_document(pdf_data, sender)
+        return document.data if document is not None else None
 
-                            # Create a new PDF writer and copy decrypted content
-                            pdf_writer = PyPDF2.PdfWriter()
-                            for page in pdf_reader.pages:
-                                pdf_writer.add_page(page)
+    def prepare_pdf(self, pdf_data, sender=None, document=None):
+        """Decrypt a PDF, then try the extraction cache, the sender's layout
+        template and the local text parser
 
-                            # Write to bytes
-                            decrypted_bytes = io.BytesIO()
-                            pdf_writer.write(decrypted_bytes)
-                            decrypted_bytes.seek(0)
-
-                            return decrypted_bytes.read()
-                    except Exception:
-                        continue
-
-                print(f"   ❌ Could not decrypt PDF with provided passwords")
-                return None
-            else:
-                print(f"   ℹ️  PDF is not encrypted")
-                return pdf_data
-
-        except Exception as e:
-            print(f"   ⚠️  Error checking PDF encryption: {e}")
-            # Return original data if we can't check encryption
-            return pdf_data
-
-    def extract_from_pdf(self, pdf_data):
-        """Extract payment advice data using Azure OpenAI Responses API
+        Shared by the synchronous and async extraction paths.
 
         Args:
             pdf_data: Binary PDF data (may be encrypted)
+            sender: From header of the email, used to pick a layout template
+            document: PdfDocument already opened from pdf_data (e.g. in a worker process)
 
         Returns:
-            dict: Extracted payment advice data or None if extraction fails
+            dict: {'pdf', 'sha256', 'page_count', 'page_indices', 'pages_sent',
+                  'pages', 'sender', 'chunks', 'estimated_tokens', 'deployment',
+                  'result', 'source'} - 'result' is set when no API call is
+                  needed ('source' is then 'cache', 'template' or 'local');
+                  'chunks' lists the page groups ({'pdf', 'pages',
+                  'estimated_tokens', 'deployment'}) of a split PDF;
+                  'deployment' is the routed model. None if the PDF could
+                  not be decrypted
         """
+        # Parse and decrypt once; the same document serves the text layer, pruning and chunking
+        if document is None:
+            document = self.open_document(pdf_data, sender)
+        else:
+            self.note_document(document, sender)
+        if document is None:
+            print(f"   ❌ Failed to decrypt PDF")
+            return None
+
+        prepared = {'pdf': document.data, 'sha256': hashlib.sha256(document.data).hexdigest(),
+                    'page_count': document.page_count, 'page_indices': None, 'pages_sent': None, 'pages': None,
+                    'sender': sender, 'chunks': None, 'estimated_tokens': None, 'deployment': None,
+                    'result': None, 'source': None}
+
+        # Same PDF + same prompt/deployment: reuse the stored result, no API call
+        cached = self.get_cached_result(prepared['sha256'])
+        if cached is not None:
+            prepared.update(result=cached, source='cache')
+            return prepared
+
+        readable = document.page_count is not None
+        if readable:
+            print(f"   📑 PDF page count after decrypt: {prepared['page_count']}")
+            prepared['pages'] = document.text()
+
+        if prepared['pages'] and sender:
+            template_result = self.layout_templates.match(sender, prepared['pages'])
+            if template_result is not None:
+                self.template_hits += 1
+                print(f"   🧩 Extracted with the sender's layout template - "
+                      f"{len(template_result['invoices'])} invoice(s), no OpenAI call")
+                prepared.update(result=template_result, source='template')
+                return prepared
+
+        if prepared['pages'] and self.local_parser_enabled:
+            local_result = self.parse_locally(prepared['pages'])
+            if local_result is not None:
+                prepared.update(result=local_result, source='local')
+                return prepared
+
+        prepared['pages_sent'] = prepared['page_count']
+        prepared['page_indices'] = list(range(prepared['page_count'] or 0))
+        if readable and prepared['pages'] and self.page_pruning_enabled:
+            self.prune_pages(prepared, document)
+
+        if readable and self.chunk_pages and prepared['pages_sent'] and \
+                prepared['pages_sent'] > self.chunk_pages:
+            self.split_chunks(prepared, document)
+
+        if prepared['chunks']:
+            prepared['estimated_tokens'] = sum(chunk['estimated_tokens'] for chunk in prepared['chunks'])
+        else:
+            prepared['estimated_tokens'] = self.estimate_tokens(prepared['pages_sent'])
+        self.router.route(prepared)
+        return prepared
+
+    def prune_pages(self, prepared, document):
+        """Replace prepared['pdf'] with a PDF of only the relevant pages (see relevant_pages)"""
+        keep = relevant_pages(prepared['pages'])
+        if keep is None:
+            return
         try:
-            print(f"   🤖 Starting Azure OpenAI extraction (Responses API)...")
+            pruned = document.subset(keep)
+        except Exception as e:
+            print(f"   ⚠️  Page pruning failed, sending the full PDF: {e}")
+            return
+
+        dropped = [str(index + 1) for index in range(len(prepared['pages'])) if index not in keep]
+        print(f"   ✂️  Page pruning: sending pages {', '.join(str(index + 1) for index in keep)} of "
+              f"{len(prepared['pages'])} (dropped {', '.join(dropped)}; "
+              f"{len(prepared['pdf'])} -> {len(pruned)} bytes)")
+        prepared['pdf'] = pruned
+        prepared['pages_sent'] = len(keep)
+        prepared['page_indices'] = keep
+
+    def split_chunks(self, prepared, document):
+        """Split the pages to send into groups of at most `chunk_pages` (prepared['chunks'])"""
+        indices = prepared['page_indices']
+        chunks = []
+        try:
+            for start in range(0, len(indices), self.chunk_pages):
+                group = indices[start:start + self.chunk_pages]
+                chunks.append({'pdf': document.subset(group), 'pages': [index + 1 for index in group],
+                               'estimated_tokens': self.estimate_tokens(len(group))})
+        except Exception as e:
+            print(f"   ⚠️  Could not split PDF into chunks, sending it whole: {e}")
+            return
 
-            # Decrypt PDF if needed
-            decrypted_pdf = self.decrypt_pdf(pdf_data)
-            if decrypted_pdf is None:
-                print(f"   ❌ Failed to decrypt PDF")
-                return None
+        prepared['chunks'] = chunks
+        print(f"   📚 Splitting {len(indices)} pages into {len(chunks)} chunks of up to {self.chunk_pages} pages")
 
-            try:
-                page_count = len(PyPDF2.PdfReader(io.BytesIO(decrypted_pdf)).pages)
-                print(f"   📑 PDF page count after decrypt: {page_count}")
-            except Exception as e:
-                print(f"   ⚠️  Could not read PDF page count: {e}")
+    def parse_locally(self, pages):
+        """Parse the PDF's text layer; the result if it is confident enough, else None"""
+        try:
+            result, confidence = parse_advice_text('\n'.join(pages))
+        except Exception as e:
+            print(f"   ⚠️  Local text parser failed: {e}")
+            return None
 
-            # Convert PDF to base64
-            pdf_base64 = base64.standard_b64encode(decrypted_pdf).decode('utf-8')
+        if confidence < self.local_min_confidence:
+            print(f"   🔎 Local text parser confidence {confidence:.2f} < {self.local_min_confidence:.2f}; using OpenAI")
+            return None
 
-            # Detailed extraction prompt
-            prompt = """You are a financial document processing AI. Extract ALL payment details from this payment advice PDF.
+        self.local_hits += 1
+        print(f"   ⚡ Parsed text layer locally (confidence {confidence:.2f}) - "
+              f"{len(result['invoices'])} invoice(s), no OpenAI call")
+        return result
 
-IMPORTANT: This PDF may contain MULTIPLE invoices across MULTIPLE PAGES. Extract EACH invoice as a separate entry.
+    @staticmethod
+    def estimate_tokens(page_count):
+        """Rough input + output token estimate for one request (used for TPM budgeting)"""
+        tokens_per_page = int(os.getenv('AZURE_OPENAI_TOKENS_PER_PAGE', 1500))
+        return len(EXTRACTION_PROMPT) // 4 + (page_count or 1) * tokens_per_page + 1000
 
-Return ONLY a valid JSON object with this structure:
+    def build_request(self, prepared):
+        """Keyword arguments for responses.create() for a prepared PDF (or one of its chunks)
 
-{
-  "invoices": [
-    {
-      "invoice_number": "invoice number (formats: ##EXT####/####, ##HB####/####, ##HBT####/####)",
-      "net_payment_amount": "final amount paid after TDS for THIS invoice (number only)",
-      "bill_amount": "gross amount before TDS for THIS invoice (number only)",
-      "tds_amount": "TDS deducted for THIS invoice (number only)",
-      "invoice_date": "YYYY-MM-DD format"
-    }
-  ],
-  "common_details": {
-    "transaction_date": "YYYY-MM-DD (date at top of document - payment date)",
-    "payment_date": "YYYY-MM-DD format",
-    "bank_name": "name of the bank",
-    "bank_reference_number": "UTR/reference/transaction ID (alphanumeric, 10-25 chars)",
-    "customer_name": "remitter/customer/payer name",
-    "utr_number": "UTR number if different from bank_reference_number",
-    "total_payment_amount": "total of all invoices combined (if shown)"
-  }
-}
+        The request goes to the deployment the router picked (prepared['deployment']).
+        """
+        # Convert PDF to base64
+        pdf_base64 = base64.standard_b64encode(prepared['pdf']).decode('utf-8')
+
+        # Azure OpenAI Responses API (exact format from Microsoft Learn docs)
+        return {
+            'model': prepared.get('deployment') or self.deployment_name,  # This is your deployment name
+            'input': [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "input_file",
+                            "filename": "payment_advice.pdf",
+                            "file_data": f"data:application/pdf;base64,{pdf_base64}",
+                        },
+                        {
+                            "type": "input_text",
+                            "text": EXTRACTION_PROMPT,
+                        },
+                    ],
+                },
+            ]
+        }
+
+    def parse_response(self, response, prepared):
+        """Parse a Responses API result, account its cost and store it in the cache
 
-CRITICAL EXTRACTION RULES:
+        Returns:
+            dict: Extracted payment advice data
 
-1. MULTIPLE INVOICES ACROSS PAGES: 
-   - SCAN ALL PAGES of the PDF - invoices may be on page 1, 2, 3, etc.
-   - If the PDF has tables spanning multiple pages, extract EACH row as a separate invoice
-   - Each invoice should have its OWN: invoice_number, net_payment_amount, bill_amount, tds_amount, invoice_date
-   - Look for table structures with columns like: Invoice No, Date, Bill Amt, TDS, Amount, etc.
-   - DO NOT STOP after the first page - continue extracting from ALL pages
+        Raises:
+            json.JSONDecodeError: If the model did not return valid JSON
+        """
+        return self.parse_responses([response], prepared)
+
+    @staticmethod
+    def _parse_output_text(result_text):
+        """JSON object from the model's output text"""
+        # Parse JSON from response
+        # Sometimes the response might include markdown code blocks, so clean it
+        if "```json" in result_text:
+            result_text = result_text.split("```json")[1].split("```")[0].strip()
+        elif "```" in result_text:
+            result_text = result_text.split("```")[1].split("```")[0].strip()
 
-2. Invoice numbers: Look for formats like "23EXT1126/1572", "11HB234/5678", "15HBT567/8901"
-   - If invoice split across lines (e.g., "23EXT1126/\\n1572"), combine them as "23EXT1126/1572"
-   - Common prefixes: EXT, HB, HBT
-   - Invoice numbers may appear on ANY page of the PDF
+        try:
+            return json.loads(result_text)
+        except json.JSONDecodeError:
+            print(f"   📄 Raw response: {result_text[:500]}")
+            raise
 
-3. Amounts (extract as numbers only, no currency symbols, no commas):
-   - net_payment_amount: Final payment after TDS (often labeled "Amount", "Net Paid", "Current Net Paid")
-   - bill_amount: Gross amount before TDS (often labeled "Bill Amt", "Invoice Amount", "Amt")
-   - tds_amount: TDS deducted (labeled "TDS")
-   - Example: "8,644.00" should be "8644.00"
+    def parse_responses(self, responses, prepared):
+        """Parse the Responses API results for a prepared PDF (one per chunk),
+        merge them, account their cost and store the result in the cache
 
-4. Dates (convert all to YYYY-MM-DD):
-   - transaction_date: Payment/advice date at the TOP of the document (page 1)
-   - invoice_date: Date specific to each invoice (usually in the table row)
+        Returns:
+            dict: Extracted payment advice data
 
-5. Bank reference: Look for long alphanumeric codes like:
-   - CITIN25657707761, HSBCN52025112997504684, SBIN525331564590
-   - Or labeled as "UTR", "Reference Number", "Transaction ID"
+        Raises:
+            ValidationFailed: A small-model result was rejected; escalate() and resend
+            json.JSONDecodeError: If the model did not return valid JSON
+        """
+        # Track usage and cost if available (also for a result that is then rejected)
+        input_tokens = output_tokens = None
+        total_cost = None
+        usages = [response.usage for response in responses if getattr(response, 'usage', None)]
+        if usages:
+            input_tokens = sum(usage.input_tokens for usage in usages)
+            output_tokens = sum(usage.output_tokens for usage in usages)
+            input_price, output_price = self.prices.get(prepared.get('deployment'),
+                                                        (self.input_cost_per_1m, self.output_cost_per_1m))
+            input_cost = (input_tokens / 1_000_000) * input_price
+            output_cost = (output_tokens / 1_000_000) * output_price
+            total_cost = input_cost + output_cost
+
+            with self._stats_lock:
+                self.total_cost += total_cost
 
-6. Customer name: Look for "Remitter Name", "From", "Sender", "Payer", "Customer Name"
+                if prepared['page_count'] and prepared['pages_sent']:
+                    self.pruning_stats['requests'] += 1
+                    self.pruning_stats['pages_total'] += prepared['page_count']
+                    self.pruning_stats['pages_sent'] += prepared['pages_sent']
+                    self.pruning_stats['input_tokens'] += input_tokens
 
-Be thorough - extract EVERY invoice from EVERY page in the document as a separate entry in the invoices array."""
+        # Escalated PDFs add the large-model requests to the rejected small-model ones
+        usage = prepared.get('usage') or {'requests': 0, 'input_tokens': None, 'output_tokens': None, 'cost': None}
+        for field, value in (('requests', len(responses)), ('input_tokens', input_tokens),
+                             ('output_tokens', output_tokens), ('cost', total_cost)):
+            if value is not None:
+                usage[field] = (usage[field] or 0) + value
+        prepared['usage'] = usage
 
-            # Call Azure OpenAI Responses API (exact format from Microsoft Learn docs)
-            response = self.client.responses.create(
-                model=self.deployment_name,  # This is your deployment name
-                input=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "input_file",
-                                "filename": "payment_advice.pdf",
-                                "file_data": f"data:application/pdf;base64,{pdf_base64}",
-                            },
-                            {
-                                "type": "input_text",
-                                "text": prompt,
-                            },
-                        ],
-                    },
-                ]
-            )
-
-            # Extract result from response
-            result_text = response.output_text
-
-            # Parse JSON from response
-            # Sometimes the response might include markdown code blocks, so clean it
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in result_text:
-                result_text = result_text.split("```")[1].split("```")[0].strip()
-
-            result = json.loads(result_text)
-
-            # Track usage and cost if available
-            if hasattr(response, 'usage') and response.usage:
-                usage = response.usage
-                input_cost = (usage.input_tokens / 1_000_000) * self.input_cost_per_1m
-                output_cost = (usage.output_tokens / 1_000_000) * self.output_cost_per_1m
-                total_cost = input_cost + output_cost
+        try:
+            results = [self._parse_output_text(response.output_text) for response in responses]
+        except json.JSONDecodeError as e:
+            if self.router.enabled and prepared.get('tier') == SMALL:
+                raise ValidationFailed([f"invalid JSON ({e})"]) from e
+            raise
+
+        print(f"   ✅ Azure OpenAI extraction successful!")
+        if usages:
+            print(f"   📊 Tokens: {input_tokens} input + {output_tokens} output")
+            print(f"   💵 Cost: ${total_cost:.4f} (Total session: ${self.total_cost:.4f})")
+        else:
+            print(f"   ℹ️  Usage information not available")
 
-                self.total_cost += total_cost
+        if len(results) == 1:
+            result = results[0]
+        else:
+            result, duplicates = merge_chunk_results(results)
+            print(f"   📚 Merged {len(results)} chunks: {len(result['invoices'])} invoice(s), "
+                  f"{duplicates} duplicate row(s) removed")
+        self.router.check(result, prepared)
+        self.router.record(prepared)
+
+        self.cache_result(prepared['sha256'], result, input_tokens, output_tokens, total_cost,
+                          prepared.get('deployment'))
+        if prepared['sender'] and prepared['pages']:
+            self.layout_templates.learn(prepared['sender'], prepared['pages'], result)
+
+        # Display extracted data
+        invoices = result.get('invoices', [])
+        common = result.get('common_details', {})
+
+        print(f"   📄 Found {len(invoices)} invoice(s):")
+        for i, inv in enumerate(invoices, 1):
+            print(
+                f"      Invoice {i}: {inv.get('invoice_number')} | Net: {inv.get('net_payment_amount')} | Bill: {inv.get('bill_amount')} | TDS: {inv.get('tds_amount')} | Date: {inv.get('invoice_date')}")
+
+        print(f"   📋 Common details:")
+        print(f"      - Transaction Date: {common.get('transaction_date')}")
+        print(f"      - Bank Ref: {common.get('bank_reference_number')}")
+        print(f"      - Customer: {common.get('customer_name')}")
+
+        return result
+
+    def create_response(self, prepared):
+        """Send the Responses API request for a prepared PDF (or chunk) with retries
+
+        Raises:
+            RetriesExhausted: Throttled or transient failures outlasted the retries
+        """
+        request = self.build_request(prepared)
+        return self.retry_policy.call(lambda: self.client.responses.create(**request))
+
+    def create_responses(self, prepared):
+        """Send the request for a prepared PDF, or one per chunk concurrently"""
+        if not prepared['chunks']:
+            return [self.create_response(prepared)]
+        # Each chunk is a separate request; all must succeed for a complete result
+        with ThreadPoolExecutor(max_workers=max(1, min(self.chunk_workers, len(prepared['chunks'])))) as pool:
+            return list(pool.map(self.create_response, prepared['chunks']))
+
+    def extract_from_pdf(self, pdf_data, sender=None):
+        """Extract payment advice data using Azure OpenAI Responses API
 
-                print(f"   ✅ Azure OpenAI extraction successful!")
-                print(f"   📊 Tokens: {usage.input_tokens} input + {usage.output_tokens} output")
-                print(f"   💵 Cost: ${total_cost:.4f} (Total session: ${self.total_cost:.4f})")
-            else:
-                print(f"   ✅ Azure OpenAI extraction successful!")
-                print(f"   ℹ️  Usage information not available")
+        Args:
+            pdf_data: Binary PDF data (may be encrypted)
+            sender: Optional From header; enables per-sender layout templates
 
-            # Display extracted data
-            invoices = result.get('invoices', [])
-            common = result.get('common_details', {})
+        Returns:
+            dict: Extracted payment advice data or None if extraction fails
 
-            print(f"   📄 Found {len(invoices)} invoice(s):")
-            for i, inv in enumerate(invoices, 1):
-                print(
-                    f"      Invoice {i}: {inv.get('invoice_number')} | Net: {inv.get('net_payment_amount')} | Bill: {inv.get('bill_amount')} | TDS: {inv.get('tds_amount')} | Date: {inv.get('invoice_date')}")
+        Raises:
+            RetriesExhausted: The request was still throttled after every retry
+        """
+        started = time.perf_counter()
+        prepared = result = error = None
+        try:
+            print(f"   🤖 Starting Azure OpenAI extraction (Responses API)...")
 
-            print(f"   📋 Common details:")
-            print(f"      - Transaction Date: {common.get('transaction_date')}")
-            print(f"      - Bank Ref: {common.get('bank_reference_number')}")
-            print(f"      - Customer: {common.get('customer_name')}")
+            prepared = self.prepare_pdf(pdf_data, sender)
+            if prepared is None:
+                return None
+            if prepared['result'] is not None:
+                result = prepared['result']
+                return result
 
+            try:
+                result = self.parse_responses(self.create_responses(prepared), prepared)
+            except ValidationFailed as e:
+                # A rejected small-model result is redone once by the large deployment
+                self.router.escalate(prepared, e)
+                result = self.parse_responses(self.create_responses(prepared), prepared)
             return result
 
+        except RetriesExhausted as e:
+            # Still throttled (or failing transiently): the caller defers the advice to the next run
+            error = e
+            raise
+
         except json.JSONDecodeError as e:
             print(f"   ❌ Azure OpenAI returned invalid JSON: {e}")
-            print(f"   📄 Raw response: {result_text[:500] if 'result_text' in locals() else 'N/A'}")
+            error = e
             return None
 
         except Exception as e:
@@ -261,12 +580,103 @@ Be thorough - extract EVERY invoice from EVERY page in the document as a separat
             import traceback
             print(f"   🔍 Full traceback:")
             traceback.print_exc()
+            error = e
+            return None
+
+        finally:
+            self.record_telemetry(pdf_data, sender, started, prepared, result, error)
+
+    def record_telemetry(self, pdf_data, sender, started, prepared, result, error=None):
+        """Record one extraction (wall time since `started`) in the telemetry store"""
+        if result is not None:
+            outcome = SUCCESS
+        elif isinstance(error, RetriesExhausted):
+            outcome = DEFERRED
+        elif prepared is None and error is None:
+            outcome = UNDECRYPTABLE
+        else:
+            outcome = FAILED
+        prepared = prepared or {}
+        path = (prepared.get('source') or LLM) if prepared else None
+        usage = prepared.get('usage') or {}
+        self.telemetry.record(
+            sender=sender_address(sender) or None, pdf_sha256=prepared.get('sha256'), pdf_bytes=len(pdf_data or b''),
+            page_count=prepared.get('page_count'), pages_sent=prepared.get('pages_sent'), path=path, outcome=outcome,
+            wall_ms=round((time.perf_counter() - started) * 1000, 1), requests=usage.get('requests'),
+            input_tokens=usage.get('input_tokens'), output_tokens=usage.get('output_tokens'),
+            cost=round(usage['cost'], 8) if usage.get('cost') is not None else None,
+            invoices=len(result.get('invoices') or []) if result else None,
+            deployment=prepared.get('deployment') if path == LLM else None, error=str(error)[:500] if error else None)
+
+    def get_cached_result(self, pdf_sha256):
+        """Look up a stored extraction for this PDF hash and the current prompt
+
+        Results of either routed deployment are reused (the large one first).
+
+        Returns:
+            dict: The cached result, or None on a miss (or without a database)
+        """
+        if not self.cache_enabled:
+            return None
+        row = None
+        try:
+            for deployment in dict.fromkeys((self.router.deployments[LARGE], self.router.deployments[SMALL])):
+                row = self.db.get_extraction_cache(pdf_sha256, EXTRACTION_PROMPT_VERSION, deployment)
+                if row is not None:
+                    break
+        except Exception as e:
+            print(f"   ⚠️  Extraction cache lookup failed: {e}")
             return None
+        if row is None:
+            return None
+
+        self.cache_hits += 1
+        self.saved_cost += row['cost'] or 0.0
+        print(f"   ♻️  Extraction cache hit ({pdf_sha256[:12]}, cached {row['created_date']}) - skipping API call")
+        return json.loads(row['result_json'])
+
+    def cache_result(self, pdf_sha256, result, input_tokens=None, output_tokens=None, cost=None, deployment=None):
+        """Store a parsed extraction result for later runs"""
+        if not self.cache_enabled:
+            return
+        try:
+            self.db.save_extraction_cache(pdf_sha256, EXTRACTION_PROMPT_VERSION, deployment or self.deployment_name,
+                                          json.dumps(result), input_tokens, output_tokens, cost)
+        except Exception as e:
+            print(f"   ⚠️  Could not store extraction in cache: {e}")
+
+    def invalidate_cache(self, all_versions=False):
+        """Drop cached results made with an older prompt (or every result)
+
+        Returns:
+            int: Number of cache rows deleted
+        """
+        if self.db is None:
+            return 0
+        keep_version = None if all_versions else EXTRACTION_PROMPT_VERSION
+        deleted = self.db.clear_extraction_cache(keep_prompt_version=keep_version)
+        print(f"🗑️  Removed {deleted} cached extraction(s)" + ("" if all_versions else " from older prompts"))
+        return deleted
 
     def get_total_cost(self):
         """Get total cost of all extractions in this session"""
         return self.total_cost
 
+    def get_pruning_summary(self):
+        """Pages sent vs. total and the input tokens (and cost) saved by page pruning
+
+        Savings are estimated from the measured input tokens per page sent.
+        """
+        stats = self.pruning_stats
+        if not stats['pages_sent']:
+            return "no OpenAI requests"
+        dropped = stats['pages_total'] - stats['pages_sent']
+        tokens_per_page = stats['input_tokens'] / stats['pages_sent']
+        saved_tokens = dropped * tokens_per_page
+        saved_cost = saved_tokens / 1_000_000 * self.input_cost_per_1m
+        return (f"{stats['pages_sent']} of {stats['pages_total']} pages sent in {stats['requests']} requests, "
+                f"~{tokens_per_page:.0f} input tokens/page, ~{saved_tokens:.0f} tokens (${saved_cost:.4f}) saved")
+
 
 # Test function
 def test_azure_openai_extractor(pdf_path):
@@ -294,6 +704,7 @@ def test_azure_openai_extractor(pdf_path):
             print(f"{'=' * 60}")
             print(json.dumps(result, indent=2))
             print(f"\n💰 Total session cost: ${extractor.get_total_cost():.4f}")
+            print(f"✂️  Page pruning: {extractor.get_pruning_summary()}")
         else:
             print(f"\n❌ Extraction failed")
 
@@ -305,10 +716,42 @@ def test_azure_openai_extractor(pdf_path):
         traceback.print_exc()
 
 
+def compare_page_pruning(pdf_path):
+    """Extract one PDF with and without page pruning and compare measured input tokens"""
+    with open(pdf_path, 'rb') as f:
+        pdf_data = f.read()
+
+    # No database (no cache) and no local parsing: both runs must reach the model
+    extractor = AzureOpenAIPaymentExtractor()
+    extractor.local_parser_enabled = False
+    runs = {}
+    for pruning in (False, True):
+        extractor.page_pruning_enabled = pruning
+        before = dict(extractor.pruning_stats)
+        result = extractor.extract_from_pdf(pdf_data)
+        runs[pruning] = {key: extractor.pruning_stats[key] - before[key] for key in before}
+        runs[pruning]['invoices'] = sorted(str(inv.get('invoice_number')) for inv in (result or {}).get('invoices', []))
+
+    full, pruned = runs[False], runs[True]
+    print(f"\n{'=' * 60}")
+    print(f"PAGE PRUNING: {pdf_path}")
+    print(f"{'=' * 60}")
+    print(f"   Full PDF: {full['pages_sent']} pages, {full['input_tokens']} input tokens")
+    print(f"   Pruned:   {pruned['pages_sent']} pages, {pruned['input_tokens']} input tokens")
+    if full['input_tokens']:
+        saved = full['input_tokens'] - pruned['input_tokens']
+        print(f"   ✂️  Saved {saved} input tokens ({saved / full['input_tokens']:.0%})")
+    same = full['invoices'] == pruned['invoices']
+    print(f"   {'✅' if same else '⚠️ '} Invoices {'match' if same else 'differ'}: "
+          f"{len(full['invoices'])} full vs {len(pruned['invoices'])} pruned")
+
+
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2 and sys.argv[2] == '--compare-pruning':
+        compare_page_pruning(sys.argv[1])
+    elif len(sys.argv) > 1:
         pdf_path = sys.argv[1]
         test_azure_openai_extractor(pdf_path)
     else:
@@ -4,38 +4,52 @@ Payment Advice Extractor (OpenAI-only)
 Uses OpenAI extractor to parse PDF payment advices and produce structured records.
 """
 import os
+import re
 import imaplib
 import email
-from email.header import decode_header
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 
+from email_classifier import MATCH_KEYWORDS, NOT_ADVICE, TRUSTED, SenderReputation, matches_payment_keywords
+from imap_utils import (as_bytes, chunked, decode_mime_words, decode_transfer_encoding,
+                        parse_bodystructure, parse_fetch_response, uid_set)
 from openai_extractor import AzureOpenAIPaymentExtractor
+from resilient_client import RetriesExhausted
 
 load_dotenv()
 
-# Keywords used to quickly detect payment advice emails
-PAYMENT_KEYWORDS = [
-    'payment advice', 'payment confirmation', 'payment receipt',
-    'fund transfer', 'neft', 'rtgs', 'imps', 'upi',
-    'transaction confirmation', 'credit advice', 'debit advice',
-    'remittance advice', 'payment processed', 'amount credited',
-    'utr', 'transaction reference', 'payment reference',
-    'advice for', 'payee advice', 'payment remittance', 'remittance',
-    'transaction advice', 'fund transfer advice'
-]
+# Put on the stream queue by an IMAP worker once its slice is finished
+_WORKER_DONE = object()
+
+# Gmail-only server-side query (X-GM-RAW) used when X-GM-EXT-1 is advertised
+GMAIL_RAW_SEARCH = 'has:attachment filename:pdf'
+
+# Header fields needed to classify a message before downloading it
+PRESCREEN_HEADER_FETCH = 'BODY.PEEK[HEADER.FIELDS (SUBJECT FROM MESSAGE-ID)]'
+
+# Encoded bytes of the text part fetched for raw_text (covers its 5000 chars)
+RAW_TEXT_FETCH_BYTES = 16384
 
 
 class PaymentAdviceExtractor:
-    def __init__(self):
+    def __init__(self, db=None):
         # Only OpenAI extractor; fail fast if not configured
-        self.openai_extractor = AzureOpenAIPaymentExtractor()
+        self.openai_extractor = AzureOpenAIPaymentExtractor(db=db)
+        # Optional ReconciliationDB used to persist the IMAP ingestion checkpoint
+        self.db = db
+        # Guards the shared processed Message-ID set across IMAP workers
+        self._processed_lock = threading.Lock()
+        # Past outcomes per sender: trusted senders fast-path the keyword checks
+        self.sender_reputation = SenderReputation(db)
 
-    def is_payment_advice_email(self, subject, body):
+    @staticmethod
+    def is_payment_advice_email(subject, body):
         """Lightweight heuristic to decide if an email is a payment advice."""
-        text = f"{subject} {body}".lower()
-        return any(keyword in text for keyword in PAYMENT_KEYWORDS)
+        return matches_payment_keywords(subject, body)
 
     @staticmethod
     def _to_float(value):
@@ -46,6 +60,22 @@ class PaymentAdviceExtractor:
 
     def extract_payment_data(self, email_message, subject, from_email, body):
         """Extract payment data using OpenAI only. Returns a list of payment dicts."""
+        job = self.build_extraction_job(email_message, subject, from_email, body)
+        if job['pdf_data'] is None:
+            return []
+        return self.extract_payment_data_from_pdf(**job)
+
+    def build_extraction_job(self, email_message, subject, from_email, body):
+        """Select the advice PDF of a message and package it for extraction
+
+        Returns:
+            dict: pdf_filename, pdf_data, message_id, subject, from_email, body
+                  and uid (IMAP UID, set by the scanner) - the keyword
+                  arguments of extract_payment_data_from_pdf(). pdf_data is
+                  None when the message has no PDF.
+        """
+        job = {'pdf_filename': None, 'pdf_data': None, 'message_id': email_message.get('Message-ID', ''),
+               'subject': subject, 'from_email': from_email, 'body': body, 'uid': None}
         pdf_candidates = []
 
         def _process_part(part):
@@ -56,17 +86,7 @@ class PaymentAdviceExtractor:
 
             # Decode filename if it's encoded (e.g., =?utf-8?B?...?=)
             if filename:
-                try:
-                    decoded_parts = decode_header(filename)
-                    decoded_filename = ""
-                    for decoded_part, charset in decoded_parts:
-                        if isinstance(decoded_part, bytes):
-                            decoded_filename += decoded_part.decode(charset or 'utf-8', errors='ignore')
-                        else:
-                            decoded_filename += decoded_part
-                    filename = decoded_filename
-                except Exception:
-                    pass  # Keep original filename if decoding fails
+                filename = decode_mime_words(filename)
 
             # Decode payload size early for debugging (without re-decoding twice)
             payload = part.get_payload(decode=True)
@@ -125,19 +145,36 @@ class PaymentAdviceExtractor:
 
         if not pdf_candidates:
             print("⚠️  No PDF attachment found; skipping email")
-            return []
+            return job
 
         # Pick the largest PDF candidate assuming it is the main advice
         pdf_candidates.sort(key=lambda x: len(x[2]) if x[2] else 0, reverse=True)
         pdf_filename, pdf_content_type, pdf_data = pdf_candidates[0]
         print(f"   📌 Selected PDF for extraction: {pdf_filename} ({len(pdf_data)} bytes, type={pdf_content_type})")
 
+        job['pdf_filename'] = pdf_filename
+        job['pdf_data'] = pdf_data
+        return job
+
+    def extract_payment_data_from_pdf(self, pdf_filename, pdf_data, message_id, subject, from_email, body, uid=None):
+        """Run OpenAI extraction on an already selected PDF. Returns a list of payment dicts.
+
+        Raises:
+            RetriesExhausted: Azure OpenAI was still throttling after every retry
+        """
         try:
-            openai_result = self.openai_extractor.extract_from_pdf(pdf_data)
+            openai_result = self.openai_extractor.extract_from_pdf(pdf_data, from_email)
+        except RetriesExhausted:
+            raise
         except Exception as e:
             print(f"❌ OpenAI extraction failed: {e}")
             return []
 
+        return self.build_payment_records(openai_result, pdf_filename, pdf_data, message_id, subject, from_email, body)
+
+    def build_payment_records(self, openai_result, pdf_filename, pdf_data, message_id, subject, from_email, body,
+                              uid=None):
+        """Turn an OpenAI extraction result into payment dicts (one per invoice)"""
         if not openai_result:
             print("⚠️  OpenAI returned no result; skipping email")
             return []
@@ -158,7 +195,7 @@ class PaymentAdviceExtractor:
             tds_amount = self._to_float(invoice.get('tds_amount'))
 
             payment_data_list.append({
-                'email_id': f"{email_message.get('Message-ID', '')}_invoice_{idx}",
+                'email_id': f"{message_id}_invoice_{idx}",
                 'email_from': from_email,
                 'email_subject': subject,
                 'email_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -180,99 +217,830 @@ class PaymentAdviceExtractor:
 
         return payment_data_list
 
-    def fetch_payment_advices_from_email(self, days_back=7):
-        """Fetch payment advice emails and extract using OpenAI."""
-        try:
+    def run_extraction_job(self, job):
+        """Extract a job from build_extraction_job() and record the sender outcome
+
+        Returns:
+            list | None: Payment dicts, or None if the extraction failed (raised
+                         or gave no result) - see fail_extraction_job()
+
+        Raises:
+            RetriesExhausted: Azure OpenAI was still throttling after every retry
+            Exception: Any other extraction error (a failure for good)
+        """
+        openai_result = None
+        if job['pdf_data'] is not None:
+            openai_result = self.openai_extractor.extract_from_pdf(job['pdf_data'], job['from_email'])
+        return self.finish_extraction_job(job, openai_result)
+
+    @staticmethod
+    def defer_extraction_job(job, error, deferred):
+        """Leave a job whose extraction was still throttled (or failing transiently) for the next run
+
+        Its IMAP UID is appended to `deferred`, which holds the checkpoint
+        below it so the message is scanned again.
+        """
+        print(f"⏳ Deferring '{job['subject'][:50]}' to the next run: {error}")
+        if job.get('uid') is not None:
+            deferred.append(job['uid'])
+
+    @staticmethod
+    def fail_extraction_job(job, error, failed):
+        """Give up on a job whose extraction failed for good (permanent error, no result)
+
+        Retrying would fail the same way, so the checkpoint moves past it;
+        (UID, error) is appended to `failed` for the extraction_failures table.
+        """
+        print(f"❌ Extraction of '{job['subject'][:50]}' failed, not retried: {error}")
+        if job.get('uid') is not None:
+            failed.append((job['uid'], str(error)))
+
+    def finish_extraction_job(self, job, openai_result):
+        """Like run_extraction_job() for a result obtained elsewhere (async_extraction.py)
+
+        Returns None when the job has a PDF but `openai_result` is None.
+        """
+        if job['pdf_data'] is None:
+            payment_data_list = []
+        elif openai_result is None:
+            payment_data_list = None
+        else:
+            payment_data_list = self.build_payment_records(openai_result, **job)
+        self.sender_reputation.record_extraction(job['from_email'], payment_data_list)
+        return payment_data_list
+
+    @staticmethod
+    def _get_email_body(email_message):
+        """Return the plain-text body, falling back to tag-stripped HTML"""
+        body = ""
+        html_body = ""
+        if email_message.is_multipart():
+            for part in email_message.walk():
+                ctype = part.get_content_type()
+                if ctype == "text/plain":
+                    body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+                    break
+                if ctype == "text/html" and not html_body:
+                    html_body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+        else:
+            body = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
+
+        # Fallback: strip HTML when no plain-text part is present
+        if not body and html_body:
+            body = re.sub(r'<[^>]+>', ' ', html_body)
+            body = re.sub(r'\s+', ' ', body).strip()
+        return body
+
+    def _connect(self):
+        """Open an authenticated IMAP session with the inbox selected"""
+        if os.getenv('IMAP_USE_SSL', 'true').lower() == 'true':
             mail = imaplib.IMAP4_SSL(os.getenv('IMAP_SERVER'), int(os.getenv('IMAP_PORT')))
-            mail.login(os.getenv('GMAIL_EMAIL'), os.getenv('GMAIL_PASSWORD'))
-            mail.select('inbox')
-            print("✅ Connected to Gmail")
+        else:
+            # Plain-text sessions are only meant for a local IMAP stand-in
+            mail = imaplib.IMAP4(os.getenv('IMAP_SERVER'), int(os.getenv('IMAP_PORT')))
+        mail.login(os.getenv('GMAIL_EMAIL'), os.getenv('GMAIL_PASSWORD'))
+        mail.select('inbox')
 
-            # Set socket timeout to prevent hangs
-            mail.sock.settimeout(300)  # 5 min timeout per operation
+        # Set socket timeout to prevent hangs (5 min per operation by default)
+        mail.sock.settimeout(int(os.getenv('IMAP_TIMEOUT', 300)))
+        return mail
 
-            mark_as_read = os.getenv('MARK_PAYMENT_EMAILS_AS_READ', 'true').lower() == 'true'
-            since_date = (datetime.now() - timedelta(days=days_back)).strftime('%d-%b-%Y')
-            status, messages = mail.search(None, f'SINCE {since_date}')
-            email_ids = messages[0].split()[::-1]  # newest first
+    @staticmethod
+    def _mailbox_key():
+        """Checkpoint key identifying the account and mailbox"""
+        return f"{os.getenv('GMAIL_EMAIL')}/INBOX"
 
-            max_emails = int(os.getenv('MAX_EMAILS_TO_PROCESS', 100))
-            if len(email_ids) > max_emails:
-                print(f"⚠️  Found {len(email_ids)} emails, limiting to NEWEST {max_emails}")
-                email_ids = email_ids[:max_emails]
+    @staticmethod
+    def _get_mailbox_uid_state(mail):
+        """Return (UIDVALIDITY, UIDNEXT) for the selected inbox
+
+        Read from the SELECT response codes, falling back to a STATUS command.
+        """
+        values = {}
+        for code in ('UIDVALIDITY', 'UIDNEXT'):
+            _, data = mail.response(code)
+            if data and data[0]:
+                values[code] = int(data[0])
+
+        if len(values) < 2:
+            try:
+                _, data = mail.status('INBOX', '(UIDVALIDITY UIDNEXT)')
+                text = data[0].decode() if data and isinstance(data[0], bytes) else ''
+                for code in ('UIDVALIDITY', 'UIDNEXT'):
+                    match = re.search(rf'{code} (\d+)', text)
+                    if match and code not in values:
+                        values[code] = int(match.group(1))
+            except Exception as e:
+                print(f"   ⚠️  Could not read mailbox UID state: {e}")
+
+        return values.get('UIDVALIDITY'), values.get('UIDNEXT')
+
+    @staticmethod
+    def _or_search(keys):
+        """Combine IMAP search keys into a balanced tree of binary ORs"""
+        if len(keys) == 1:
+            return keys[0]
+        middle = len(keys) // 2
+        return f"OR {PaymentAdviceExtractor._or_search(keys[:middle])} {PaymentAdviceExtractor._or_search(keys[middle:])}"
+
+    def _search_uids(self, mail, criteria, narrow=True):
+        """UID SEARCH narrowed on the server to likely payment advices
+
+        Gmail (X-GM-EXT-1) gets an X-GM-RAW attachment query; other servers get
+        an OR over SUBJECT/BODY for every payment keyword. The local keyword
+        heuristic still runs afterwards. IMAP_SERVER_SEARCH=false or
+        narrow=False searches by `criteria` alone.
+        """
+        if narrow and os.getenv('IMAP_SERVER_SEARCH', 'true').lower() == 'true':
+            try:
+                _, data = mail.capability()
+                capabilities = b' '.join(d for d in data if isinstance(d, bytes)).upper().split()
+            except Exception:
+                capabilities = []
+
+            if b'X-GM-EXT-1' in capabilities:
+                criteria = f'{criteria} X-GM-RAW "{GMAIL_RAW_SEARCH}"'
+                print(f"🔎 Server-side search (Gmail): {GMAIL_RAW_SEARCH}")
             else:
-                print(f"📧 Found {len(email_ids)} emails to scan")
+                keys = [f'SUBJECT "{kw}"' for kw in MATCH_KEYWORDS] + [f'BODY "{kw}"' for kw in MATCH_KEYWORDS]
+                criteria = f'{criteria} {self._or_search(keys)}'
+                print(f"🔎 Server-side search over {len(MATCH_KEYWORDS)} payment keywords")
 
-            payment_advices = []
-            processed_emails = set()
+        status, messages = mail.uid('SEARCH', None, criteria)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID SEARCH failed: {status}")
+        return messages[0].split()
 
-            for idx, email_id in enumerate(email_ids):
-                # Reconnect every 20 emails to prevent timeout
-                if idx > 0 and idx % 100 == 0:
-                    print(f"   🔄 Reconnecting to prevent timeout (processed {idx} emails)...")
-                    try:
-                        mail.close()
-                        mail.logout()
-                    except:
-                        pass
-                    mail = imaplib.IMAP4_SSL(os.getenv('IMAP_SERVER'), int(os.getenv('IMAP_PORT')))
-                    mail.login(os.getenv('GMAIL_EMAIL'), os.getenv('GMAIL_PASSWORD'))
-                    mail.select('inbox')
-                    mail.sock.settimeout(300)
-                try:
-                    status, msg_data = mail.fetch(email_id, '(BODY.PEEK[])')
-                    email_message = email.message_from_bytes(msg_data[0][1])
+    @staticmethod
+    def _next_checkpoint_uid(scanned_uids, failed_uids, previous_uid, uidnext=None):
+        """Highest UID such that every scanned UID at or below it was processed
 
-                    subject = str(email_message.get('Subject', ''))
-                    from_email = email_message.get('From', '')
-                    message_id = email_message.get('Message-ID', '')
+        When nothing failed, UIDNEXT - 1 is used (if given) so that mail outside
+        the scanned window is not picked up by the next incremental run.
+        """
+        scanned = [int(uid) for uid in scanned_uids]
+        if failed_uids:
+            first_failed = min(int(uid) for uid in failed_uids)
+            done = [uid for uid in scanned if uid < first_failed]
+            return max([previous_uid] + done)
+        candidates = [previous_uid] + scanned
+        if uidnext:
+            candidates.append(uidnext - 1)
+        return max(candidates)
 
-                    if message_id in processed_emails:
-                        print(f"   ⏭️  Skipping duplicate email: {subject[:50]}")
-                        continue
+    @staticmethod
+    def _disconnect(mail):
+        try:
+            mail.close()
+            mail.logout()
+        except Exception:
+            pass
 
-                    body = ""
-                    html_body = ""
-                    if email_message.is_multipart():
-                        for part in email_message.walk():
-                            ctype = part.get_content_type()
-                            if ctype == "text/plain":
-                                body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                break
-                            if ctype == "text/html" and not html_body:
-                                html_body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    else:
-                        body = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
+    def _fetch_messages_batch(self, mail, uids):
+        """Fetch full messages for a batch of UIDs with a single UID FETCH
+
+        Returns:
+            list: (uid, raw_message_bytes) in the same order as `uids`
+        """
+        status, data = mail.uid('FETCH', uid_set(uids), '(UID BODY.PEEK[])')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH failed: {status}")
+
+        raw_by_uid = {}
+        for item in parse_fetch_response(data):
+            if item.get('UID') and item.get('BODY[]') is not None:
+                raw_by_uid[item['UID'].encode()] = as_bytes(item['BODY[]'])
+
+        return [(uid, raw_by_uid[uid]) for uid in uids if uid in raw_by_uid]
+
+    @staticmethod
+    def _is_pdf_part(part):
+        """Mirror of the PDF checks in extract_payment_data, driven by BODYSTRUCTURE
 
-                    # Fallback: strip HTML when no plain-text part is present
-                    if not body and html_body:
-                        import re
-                        body = re.sub(r'<[^>]+>', ' ', html_body)
-                        body = re.sub(r'\s+', ' ', body).strip()
+        Unnamed octet-stream parts are kept because only the payload can tell
+        whether they are PDFs (the %PDF sniffing fallback).
+        """
+        filename = (part.get('filename') or '').lower()
+        content_type = part['content_type']
+        if filename.endswith('.pdf') or content_type == 'application/pdf':
+            return True
+        return content_type == 'application/octet-stream'
+
+    @staticmethod
+    def _pick_text_part(parts):
+        """Return the first text/plain part, else the first text/html part"""
+        for wanted in ('text/plain', 'text/html'):
+            for part in parts:
+                if part['content_type'] == wanted and part.get('disposition') != 'attachment':
+                    return part
+        return None
+
+    @staticmethod
+    def _decode_text_part(data, part):
+        """Decode a fetched text section, stripping tags from HTML"""
+        raw = decode_transfer_encoding(data, part['encoding'])
+        try:
+            text = raw.decode(part['params'].get('charset') or 'utf-8', errors='ignore')
+        except LookupError:
+            text = raw.decode('utf-8', errors='ignore')
+        if part['content_type'] == 'text/html':
+            text = re.sub(r'\s+', ' ', re.sub(r'<[^>]+>', ' ', text)).strip()
+        return text
 
-                    if self.is_payment_advice_email(subject, body):
-                        print(f"💰 Payment advice found: {subject[:50]}")
-                        payment_data_list = self.extract_payment_data(email_message, subject, from_email, body)
+    def _fetch_advice_sections(self, mail, entries):
+        """Download only the PDF section and a text prefix for screened advices
 
-                        processed_emails.add(message_id)
-                        payment_advices.extend(payment_data_list)
+        The largest PDF-like part is fetched first; if its payload turns out not to
+        be a PDF (unnamed octet-stream), the next largest part is tried.
 
-                        if mark_as_read:
-                            mail.store(email_id, '+FLAGS', '\\Seen')
-                            print(f"   ✅ Marked email as read")
+        Returns:
+            list: (entry, pdf_filename, pdf_data, body) for entries with a PDF
+        """
+        pending = []
+        for entry in entries:
+            pdf_parts = sorted((p for p in entry['parts'] if self._is_pdf_part(p)),
+                               key=lambda p: p['size'], reverse=True)
+            pending.append((entry, pdf_parts, self._pick_text_part(entry['parts']), True))
+
+        results = []
+        while pending:
+            # Group by requested sections so each group is a single UID FETCH
+            groups = {}
+            for entry, pdf_parts, text_part, want_text in pending:
+                key = (pdf_parts[0]['section'], text_part['section'] if text_part and want_text else None)
+                groups.setdefault(key, []).append((entry, pdf_parts, text_part, want_text))
+
+            pending = []
+            for (pdf_section, text_section), group in groups.items():
+                items = f'UID BODY.PEEK[{pdf_section}]'
+                if text_section:
+                    items += f' BODY.PEEK[{text_section}]<0.{RAW_TEXT_FETCH_BYTES}>'
+                status, data = mail.uid('FETCH', uid_set([e['uid'] for e, _, _, _ in group]), f'({items})')
+                if status != 'OK':
+                    raise imaplib.IMAP4.error(f"UID FETCH (sections) failed: {status}")
+                fetched = {item['UID'].encode(): item for item in parse_fetch_response(data) if item.get('UID')}
+
+                for entry, pdf_parts, text_part, want_text in group:
+                    item = fetched.get(entry['uid'], {})
+                    if want_text:
+                        text_key = next((k for k in item if text_section and k.startswith(f'BODY[{text_section}]')), None)
+                        entry['body'] = self._decode_text_part(item.get(text_key), text_part) if text_key else ''
+
+                    part = pdf_parts[0]
+                    pdf_data = decode_transfer_encoding(item.get(f'BODY[{pdf_section}]'), part['encoding'])
+                    filename = part.get('filename')
+                    is_named_pdf = (filename or '').lower().endswith('.pdf') or part['content_type'] == 'application/pdf'
+                    if pdf_data and (is_named_pdf or pdf_data[:4] == b'%PDF'):
+                        if not filename:
+                            filename = 'payment_advice.pdf' if is_named_pdf else 'payment_advice_sniffed.pdf'
+                        print(f"   📎 Fetched PDF section {pdf_section}: {filename} ({len(pdf_data)} bytes)")
+                        results.append((entry, filename, pdf_data, entry['body']))
+                    elif len(pdf_parts) > 1:
+                        pending.append((entry, pdf_parts[1:], text_part, False))
                     else:
-                        print(f"   ℹ️  Not a payment advice: {subject[:50]}")
+                        print(f"⚠️  No PDF attachment found; skipping email: {entry['subject'][:50]}")
+
+        return results
+
+    def _prescreen_batch(self, mail, uids, body_bytes):
+        """Classify a batch of UIDs from headers and BODYSTRUCTURE only
+
+        Returns:
+            list: Entries (same order as `uids`) worth downloading. Screened
+                  entries carry subject/from_email/message_id/parts; UIDs the
+                  server did not describe come back as {'uid': uid}.
+        """
+        status, data = mail.uid('FETCH', uid_set(uids), f'(UID BODYSTRUCTURE {PRESCREEN_HEADER_FETCH})')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH (prescreen) failed: {status}")
+
+        screened = {}
+        for item in parse_fetch_response(data):
+            if not item.get('UID'):
+                continue
+            header_key = next((k for k in item if k.startswith('BODY[HEADER')), None)
+            headers = email.message_from_bytes(as_bytes(item.get(header_key)))
+            uid = item['UID'].encode()
+            screened[uid] = {
+                'uid': uid,
+                'subject': str(headers.get('Subject', '')),
+                'from_email': headers.get('From', ''),
+                'message_id': headers.get('Message-ID', ''),
+                'parts': parse_bodystructure(item.get('BODYSTRUCTURE')),
+            }
+
+        candidates = set()
+        needs_body = {}  # text section -> [(uid, part)]
+        for uid, info in screened.items():
+            if not any(self._is_pdf_part(part) for part in info['parts']):
+                print(f"   ℹ️  No PDF part, skipping: {info['subject'][:50]}")
+                continue
+            if self.is_payment_advice_email(info['subject'], ''):
+                candidates.add(uid)
+                continue
+            verdict = self.sender_reputation.verdict(info['from_email'])
+            if verdict == TRUSTED:
+                candidates.add(uid)
+                continue
+            # Everyone else, known non-advice senders included, is classified from the body:
+            # dropping their mail unseen would lose the first real advice they send
+            text_part = self._pick_text_part(info['parts'])
+            if text_part is None:
+                print(f"   ℹ️  Not a payment advice: {info['subject'][:50]}")
+                self.sender_reputation.record(info['from_email'], NOT_ADVICE)
+                continue
+            needs_body.setdefault(text_part['section'], []).append((uid, text_part))
+
+        # Classify the rest from the first bytes of their text part, one FETCH per section
+        for section, entries in needs_body.items():
+            status, data = mail.uid('FETCH', uid_set([uid for uid, _ in entries]),
+                                    f'(UID BODY.PEEK[{section}]<0.{body_bytes}>)')
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"UID FETCH (text prefix) failed: {status}")
+            prefixes = {}
+            for item in parse_fetch_response(data):
+                body_key = next((k for k in item if k.startswith(f'BODY[{section}]')), None)
+                if item.get('UID') and body_key:
+                    prefixes[item['UID'].encode()] = item[body_key]
+
+            for uid, part in entries:
+                text = self._decode_text_part(prefixes.get(uid), part)
+                subject = screened[uid]['subject']
+                if self.is_payment_advice_email(subject, text):
+                    candidates.add(uid)
+                else:
+                    print(f"   ℹ️  Not a payment advice: {subject[:50]}")
+                    self.sender_reputation.record(screened[uid]['from_email'], NOT_ADVICE)
+
+        # UIDs the server did not describe are kept, so nothing is silently lost
+        return [screened.get(uid, {'uid': uid}) for uid in uids if uid in candidates or uid not in screened]
+
+    def _prescreen_uids(self, mail, uids, batch_size):
+        """Phase 1 of the scan: keep only UIDs that look like advices with a PDF part
+
+        Returns:
+            tuple: (candidate_entries, mail) - the session may have been reopened
+        """
+        body_bytes = int(os.getenv('IMAP_PRESCREEN_BODY_BYTES', 4096))
+        candidates = []
+        for batch in chunked(uids, batch_size):
+            try:
+                candidates.extend(self._prescreen_batch(mail, batch, body_bytes))
+            except Exception as e:
+                # Fail open: download the batch in full rather than drop it
+                print(f"⚠️  Prescreen failed for batch of {len(batch)} emails: {e}")
+                candidates.extend({'uid': uid} for uid in batch)
+                self._disconnect(mail)
+                mail = self._connect()
+
+        print(f"🔎 Prescreen kept {len(candidates)} of {len(uids)} emails for full download")
+        return candidates, mail
+
+    def _process_email_message(self, email_message, processed_emails):
+        """Classify one message and build its extraction job
+
+        Returns:
+            dict | None: Job from build_extraction_job() for a payment advice, None if skipped
+        """
+        subject = str(email_message.get('Subject', ''))
+        from_email = email_message.get('From', '')
+        message_id = email_message.get('Message-ID', '')
+
+        if message_id in processed_emails:
+            print(f"   ⏭️  Skipping duplicate email: {subject[:50]}")
+            return None
+
+        verdict = self.sender_reputation.verdict(from_email)
+        body = self._get_email_body(email_message)
+
+        if verdict != TRUSTED and not self.is_payment_advice_email(subject, body):
+            print(f"   ℹ️  Not a payment advice: {subject[:50]}")
+            self.sender_reputation.record(from_email, NOT_ADVICE)
+            return None
+
+        if not self._claim_message(message_id, processed_emails):
+            print(f"   ⏭️  Skipping duplicate email: {subject[:50]}")
+            return None
+
+        print(f"💰 Payment advice found: {subject[:50]}")
+        return self.build_extraction_job(email_message, subject, from_email, body)
+
+    def _claim_message(self, message_id, processed_emails):
+        """Atomically mark a Message-ID as processed; False if another worker has it"""
+        with self._processed_lock:
+            if message_id in processed_emails:
+                return False
+            processed_emails.add(message_id)
+            return True
+
+    def _process_batch(self, mail, entries, processed_emails, use_sections):
+        """Download one batch of candidate entries
 
+        Screened entries are fetched section-by-section when `use_sections` is
+        set; everything else is downloaded as a full message.
+
+        Yields:
+            tuple: (uid, extraction job) for each payment advice email
+        """
+        section_entries = [e for e in entries if use_sections and 'parts' in e]
+        full_uids = [e['uid'] for e in entries if not (use_sections and 'parts' in e)]
+
+        if section_entries:
+            for entry, pdf_filename, pdf_data, body in self._fetch_advice_sections(mail, section_entries):
+                try:
+                    if not self._claim_message(entry['message_id'], processed_emails):
+                        print(f"   ⏭️  Skipping duplicate email: {entry['subject'][:50]}")
+                        continue
+                    print(f"💰 Payment advice found: {entry['subject'][:50]}")
                 except Exception as e:
                     print(f"⚠️  Error processing email: {e}")
                     continue
+                yield entry['uid'], {'pdf_filename': pdf_filename, 'pdf_data': pdf_data,
+                                     'message_id': entry['message_id'], 'subject': entry['subject'],
+                                     'from_email': entry['from_email'], 'body': body, 'uid': entry['uid']}
 
-            mail.close()
-            mail.logout()
+        if full_uids:
+            fetched = self._fetch_messages_batch(mail, full_uids)
+            print(f"   📦 Fetched {len(fetched)} emails in one batch")
+            for uid, raw_message in fetched:
+                try:
+                    email_message = email.message_from_bytes(raw_message)
+                    job = self._process_email_message(email_message, processed_emails)
+                except Exception as e:
+                    print(f"⚠️  Error processing email: {e}")
+                    continue
+                if job is not None:
+                    job['uid'] = uid
+                    yield uid, job
+
+    def _iter_scan_uids(self, mail, uids, processed_emails, failed_uids):
+        """Prescreen and download `uids` over one IMAP session
+
+        Reconnects every ~100 emails and after a failed batch. The UIDs of a
+        failed batch that were not yielded yet are retried one at a time;
+        those that fail again are appended to `failed_uids`. The session is
+        closed when the generator finishes or is closed by the consumer.
+
+        Yields:
+            dict: Extraction jobs (see build_extraction_job), as soon as each email is downloaded
+        """
+        mark_as_read = os.getenv('MARK_PAYMENT_EMAILS_AS_READ', 'true').lower() == 'true'
+        batch_size = int(os.getenv('IMAP_FETCH_BATCH_SIZE', 50))
+        use_sections = os.getenv('IMAP_FETCH_SECTIONS', 'true').lower() == 'true'
+
+        try:
+            if os.getenv('IMAP_PRESCREEN', 'true').lower() == 'true':
+                entries, mail = self._prescreen_uids(mail, uids, batch_size)
+            else:
+                entries = [{'uid': uid} for uid in uids]
+
+            fetched_since_connect = 0
+            for batch in chunked(entries, batch_size):
+                # Reconnect every ~100 emails to prevent timeout
+                if fetched_since_connect >= 100:
+                    print(f"   🔄 Reconnecting to prevent timeout (fetched {fetched_since_connect} emails)...")
+                    self._disconnect(mail)
+                    mail = self._connect()
+                    fetched_since_connect = 0
+
+                advice_uids = []
+                try:
+                    for uid, job in self._process_batch(mail, batch, processed_emails, use_sections):
+                        advice_uids.append(uid)
+                        yield job
+                except Exception as e:
+                    print(f"⚠️  Error fetching batch of {len(batch)} emails: {e}")
+                    self._disconnect(mail)
+                    mail = self._connect()
+                    fetched_since_connect = 0
+                    # Advices already yielded (fetched section-by-section) are done
+                    done = set(advice_uids)
+                    for entry in batch:
+                        if entry['uid'] in done:
+                            continue
+                        try:
+                            for uid, job in self._process_batch(mail, [entry], processed_emails, use_sections):
+                                advice_uids.append(uid)
+                                yield job
+                        except Exception as retry_error:
+                            print(f"⚠️  Error fetching email UID {entry['uid'].decode()}: {retry_error}")
+                            failed_uids.append(entry['uid'])
+                            self._disconnect(mail)
+                            mail = self._connect()
+
+                fetched_since_connect += len(batch)
+
+                if mark_as_read and advice_uids:
+                    mail.uid('STORE', uid_set(advice_uids), '+FLAGS', '(\\Seen)')
+                    print(f"   ✅ Marked {len(advice_uids)} email(s) as read")
+        finally:
+            self._disconnect(mail)
+
+    def _scan_partition(self, worker_no, uids, processed_emails, failed_uids, output, stop):
+        """Worker entry point: scan a slice of UIDs on a dedicated IMAP session
+
+        Jobs are put on the bounded `output` queue, so a slow consumer
+        throttles the scan. `_WORKER_DONE` is always put last.
+        """
+        try:
+            try:
+                mail = self._connect()
+            except Exception as e:
+                print(f"❌ IMAP worker {worker_no} could not connect: {e}")
+                failed_uids.extend(uids)
+                return
+
+            print(f"   🧵 IMAP worker {worker_no} scanning {len(uids)} emails")
+            try:
+                for job in self._iter_scan_uids(mail, uids, processed_emails, failed_uids):
+                    if not self._put_stream_item(output, stop, job):
+                        return
+            except Exception as e:
+                # e.g. a reconnect that failed - nothing in this slice is counted as done
+                print(f"❌ IMAP worker {worker_no} failed: {e}")
+                failed_uids.extend(uids)
+        finally:
+            self._put_stream_item(output, stop, _WORKER_DONE)
+
+    @staticmethod
+    def _put_stream_item(output, stop, item):
+        """Put `item` on the bounded stream queue; False once the consumer has stopped"""
+        while not stop.is_set():
+            try:
+                output.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def will_full_scan(self, full_rescan=False):
+        """Whether the next scan covers the whole `days_back` window (no usable checkpoint)
+
+        A UIDVALIDITY change is only seen after connecting; iter_payment_advices_from_email
+        reports it through `on_full_scan`.
+        """
+        return full_rescan or self.db is None or self.db.get_imap_checkpoint(self._mailbox_key()) is None
+
+    def iter_payment_advices_from_email(self, days_back=7, full_rescan=False, on_full_scan=None):
+        """Stream payment advice records from the inbox as they are extracted.
+
+        Messages are downloaded with batched UID FETCH commands
+        (IMAP_FETCH_BATCH_SIZE UIDs per round trip, default 50). Unless
+        IMAP_PRESCREEN=false, a first pass fetches only headers, BODYSTRUCTURE
+        and a text prefix so that only likely advices with a PDF part are
+        downloaded. Those are then fetched section-by-section (the selected
+        PDF plus the text part) unless IMAP_FETCH_SECTIONS=false.
+
+        When the extractor has a database, a per-mailbox checkpoint
+        (UIDVALIDITY + highest processed UID) is stored and later runs only
+        fetch newer UIDs. The `days_back` window is used for the first run,
+        after a UIDVALIDITY change, or when `full_rescan` is requested. The
+        checkpoint is only saved once the stream has been fully consumed.
+
+        With IMAP_WORKERS > 1 the UID list is split across that many
+        authenticated sessions scanned in parallel; Message-ID de-duplication
+        is shared between them and at most IMAP_STREAM_QUEUE_SIZE advices
+        are buffered ahead of the consumer.
+
+        With EXTRACTION_CONCURRENCY > 1 the PDFs are sent to Azure OpenAI
+        concurrently (see async_extraction.py) while the inbox is still
+        being scanned; records are then yielded in completion order.
+
+        An advice still throttled (or failing transiently) after every retry
+        is treated like a failed fetch: the checkpoint stays below its UID so
+        the next run retries it, up to IMAP_MAX_EXTRACTION_DEFERRALS runs.
+        Permanent failures (bad request, no result, undecryptable PDF) are
+        not retried. Both are kept in the extraction_failures table.
 
-            print(f"✅ Extracted {len(payment_advices)} payment advices")
-            return payment_advices
+        Args:
+            on_full_scan: Called before the first advice is yielded if the scan
+                          ignores the checkpoint (first run, full_rescan or a
+                          UIDVALIDITY change)
 
+        Yields:
+            dict: One payment advice record per invoice (includes pdf_data)
+        """
+        scan = {}
+        deferred = []
+        failed = []
+        extracted = 0
+        jobs = self._iter_advice_jobs(days_back, full_rescan, scan, on_full_scan)
+        for advice in self._extract_jobs(jobs, deferred, failed):
+            extracted += 1
+            yield advice
+
+        if not scan.get('complete'):
+            return
+
+        self.sender_reputation.flush()
+        if self.db is not None and scan['uidvalidity'] is not None:
+            deferred = self._record_extraction_failures(scan, deferred, failed)
+            new_last_uid = self._next_checkpoint_uid(scan['email_ids'], scan['failed_uids'] + deferred,
+                                                     scan['last_uid'], scan['uidnext'])
+            self.db.save_imap_checkpoint(self._mailbox_key(), scan['uidvalidity'], new_last_uid)
+            print(f"📌 Saved IMAP checkpoint: UIDVALIDITY {scan['uidvalidity']}, last UID {new_last_uid}")
+
+        print(f"✅ Extracted {extracted} payment advices")
+        if deferred:
+            print(f"⏳ {len(deferred)} throttled advice(s) left for the next run")
+        if failed:
+            print(f"❌ {len(failed)} advice(s) could not be extracted (see extraction_failures)")
+
+    def _record_extraction_failures(self, scan, deferred, failed):
+        """Store this run's failed extractions; return the deferred UIDs still worth waiting for
+
+        A UID deferred IMAP_MAX_EXTRACTION_DEFERRALS times (default 5) is
+        given up on, so one message that keeps failing cannot hold the
+        checkpoint - and every newer advice behind it - forever.
+        """
+        mailbox, uidvalidity = self._mailbox_key(), scan['uidvalidity']
+        max_deferrals = int(os.getenv('IMAP_MAX_EXTRACTION_DEFERRALS', 5))
+        for uid, error in failed:
+            self.db.record_extraction_failure(mailbox, uidvalidity, int(uid), error, transient=False, gave_up=True)
+
+        waiting = []
+        for uid in deferred:
+            attempts = self.db.record_extraction_failure(mailbox, uidvalidity, int(uid),
+                                                         'still throttled or failing transiently', transient=True)
+            if attempts >= max_deferrals:
+                print(f"⚠️  Giving up on UID {int(uid)} after {attempts} deferred extractions")
+                self.db.give_up_extraction_failure(mailbox, uidvalidity, int(uid))
+            else:
+                waiting.append(uid)
+
+        # Messages retried earlier that went through this time
+        unfinished = {int(uid) for uid in deferred + scan['failed_uids']} | {int(uid) for uid, _ in failed}
+        self.db.clear_extraction_failures(mailbox, uidvalidity,
+                                          [int(uid) for uid in scan['email_ids'] if int(uid) not in unfinished])
+        return waiting
+
+    def _extract_jobs(self, jobs, deferred=None, failed=None):
+        """Run extraction jobs serially, or concurrently when EXTRACTION_CONCURRENCY > 1
+
+        UIDs of jobs still throttled after every retry are appended to
+        `deferred`; (UID, error) of jobs whose extraction failed for good
+        to `failed`. Extraction telemetry and per-sender model routing outcomes are
+        flushed when the jobs are done.
+
+        Yields:
+            dict: Payment advice records
+        """
+        if deferred is None:
+            deferred = []
+        if failed is None:
+            failed = []
+        try:
+            if int(os.getenv('EXTRACTION_CONCURRENCY', 1)) <= 1:
+                for job in jobs:
+                    try:
+                        payment_data_list = self.run_extraction_job(job)
+                    except RetriesExhausted as e:
+                        self.defer_extraction_job(job, e, deferred)
+                        continue
+                    except Exception as e:
+                        print(f"⚠️  Error processing email: {e}")
+                        self.fail_extraction_job(job, e, failed)
+                        continue
+                    if payment_data_list is None:
+                        self.fail_extraction_job(job, 'no extraction result', failed)
+                        continue
+                    yield from payment_data_list
+                return
+
+            from async_extraction import AsyncExtractionPipeline
+            yield from AsyncExtractionPipeline(self).run(jobs, deferred, failed)
+        finally:
+            # Also when the consumer stops early: completed extractions are still recorded
+            self.openai_extractor.telemetry.flush()
+            self.openai_extractor.router.flush()
+
+    def _iter_advice_jobs(self, days_back, full_rescan, scan, on_full_scan=None):
+        """Search the inbox and yield an extraction job per payment advice email
+
+        Fills `scan` with what the checkpoint needs (uidvalidity, uidnext,
+        last_uid, email_ids, failed_uids) and sets scan['complete'] once
+        every UID has been scanned.
+        """
+        mail = None
+        try:
+            mail = self._connect()
+            print("✅ Connected to Gmail")
+
+            max_emails = int(os.getenv('MAX_EMAILS_TO_PROCESS', 100))
+
+            uidvalidity, uidnext = self._get_mailbox_uid_state(mail)
+            checkpoint = None
+            if self.db is not None and not full_rescan:
+                checkpoint = self.db.get_imap_checkpoint(self._mailbox_key())
+                if checkpoint and checkpoint['uidvalidity'] != uidvalidity:
+                    print(f"⚠️  UIDVALIDITY changed ({checkpoint['uidvalidity']} -> {uidvalidity}); full rescan")
+                    checkpoint = None
+
+            if checkpoint:
+                last_uid = checkpoint['last_uid'] or 0
+                # "n:*" always matches the newest message, even if it is below n
+                email_ids = [uid for uid in self._search_uids(mail, f'UID {last_uid + 1}:*') if int(uid) > last_uid]
+                print(f"📌 Incremental scan from UID {last_uid + 1}")
+                if len(email_ids) > max_emails:
+                    # Oldest first so the checkpoint never skips unprocessed mail
+                    print(f"⚠️  Found {len(email_ids)} new emails, limiting to OLDEST {max_emails}")
+                    email_ids = email_ids[:max_emails]
+                    uidnext = None
+                else:
+                    print(f"📧 Found {len(email_ids)} new emails to scan")
+            else:
+                last_uid = 0
+                since_date = (datetime.now() - timedelta(days=days_back)).strftime('%d-%b-%Y')
+                email_ids = self._search_uids(mail, f'SINCE {since_date}')[::-1]  # newest first
+
+                if len(email_ids) > max_emails:
+                    print(f"⚠️  Found {len(email_ids)} emails, limiting to NEWEST {max_emails}")
+                    email_ids = email_ids[:max_emails]
+                else:
+                    print(f"📧 Found {len(email_ids)} emails to scan")
+                # Only after the search succeeded: a failed one must not leave the stored advices cleared
+                if on_full_scan is not None:
+                    on_full_scan()
         except Exception as e:
             print(f"❌ Error fetching emails: {e}")
-            return []
+            if mail is not None:
+                self._disconnect(mail)
+            return
+
+        processed_emails = set()
+        failed_uids = []
+        scan.update(uidvalidity=uidvalidity, uidnext=uidnext, last_uid=last_uid,
+                    email_ids=email_ids, failed_uids=failed_uids)
+        workers = max(1, min(int(os.getenv('IMAP_WORKERS', 1)), len(email_ids)))
+
+        if workers == 1:
+            try:
+                yield from self._iter_scan_uids(mail, email_ids, processed_emails, failed_uids)
+            except Exception as e:
+                print(f"❌ Error fetching emails: {e}")
+                return
+        else:
+            # Contiguous slices keep each worker's FETCH UID sets compact
+            self._disconnect(mail)
+            slice_size = -(-len(email_ids) // workers)
+            partitions = list(chunked(email_ids, slice_size))
+            print(f"🧵 Scanning with {len(partitions)} parallel IMAP sessions")
+
+            output = queue.Queue(maxsize=int(os.getenv('IMAP_STREAM_QUEUE_SIZE', 100)))
+            stop = threading.Event()
+            with ThreadPoolExecutor(max_workers=len(partitions)) as pool:
+                for worker_no, partition in enumerate(partitions, 1):
+                    pool.submit(self._scan_partition, worker_no, partition, processed_emails,
+                                failed_uids, output, stop)
+                try:
+                    finished = 0
+                    while finished < len(partitions):
+                        job = output.get()
+                        if job is _WORKER_DONE:
+                            finished += 1
+                            continue
+                        yield job
+                finally:
+                    # Release workers blocked on a full queue if the consumer stopped early
+                    stop.set()
+
+        scan['complete'] = True
+
+    def fetch_payment_advices_from_email(self, days_back=7, full_rescan=False):
+        """Fetch payment advice emails and extract using OpenAI.
+
+        Collects iter_payment_advices_from_email() into a list. Prefer the
+        iterator for large windows so the PDFs are not all held in memory.
+        """
+        return list(self.iter_payment_advices_from_email(days_back, full_rescan))
+
+    def iter_payment_advices_from_source(self, source):
+        """Stream payment advice records from any MessageSource (mbox, Maildir, .eml, IMAP)
+
+        Each message goes through the same classification and extraction
+        path as a fully downloaded IMAP message (including
+        EXTRACTION_CONCURRENCY). No checkpoint is read or written and nothing
+        is marked as read.
+
+        Yields:
+            dict: One payment advice record per invoice (includes pdf_data)
+        """
+        extracted = 0
+        for payment_data in self._extract_jobs(self._iter_source_jobs(source)):
+            extracted += 1
+            yield payment_data
+
+        self.sender_reputation.flush()
+        print(f"✅ Extracted {extracted} payment advices from {source!r}")
+
+    def _iter_source_jobs(self, source):
+        """Yield an extraction job per payment advice message of a MessageSource"""
+        processed_emails = set()
+        for key, email_message in source.iter_messages():
+            try:
+                job = self._process_email_message(email_message, processed_emails)
+            except Exception as e:
+                print(f"⚠️  Error processing message {key}: {e}")
+                continue
+            if job is not None:
+                yield job
@@ -7,6 +7,7 @@ import sys
 from datetime import datetime
 import pandas as pd
 from database import ReconciliationDB
+from invoice_snapshot import InvoiceSnapshot, merge_results
 from payment_advice_extractor import PaymentAdviceExtractor
 from reconciliation_engine import ReconciliationEngine
 from warsoft_client import WarsoftClient
@@ -115,31 +116,30 @@ def generate_excel_report(db):
 
 def sync_invoices_from_warsoft(db, warsoft_client):
     """
-    Sync unpaid invoices from Warsoft into database
+    Sync unpaid invoices from Warsoft into database (a new invoice snapshot version)
     """
     print(f"\n📥 Fetching unpaid invoices from Warsoft...")
 
-    # Fetch all unpaid invoices
-    invoices = warsoft_client.fetch_all_unpaid_invoices()
-
-    if not invoices:
+    stats = InvoiceSnapshot(db, warsoft_client).refresh(verbose=True)
+    if not stats or not stats['invoices']:
         print("⚠️  No unpaid invoices found in Warsoft")
         return 0
 
-    count = 0
-    for invoice_raw in invoices:
-        try:
-            # Parse invoice to standardized format
-            invoice = warsoft_client.parse_invoice(invoice_raw)
-            db.insert_warsoft_invoice(invoice)
-            count += 1
-            print(
-                f"   ✅ Synced: {invoice.get('invoice_number')} - ₹{invoice.get('total_amount', 0)} ({invoice.get('status')})")
-        except Exception as e:
-            print(f"   ⚠️  Error storing invoice {invoice_raw.get('invoiceNumber')}: {e}")
+    print(f"✅ Synced {stats['invoices']} unpaid invoices from Warsoft ({stats['added']} added, "
+          f"{stats['changed']} changed, {stats['removed']} removed, {stats['unchanged']} unchanged)")
+    return stats['invoices']
+
+
+def clear_run_data(db):
+    """Drop stored advices and results before a full scan re-ingests the DAYS_TO_SEARCH window
 
-    print(f"✅ Synced {count} unpaid invoices from Warsoft")
-    return count
+    Incremental runs keep them: mail older than the IMAP checkpoint is never
+    fetched again, so a NOT_FOUND advice has to stay stored until its invoice
+    shows up in Warsoft.
+    """
+    print("\n🗑️  Full scan - clearing previous data...")
+    db.clear_payment_advices()
+    db.clear_reconciliation_results()
 
 
 def generate_no_invoice_report(db):
@@ -238,79 +238,110 @@ def main():
     print("=" * 70)
     print("💰 PAYMENT RECONCILIATION SYSTEM - WARSOFT INTEGRATION")
     print("=" * 70)
-    print("1. 📧 Extract payment advices from email inbox")
-    print("2. 📥 Sync unpaid invoices from Warsoft")
-    print("3. 🔄 Match payment advices with invoices by invoice number")
+    print("1. 📥 Load the Warsoft invoice snapshot (refreshed in the background when stale)")
+    print("2. 📧 Stream payment advices from email inbox")
+    print("3. 🔄 Match each advice with invoices by invoice number as it arrives")
     print("4. 📤 Write matched payments to Warsoft")
     print("5. 📊 Generate Excel report (MATCHED/UNMATCHED/NOT_FOUND)")
     print("=" * 70)
 
     # Initialize components
     db = ReconciliationDB()
-    extractor = PaymentAdviceExtractor()
+    extractor = PaymentAdviceExtractor(db=db)
     warsoft_client = WarsoftClient()
     reconciler = ReconciliationEngine(db, warsoft_client)
 
-    # Clear old data to start fresh each run
-    print("\n🗑️  Clearing previous data...")
-    db.clear_payment_advices()
-    db.clear_reconciliation_results()
+    # Stored advices are only dropped when this run rescans the whole window
+    days_back = int(os.getenv('DAYS_TO_SEARCH', 365))
+    full_rescan = '--full-rescan' in sys.argv or os.getenv('IMAP_FULL_RESCAN', 'false').lower() == 'true'
+    full_scan = extractor.will_full_scan(full_rescan)
+
+    # Cached OpenAI extractions survive the clear; drop those made with an older prompt
+    extractor.openai_extractor.invalidate_cache(all_versions='--clear-extraction-cache' in sys.argv)
 
     if not warsoft_client.enabled:
         print("\n❌ Warsoft API is not configured. Please set credentials in .env file")
         print("📋 Required: WARSOFT_ACCESS_TOKEN (or ACCESS_TOKEN)")
         return
 
-    # Step 1: Extract payment advices from inbox
-    print("\n📧 STEP 1: Extracting payment advices from inbox...")
-    days_back = int(os.getenv('DAYS_TO_SEARCH', 365))
-    payment_advices = extractor.fetch_payment_advices_from_email(days_back)
-
-    if not payment_advices:
-        print("⚠️  No payment advices found in inbox")
-    else:
-        # Store in database
-        print(f"\n💾 Storing {len(payment_advices)} payment advices in database...")
-        stored_count = 0
-        skipped_count = 0
-        for payment in payment_advices:
-            try:
-                result = db.insert_payment_advice(payment)
-                inv_num = payment.get('invoice_number', 'Unknown')
-                if result is not None:
-                    # Successfully stored (not a duplicate)
-                    stored_count += 1
-                    print(f"   ✅ Stored: Invoice {inv_num} - ₹{payment.get('payment_amount', 0)}")
-                else:
-                    # Skipped duplicate (already printed by database function)
-                    skipped_count += 1
-            except Exception as e:
-                print(f"   ⚠️  Error storing payment: {e}")
-
-        print(f"\n📊 Storage Summary: {stored_count} stored, {skipped_count} duplicates skipped")
-
-    # Step 2: Sync invoices from Warsoft
-    print("\n📥 STEP 2: Syncing unpaid invoices from Warsoft...")
-    sync_invoices_from_warsoft(db, warsoft_client)
-
-    # Step 2.5: Load invoice cache into memory for fast reconciliation
-    print("\n🚀 OPTIMIZATION: Loading invoice cache into memory...")
-    cache_count = reconciler.load_invoice_cache()
+    # Step 1: Reconcile against the last invoice snapshot at once; a stale one is
+    # refreshed from Warsoft in the background and swapped in between advices
+    print("\n📥 STEP 1: Loading Warsoft invoice snapshot...")
+    snapshot = InvoiceSnapshot(db, warsoft_client)
+    cache_count = snapshot.open(reconciler, force_refresh='--refresh-invoices' in sys.argv)
     print(f"   ⚡ Ready for high-speed reconciliation with {cache_count} invoices in memory")
 
-    # Step 3: Reconciliation (now 50-100x faster with in-memory cache!)
-    print("\n🔄 STEP 3: Reconciling payments with invoices by invoice number...")
-    results = reconciler.reconcile_all_pending()
+    # Advices kept from earlier runs get another chance against the loaded snapshot
+    results = []
+    if not full_scan:
+        merge_results(results, reconciler.rereconcile_not_found())
+
+    def on_full_scan():
+        # The whole window is ingested again (first run, full rescan or a UIDVALIDITY
+        # change); cleared only once the inbox search has succeeded
+        clear_run_data(db)
+        results.clear()
+
+    # Steps 2-3: Store and reconcile each payment advice as soon as it is extracted,
+    # so only one advice's PDF is held in memory at a time
+    print("\n📧 STEP 2: Streaming payment advices from inbox and reconciling...")
+    stored_count = 0
+    skipped_count = 0
+    for payment in extractor.iter_payment_advices_from_email(days_back, full_rescan=full_rescan,
+                                                             on_full_scan=on_full_scan):
+        try:
+            payment_id = db.insert_payment_advice(payment)
+            inv_num = payment.get('invoice_number', 'Unknown')
+            if payment_id is None:
+                # Skipped duplicate (already printed by database function)
+                skipped_count += 1
+                continue
+            stored_count += 1
+            print(f"   ✅ Stored: Invoice {inv_num} - ₹{payment.get('payment_amount', 0)}")
+        except Exception as e:
+            print(f"   ⚠️  Error storing payment: {e}")
+            continue
+
+        payment['id'] = payment_id
+        merge_results(results, snapshot.poll(reconciler))
+        if snapshot.needs_sync(reconciler, payment.get('invoice_number')):
+            continue  # Stays PENDING until the targeted sync below
+        results.append(reconciler.reconcile_and_record(payment))
 
+    if snapshot.targeted:
+        merge_results(results, snapshot.sync_pending(reconciler))
+    else:
+        # Advices an interrupted run stored but never reconciled are still PENDING
+        merge_results(results, reconciler.reconcile_all_pending())
+
+    # Finish the background refresh so the snapshot is current for the next run and
+    # advices that were NOT_FOUND in the old version get another chance
+    if snapshot.refreshing():
+        print("\n⏳ Waiting for the background invoice refresh to finish...")
+        snapshot.wait()
+    merge_results(results, snapshot.poll(reconciler))
+
+    print(f"\n📊 Storage Summary: {stored_count} stored, {skipped_count} duplicates skipped")
+    openai_extractor = extractor.openai_extractor
+    print(f"💵 OpenAI cost: ${openai_extractor.get_total_cost():.4f} "
+          f"({openai_extractor.cache_hits} cache hits saved ~${openai_extractor.saved_cost:.4f}, "
+          f"{openai_extractor.template_hits} layout template hits, "
+          f"{openai_extractor.local_hits} PDFs parsed locally)")
+    print(f"✂️  Page pruning: {openai_extractor.get_pruning_summary()}")
+    print(f"🔁 OpenAI retries: {openai_extractor.retry_policy.summary()}")
+    print(f"🧭 Model routing: {openai_extractor.router.summary()}")
     if not results:
         print("⚠️  No payments to reconcile")
         return
 
-    # Step 4: Generate Excel report
-    print("\n📊 STEP 4: Generating Excel report...")
+    print(f"\n✅ Reconciliation complete: {len(results)} payments processed")
+    reconciler.print_upload_summary(results)
+
+    # Step 3: Generate Excel report
+    print("\n📊 STEP 3: Generating Excel report...")
     report_file = generate_excel_report(db)
 
-    # Step 5: Generate separate report for payment advices without invoice numbers
+    # Step 4: Generate separate report for payment advices without invoice numbers
     no_invoice_file = generate_no_invoice_report(db)
 
     # Print summary
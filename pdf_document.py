@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Single-pass PDF handling for payment advices
+Parses a PDF once and reports encryption, page count, the decrypted bytes
+and the text layer; the same reader is reused for page pruning and
+chunking. Remembers which configured password opened each sender's PDFs
+so it is tried first next time.
+"""
+import io
+import sys
+import threading
+import time
+import PyPDF2
+from email_classifier import sender_address
+from pdf_text_parser import extract_text
+
+
+def mask_password(password):
+    return password[:3] + '***' if password else '<empty>'
+
+
+class PdfDocument:
+    """A PDF parsed once
+
+    Attributes:
+        data: PDF bytes to hash and send (a decrypted copy if the original was encrypted)
+        encrypted: True if the original was password-protected
+        password_index: Candidate password that opened it (see candidate_passwords)
+        page_count: Number of pages, None if PyPDF2 could not parse the PDF
+        error: Why the PDF could not be parsed
+    """
+
+    def __init__(self, data, encrypted=False, password_index=None, page_count=None, reader=None, error=None):
+        self.data = data
+        self.encrypted = encrypted
+        self.password_index = password_index
+        self.page_count = page_count
+        self.error = error
+        self.pages = None
+        self._reader = reader
+
+    def __getstate__(self):
+        # Readers do not pickle; one is re-opened on demand after crossing a process boundary
+        state = self.__dict__.copy()
+        state['_reader'] = None
+        return state
+
+    @property
+    def reader(self):
+        """PdfReader over the (decrypted) PDF, None if it could not be parsed"""
+        if self._reader is None and self.page_count is not None:
+            self._reader = PyPDF2.PdfReader(io.BytesIO(self.data))
+        return self._reader
+
+    def text(self):
+        """Text of every page, read once ([] if there is no text layer to read)"""
+        if self.pages is None:
+            self.pages = []
+            if self.reader is not None:
+                try:
+                    self.pages = extract_text(self.reader)
+                except Exception as e:
+                    print(f"   ⚠️  Could not read PDF text layer: {e}")
+        return self.pages
+
+    def subset(self, indices):
+        """PDF bytes with only the pages at `indices` (0-based, in that order)"""
+        writer = PyPDF2.PdfWriter()
+        for index in indices:
+            writer.add_page(self.reader.pages[index])
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
+
+
+def candidate_passwords(passwords, first=None):
+    """(index, password) pairs to try: the empty password, then `passwords`,
+    with the candidate at index `first` moved to the front"""
+    candidates = list(enumerate([''] + list(passwords)))
+    if first is not None and 0 <= first < len(candidates):
+        candidates.insert(0, candidates.pop(first))
+    return candidates
+
+
+def open_pdf(pdf_data, passwords, first_password=None):
+    """Parse a PDF once, decrypting it with the first candidate password that works
+
+    Unencrypted PDFs are kept byte-for-byte; only an encrypted PDF is
+    re-serialized (the model cannot read it otherwise).
+
+    Args:
+        pdf_data: Binary PDF data (may be encrypted)
+        passwords: Configured PDF passwords (tried after the empty password)
+        first_password: Index of the candidate to try first (PasswordHints)
+
+    Returns:
+        PdfDocument | None: None if the PDF is encrypted and no password opens it
+    """
+    try:
+        reader = PyPDF2.PdfReader(io.BytesIO(pdf_data))
+        if not reader.is_encrypted:
+            return PdfDocument(pdf_data, page_count=len(reader.pages), reader=reader)
+    except Exception as e:
+        # PyPDF2 cannot parse it; the model may still cope, so it is sent as is
+        return PdfDocument(pdf_data, error=str(e))
+
+    for index, password in candidate_passwords(passwords, first_password):
+        try:
+            if not reader.decrypt(password):
+                continue
+            writer = PyPDF2.PdfWriter()
+            for page in reader.pages:
+                writer.add_page(page)
+            decrypted = io.BytesIO()
+            writer.write(decrypted)
+        except Exception:
+            continue
+        return PdfDocument(decrypted.getvalue(), encrypted=True, password_index=index,
+                           page_count=len(reader.pages), reader=reader)
+    return None
+
+
+def load_pdf(pdf_data, passwords, first_password=None):
+    """open_pdf() plus the text layer, in one call (the unit of work for a process pool)"""
+    document = open_pdf(pdf_data, passwords, first_password)
+    if document is not None:
+        document.text()
+    return document
+
+
+class PasswordHints:
+    """Which candidate password last opened each sender's PDFs
+
+    Only the candidate's index is stored, never the password. If the
+    configured passwords change, a stale hint just costs a wrong first try.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self.hints = {}
+        self._lock = threading.Lock()
+        if db is not None:
+            self.hints = {row['sender']: row['password_index'] for row in db.get_pdf_password_hints()}
+
+    def first(self, sender):
+        """Candidate index to try first for PDFs from `sender` (None if unknown)"""
+        return self.hints.get(sender_address(sender)) if sender else None
+
+    def record(self, sender, password_index):
+        """Remember the candidate that opened a PDF from `sender`"""
+        address = sender_address(sender) if sender else ''
+        if not address or password_index is None:
+            return
+        with self._lock:
+            if self.hints.get(address) == password_index:
+                return
+            self.hints[address] = password_index
+        if self.db is not None:
+            self.db.save_pdf_password_hint(address, password_index)
+
+
+if __name__ == "__main__":
+    # Usage: python pdf_document.py <pdf> [<pdf> ...]  (passwords from PDF_PASSWORD_1/2)
+    import os
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    if len(sys.argv) < 2:
+        print("Usage: python pdf_document.py <pdf> [<pdf> ...]")
+        sys.exit(1)
+
+    passwords = [os.getenv('PDF_PASSWORD_1', '253538'), os.getenv('PDF_PASSWORD_2', '502000')]
+    for path in sys.argv[1:]:
+        with open(path, 'rb') as f:
+            pdf_data = f.read()
+        started = time.perf_counter()
+        document = load_pdf(pdf_data, passwords)
+        elapsed = (time.perf_counter() - started) * 1000
+        if document is None:
+            print(f"❌ {path}: encrypted, no configured password opens it")
+            continue
+        opened = f"encrypted, password #{document.password_index}" if document.encrypted else "not encrypted"
+        print(f"📄 {path}: {opened}, {document.page_count} page(s), "
+              f"{sum(len(page) for page in document.text())} text chars, {elapsed:.1f} ms"
+              + (f" - {document.error}" if document.error else ""))
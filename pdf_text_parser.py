@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Local text-layer parser for payment advice PDFs
+Reads the PDF's text with PyPDF2 and extracts invoices, amounts, dates and
+bank references with regular expressions. Returns the same
+{"invoices": [...], "common_details": {...}} shape as the OpenAI extractor
+plus a confidence score, so the LLM is only needed when the score is low.
+"""
+import io
+import json
+import re
+import sys
+import time
+from datetime import datetime
+import PyPDF2
+
+# Invoice numbers: 23EXT1126/1572, 11HB234/5678, 15HBT567/8901 (may wrap after the slash)
+INVOICE_RE = re.compile(r'(?<![A-Z0-9])(\d{1,2}(?:EXT|HBT|HB)\d+)\s*/\s*(\d+)(?!\d)', re.IGNORECASE)
+
+# 8,644.00 / 1,23,456.50 / 8644.00 - bare integers are too ambiguous to count as amounts
+AMOUNT_RE = re.compile(r'(?<![\d.,/])(\d{1,3}(?:,\d{2,3})+(?:\.\d{1,2})?|\d+\.\d{2})(?![\d/]|\.\d)')
+
+DATE_RE = re.compile(
+    r'(?<!\d)(?:(\d{4})-(\d{1,2})-(\d{1,2})'
+    r'|(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})'
+    r'|(\d{1,2})[- ]?([A-Za-z]{3})[A-Za-z]*[- ,]*(\d{4}))(?!\d)')
+
+MONTHS = {m: i for i, m in enumerate(
+    ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}
+
+PAYMENT_DATE_RE = re.compile(r'(?:payment|value|transaction|credit|advice)\s*date', re.IGNORECASE)
+
+# Labelled references first, then bare NEFT/RTGS UTRs (IFSC bank code + digits)
+LABELLED_REFERENCE_RE = re.compile(
+    r'\b(?:UTR|Reference|Ref\.?|Transaction\s*ID|Txn\.?\s*ID)\s*(?:No\.?|Number|#)?\s*[:\-]?\s*'
+    r'([A-Z0-9]*\d[A-Z0-9]*)', re.IGNORECASE)
+UTR_RE = re.compile(r'\b([A-Z]{4}[A-Z0-9]\d{9,20})\b')
+
+CUSTOMER_RE = re.compile(
+    r'(?:Remitter\s*Name|Remitter|Payer\s*Name|Payer|Customer\s*Name|Paid\s*By)\s*[:\-]\s*([^\n]+)', re.IGNORECASE)
+
+# Bank names found in the text, and the IFSC code that starts their UTRs
+BANKS = (
+    ('citi', 'CITI', 'Citibank'),
+    ('hsbc', 'HSBC', 'HSBC'),
+    ('state bank of india', 'SBIN', 'State Bank of India'),
+    ('standard chartered', 'SCBL', 'Standard Chartered'),
+    ('hdfc', 'HDFC', 'HDFC Bank'),
+    ('icici', 'ICIC', 'ICICI Bank'),
+    ('axis bank', 'UTIB', 'Axis Bank'),
+    ('kotak', 'KKBK', 'Kotak Mahindra Bank'),
+    ('yes bank', 'YESB', 'Yes Bank'),
+    ('deutsche', 'DEUT', 'Deutsche Bank'),
+)
+
+
+def extract_text(pdf):
+    """Text of every page (PDF bytes or an open, decrypted PdfReader)"""
+    reader = pdf if isinstance(pdf, PyPDF2.PdfReader) else PyPDF2.PdfReader(io.BytesIO(pdf))
+    pages = []
+    for page in reader.pages:
+        try:
+            pages.append(page.extract_text() or '')
+        except Exception:
+            pages.append('')
+    return pages
+
+
+def _to_amount(text):
+    return float(text.replace(',', ''))
+
+
+def _to_iso_date(match):
+    """YYYY-MM-DD for a DATE_RE match (day-first for numeric dates), None if invalid"""
+    try:
+        if match.group(1):
+            year, month, day = int(match.group(1)), int(match.group(2)), int(match.group(3))
+        elif match.group(6):
+            day, month, year = int(match.group(4)), int(match.group(5)), int(match.group(6))
+        else:
+            month = MONTHS.get(match.group(8)[:3].lower())
+            if month is None:
+                return None
+            day, year = int(match.group(7)), int(match.group(9))
+        return datetime(year, month, day).strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def date_matches(text):
+    """(offset, YYYY-MM-DD) for every valid date in `text`"""
+    return [(m.start(), d) for m, d in ((m, _to_iso_date(m)) for m in DATE_RE.finditer(text)) if d]
+
+
+def amount_matches(text):
+    """(offset, amount) for every amount in `text`, ignoring anything that is part of a date"""
+    undated = DATE_RE.sub(lambda m: ' ' * len(m.group()), text)
+    return [(m.start(), _to_amount(m.group(1))) for m in AMOUNT_RE.finditer(undated)]
+
+
+def dates_in(text):
+    return [d for _, d in date_matches(text)]
+
+
+def amounts_in(text):
+    return [a for _, a in amount_matches(text)]
+
+
+def _assign_amounts(amounts):
+    """Map a table row's amounts to (bill, tds, net, consistent)
+
+    Three amounts where two add up to the third are unambiguous: the largest
+    is the bill amount, the larger remainder the net amount, the smaller the
+    TDS. Otherwise the last amount is taken as the net amount.
+    """
+    for i, bill in enumerate(amounts):
+        others = amounts[:i] + amounts[i + 1:]
+        for j in range(len(others)):
+            for k in range(j + 1, len(others)):
+                x, y = others[j], others[k]
+                if bill >= max(x, y) and abs(x + y - bill) < 0.015:
+                    return bill, min(x, y), max(x, y), True
+    if amounts:
+        return None, None, amounts[-1], False
+    return None, None, None, False
+
+
+def invoice_rows(text):
+    """(invoice_number, row_text) per invoice occurrence; a row is the rest of
+    the line, plus the next line when the row wrapped before its amounts"""
+    matches = list(INVOICE_RE.finditer(text))
+    rows = []
+    for idx, match in enumerate(matches):
+        end = matches[idx + 1].start() if idx + 1 < len(matches) else len(text)
+        lines = text[match.end():end].split('\n')
+        row = lines[0]
+        if not amounts_in(row) and len(lines) > 1:
+            row = f"{row} {lines[1]}"
+        # Columns before the invoice number (e.g. a date), but not the previous row
+        line_start = text.rfind('\n', 0, match.start()) + 1
+        if idx:
+            line_start = max(line_start, matches[idx - 1].end())
+        prefix = text[line_start:match.start()]
+        rows.append((f"{match.group(1).upper()}/{match.group(2)}", f"{prefix} {row}"))
+    return rows
+
+
+def _bank_reference(text):
+    for match in LABELLED_REFERENCE_RE.finditer(text):
+        candidate = match.group(1).upper()
+        if 10 <= len(candidate) <= 25 and not INVOICE_RE.fullmatch(candidate):
+            return candidate
+    match = UTR_RE.search(text)
+    return match.group(1) if match else None
+
+
+def _bank_name(text, reference):
+    lowered = text.lower()
+    for needle, code, name in BANKS:
+        if needle in lowered:
+            return name
+    for needle, code, name in BANKS:
+        if reference and reference.startswith(code):
+            return name
+    return None
+
+
+def _customer_name(text):
+    match = CUSTOMER_RE.search(text)
+    if not match:
+        return None
+    # Drop neighbouring columns that the text layer put on the same line
+    name = re.split(r'\s{2,}|\t', match.group(1).strip())[0].strip(' :-')
+    return name or None
+
+
+def _total_amount(text):
+    """Largest amount on a line mentioning a total, if any"""
+    totals = []
+    for line in text.split('\n'):
+        if 'total' in line.lower() and not INVOICE_RE.search(line):
+            totals.extend(amounts_in(line))
+    return max(totals) if totals else None
+
+
+def parse_advice_text(text):
+    """Parse the text layer of a payment advice
+
+    Returns:
+        tuple: (result, confidence) - result has the OpenAI extractor's shape,
+               confidence is 0.0-1.0 (0.0 when no invoice number was found)
+    """
+    invoices = []
+    consistent = 0
+    seen = set()
+    for invoice_number, row in invoice_rows(text):
+        bill, tds, net, is_consistent = _assign_amounts(amounts_in(row))
+        if invoice_number in seen and net is None:
+            continue  # Repeated in a header or footer
+        seen.add(invoice_number)
+        consistent += is_consistent
+        row_dates = dates_in(row)
+        invoices.append({
+            'invoice_number': invoice_number,
+            'net_payment_amount': net,
+            'bill_amount': bill,
+            'tds_amount': tds,
+            'invoice_date': row_dates[0] if row_dates else None
+        })
+
+    first_invoice = INVOICE_RE.search(text)
+    header = text[:first_invoice.start()] if first_invoice else text
+    payment_date = None
+    for line in text.split('\n'):
+        if PAYMENT_DATE_RE.search(line) and dates_in(line):
+            payment_date = dates_in(line)[0]
+            break
+    header_dates = dates_in(header)
+    transaction_date = payment_date or (header_dates[0] if header_dates else None)
+
+    reference = _bank_reference(text)
+    total = _total_amount(text)
+    result = {
+        'invoices': invoices,
+        'common_details': {
+            'transaction_date': transaction_date,
+            'payment_date': payment_date or transaction_date,
+            'bank_name': _bank_name(text, reference),
+            'bank_reference_number': reference,
+            'customer_name': _customer_name(text),
+            'utr_number': None,
+            'total_payment_amount': total
+        }
+    }
+
+    if not invoices:
+        return result, 0.0
+
+    with_net = [inv['net_payment_amount'] for inv in invoices if inv['net_payment_amount'] is not None]
+    if total is None:
+        total_score = 0.5
+    else:
+        total_score = 1.0 if abs(sum(with_net) - total) < 1 else 0.0
+
+    confidence = (0.4 * len(with_net) / len(invoices) +
+                  0.3 * consistent / len(invoices) +
+                  0.15 * (reference is not None) +
+                  0.15 * total_score)
+    if total is not None and total_score == 0.0:
+        # The total disagrees with the rows: an invoice was probably missed
+        confidence = min(confidence, 0.5)
+    return result, round(confidence, 3)
+
+
+def relevant_pages(pages):
+    """Indices of the pages worth sending to the model
+
+    Page 1 (advice header) is always kept, plus every page with an invoice
+    number, a bank reference or a total. Cover, terms and image-only pages
+    are dropped.
+
+    Returns:
+        list | None: Page indices, or None if nothing can be dropped safely
+                     (no invoice number in the text layer, or every page is relevant)
+    """
+    if not any(INVOICE_RE.search(page) for page in pages):
+        return None
+    keep = [index for index, page in enumerate(pages)
+            if index == 0 or INVOICE_RE.search(page) or _bank_reference(page) or _total_amount(page) is not None]
+    return keep if len(keep) < len(pages) else None
+
+
+def parse_pdf(pdf):
+    """parse_advice_text() over all pages of a PDF (bytes or decrypted PdfReader)"""
+    return parse_advice_text('\n'.join(extract_text(pdf)))
+
+
+if __name__ == "__main__":
+    # Usage: python pdf_text_parser.py <pdf> [<pdf> ...]  (PDFs must not be encrypted)
+    if len(sys.argv) < 2:
+        print("Usage: python pdf_text_parser.py <pdf> [<pdf> ...]")
+        sys.exit(1)
+
+    for path in sys.argv[1:]:
+        with open(path, 'rb') as f:
+            pdf_data = f.read()
+        started = time.perf_counter()
+        result, confidence = parse_pdf(pdf_data)
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"\n📄 {path}: {len(result['invoices'])} invoice(s), confidence {confidence:.2f}, {elapsed:.1f} ms")
+        print(json.dumps(result, indent=2))
@@ -17,12 +17,17 @@ class ReconciliationEngine:
         self.blob_storage = BlobStorageClient()  # Add blob storage client
         self.auto_write_matched = auto_write_matched
         self.invoice_cache = {}  # In-memory cache for fast lookups
+        self.snapshot_version = None  # invoice_snapshots version the cache holds
 
-    def load_invoice_cache(self):
+    def load_invoice_cache(self, snapshot_version=None):
         """Load all Warsoft invoices from database into memory cache
 
-        This should be called ONCE after syncing invoices from Warsoft.
+        This should be called ONCE after syncing invoices from Warsoft
+        (and again when InvoiceSnapshot switches to a newer version).
         Makes reconciliation 50-100x faster by avoiding database lookups.
+
+        Args:
+            snapshot_version: Snapshot version of the invoices, recorded on each result
         """
         print("📥 Loading invoice cache into memory...")
 
@@ -30,14 +35,33 @@ class ReconciliationEngine:
         invoices = self.db.get_all_warsoft_invoices()
 
         # Build in-memory lookup dictionary
-        self.invoice_cache = {}
+        invoice_cache = {}
         for inv in invoices:
             invoice_dict = dict(inv)
-            self.invoice_cache[invoice_dict['invoice_number']] = invoice_dict
+            invoice_cache[invoice_dict['invoice_number']] = invoice_dict
+        self.invoice_cache = invoice_cache
+        self.snapshot_version = snapshot_version
 
         print(f"✅ Loaded {len(self.invoice_cache)} invoices into memory cache")
         return len(self.invoice_cache)
 
+    def apply_invoice_changes(self, rows, removed, snapshot_version):
+        """Update the cache in place with a snapshot delta instead of reloading every invoice
+
+        Args:
+            rows: warsoft_invoices rows that were added or changed
+            removed: Invoice numbers that were deleted
+            snapshot_version: Snapshot version after the delta
+        """
+        for row in rows:
+            invoice_dict = dict(row)
+            self.invoice_cache[invoice_dict['invoice_number']] = invoice_dict
+        for invoice_number in removed:
+            self.invoice_cache.pop(invoice_number, None)
+        self.snapshot_version = snapshot_version
+        print(f"✅ Invoice cache: {len(rows)} added/changed, {len(removed)} removed "
+              f"({len(self.invoice_cache)} invoices)")
+
     def reconcile_payment(self, payment_advice):
         """Reconcile a single payment advice with Warsoft invoice
 
@@ -101,6 +125,15 @@ class ReconciliationEngine:
         else:
             match_status = 'UNMATCHED'
 
+        if self.auto_write_matched and match_status == 'MATCHED' and not already_paid and amount_match:
+            # The cache can trail a payment written since it was loaded (another run, the daemon or API server)
+            stored = self.db.get_warsoft_invoice_by_number(invoice['invoice_number'])
+            if stored is None or stored['status'] == 'paid':
+                discrepancies.append("Invoice already paid (payment written to Warsoft since the snapshot)"
+                                     if stored is not None else "Invoice no longer unpaid in Warsoft")
+                invoice['status'] = 'paid'
+                already_paid = True
+
         # AUTO-WRITE TO WARSOFT: If perfect match and not already paid and feature enabled
         if self.auto_write_matched and match_status == 'MATCHED' and not already_paid and amount_match:
             invoice_number = invoice.get('invoice_number', '')
@@ -270,6 +303,9 @@ class ReconciliationEngine:
 
             if success:
                 discrepancies.append("✅ WRITTEN TO WARSOFT")
+                # Stays in the snapshot until the next complete sync: a re-sent advice must not pay it twice
+                self.db.mark_warsoft_invoice_paid(invoice_number)
+                invoice['status'] = 'paid'
             else:
                 discrepancies.append("⚠️ Failed to write to Warsoft")
 
@@ -295,49 +331,96 @@ class ReconciliationEngine:
             'discrepancy_notes': notes,
             'reconciled_by': 'SYSTEM',
             'pdf_filename': payment.get('blob_filename') or payment.get('pdf_filename'),
-            'blob_url': payment.get('blob_url')
+            'blob_url': payment.get('blob_url'),
+            'snapshot_version': self.snapshot_version
         }
 
     def reconcile_all_pending(self):
-        """Reconcile all pending payment advices"""
-        print("🔄 Starting reconciliation process...")
+        """Reconcile all pending payment advices
 
+        Reporting is left to the caller, which merges these results with the
+        rest of its run before printing a summary.
+        """
         pending_payments = self.db.get_pending_payment_advices()
         print(f"📊 Found {len(pending_payments)} pending payment advices")
 
         results = []
         for payment in pending_payments:
-            payment_dict = dict(payment)
-            print(f"\n💰 Processing payment for invoice: {payment_dict.get('invoice_number', 'Unknown')}")
-
-            result = self.reconcile_payment(payment_dict)
-            result_id = self.db.insert_reconciliation_result(result)
-
-            # Update payment status
-            status_map = {
-                'MATCHED': 'RECONCILED',
-                'PARTIAL_MATCH': 'REVIEW_REQUIRED',
-                'NOT_FOUND': 'NOT_FOUND',
-                'UNMATCHED': 'UNMATCHED'
-            }
+            results.append(self.reconcile_and_record(dict(payment)))
 
-            new_status = status_map.get(result['match_status'], 'PENDING')
-            self.db.update_payment_status(payment_dict['id'], new_status)
+        return results
 
-            print(f"   Status: {result['match_status']}")
-            print(f"   Confidence: {result['confidence_score']}%")
-            print(f"   Notes: {result['discrepancy_notes']}")
+    def reconcile_and_record(self, payment_dict, replace=False):
+        """Reconcile one stored payment advice and record the outcome
 
-            results.append(result)
+        Inserts the reconciliation result and moves the payment out of PENDING.
+        `payment_dict` must carry the payment_advices row id.
 
-        # Upload summary
+        Args:
+            replace: Delete the payment's earlier reconciliation results first
+
+        Returns:
+            dict: The reconciliation result
+        """
+        print(f"\n💰 Processing payment for invoice: {payment_dict.get('invoice_number', 'Unknown')}")
+
+        result = self.reconcile_payment(payment_dict)
+        if replace:
+            self.db.delete_reconciliation_results(payment_dict['id'])
+        self.db.insert_reconciliation_result(result)
+
+        # Update payment status
+        status_map = {
+            'MATCHED': 'RECONCILED',
+            'PARTIAL_MATCH': 'REVIEW_REQUIRED',
+            'NOT_FOUND': 'NOT_FOUND',
+            'UNMATCHED': 'UNMATCHED'
+        }
+
+        new_status = status_map.get(result['match_status'], 'PENDING')
+        self.db.update_payment_status(payment_dict['id'], new_status)
+
+        print(f"   Status: {result['match_status']}")
+        print(f"   Confidence: {result['confidence_score']}%")
+        print(f"   Notes: {result['discrepancy_notes']}")
+
+        return result
+
+    def rereconcile_not_found(self, invoice_numbers=None):
+        """Reconcile NOT_FOUND payment advices again if their invoice is now in the cache
+
+        Called after switching to a newer invoice snapshot; the new result
+        replaces the NOT_FOUND one.
+
+        Args:
+            invoice_numbers: Only consider these invoices (those a snapshot delta added or changed)
+
+        Returns:
+            list: The new reconciliation results
+        """
+        payment_ids = [row['id'] for row in self.db.get_not_found_payment_advices()
+                       if row['invoice_number'] in self.invoice_cache and
+                       (invoice_numbers is None or row['invoice_number'] in invoice_numbers)]
+        if not payment_ids:
+            return []
+
+        print(f"🔁 {len(payment_ids)} NOT_FOUND payment(s) now have an invoice in snapshot "
+              f"v{self.snapshot_version} - reconciling again")
+        results = []
+        for payment_id in payment_ids:
+            payment = self.db.get_payment_advice(payment_id)
+            if payment is not None:
+                results.append(self.reconcile_and_record(dict(payment), replace=True))
+        return results
+
+    @staticmethod
+    def print_upload_summary(results):
+        """Print how many matched payment PDFs were uploaded to blob storage"""
         uploaded_count = sum(1 for r in results if r.get('blob_url'))
         failed_count = len([r for r in results if r.get('match_status') == 'MATCHED']) - uploaded_count
-        
-        print(f"\n✅ Reconciliation complete: {len(results)} payments processed")
+
         print(f"\n📊 BLOB UPLOAD SUMMARY:")
         print(f"   ✅ PDFs uploaded to blob storage: {uploaded_count}")
         if failed_count > 0:
             print(f"   ⚠️  Upload failures: {failed_count}")
-        
-        return results
+
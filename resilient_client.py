@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Retries and adaptive concurrency for Azure OpenAI requests
+Failures are classified as throttling (429), transient (timeouts, dropped
+connections, 5xx) or permanent (bad request, auth, quota). Throttled
+requests wait for Retry-After, transient ones back off exponentially with
+jitter, and the number of concurrent requests adapts AIMD-style so the
+pipeline runs just under the deployment's throttle point.
+"""
+import asyncio
+import itertools
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import openai
+
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+
+class RetriesExhausted(Exception):
+    """A request kept being throttled or failing transiently; it can succeed on a later run"""
+
+    def __init__(self, kind, attempts, error):
+        super().__init__(f"{kind} after {attempts} attempt(s): {error}")
+        self.kind = kind
+        self.attempts = attempts
+        self.error = error
+
+
+def classify_error(error):
+    """THROTTLED, TRANSIENT or PERMANENT for an exception raised by the OpenAI client"""
+    if isinstance(error, openai.APIConnectionError):  # Includes timeouts
+        return TRANSIENT
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code == 429:
+            # An exhausted quota is not cleared by waiting a few seconds
+            return PERMANENT if getattr(error, 'code', None) == 'insufficient_quota' else THROTTLED
+        if error.status_code in (408, 409) or error.status_code >= 500:
+            return TRANSIENT
+    return PERMANENT
+
+
+def retry_after_seconds(error):
+    """Delay the server asked for (Retry-After-Ms / Retry-After), None if it gave none"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Retries throttled and transient failures; permanent ones are raised at once
+
+    After OPENAI_MAX_ATTEMPTS attempts RetriesExhausted is raised, so the
+    caller can defer the advice to the next run instead of dropping it.
+    """
+
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None):
+        self.max_attempts = max(1, max_attempts or int(os.getenv('OPENAI_MAX_ATTEMPTS', 6)))
+        self.base_delay = base_delay if base_delay is not None else float(os.getenv('OPENAI_RETRY_BASE_SECONDS', 1.0))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv('OPENAI_RETRY_MAX_SECONDS', 60))
+        self.stats = {'retries': 0, THROTTLED: 0, TRANSIENT: 0, 'exhausted': 0}
+        self._lock = threading.Lock()
+
+    def delay(self, attempt, error, kind):
+        """Seconds to wait after failed attempt number `attempt`
+
+        Throttled requests wait for Retry-After (plus a little jitter so the
+        waiting requests do not all return at once); everything else uses
+        full-jitter exponential backoff.
+        """
+        if kind == THROTTLED:
+            hinted = retry_after_seconds(error)
+            if hinted is not None:
+                return min(self.max_delay, hinted + random.uniform(0, self.base_delay))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _after_failure(self, error, attempt):
+        """Classify a failed attempt and return (kind, seconds to wait); raise if it must not be retried"""
+        kind = classify_error(error)
+        if kind == PERMANENT:
+            raise error
+        with self._lock:
+            self.stats[kind] += 1
+            exhausted = attempt >= self.max_attempts
+            self.stats['exhausted' if exhausted else 'retries'] += 1
+        if exhausted:
+            raise RetriesExhausted(kind, attempt, error) from error
+        wait = self.delay(attempt, error, kind)
+        status = getattr(error, 'status_code', None) or type(error).__name__
+        print(f"   ⏳ Azure OpenAI {kind} ({status}); retry {attempt}/{self.max_attempts - 1} in {wait:.1f}s")
+        return kind, wait
+
+    def call(self, request):
+        """Return request(), retrying in this thread"""
+        for attempt in itertools.count(1):
+            try:
+                return request()
+            except Exception as error:
+                _, wait = self._after_failure(error, attempt)
+            time.sleep(wait)
+
+    async def call_async(self, request, concurrency=None):
+        """Return await request(), retrying; each attempt holds a slot of `concurrency` (AdaptiveConcurrency)"""
+        for attempt in itertools.count(1):
+            try:
+                if concurrency is None:
+                    return await request()
+                async with concurrency:
+                    response = await request()
+                    concurrency.succeeded()
+                    return response
+            except Exception as error:
+                kind, wait = self._after_failure(error, attempt)
+                if concurrency is not None and kind == THROTTLED:
+                    concurrency.throttled()
+            await asyncio.sleep(wait)
+
+    def summary(self):
+        return (f"{self.stats['retries']} retries ({self.stats[THROTTLED]} throttled, "
+                f"{self.stats[TRANSIENT]} transient), {self.stats['exhausted']} deferred")
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on concurrent requests, used like an asyncio.Semaphore
+
+    Starts at `maximum`. A throttled response halves the limit - once per
+    `cooldown` seconds, since a burst of 429s is one signal - and every
+    `limit` successful requests raise it by one, up to `maximum` again.
+    Create it inside the event loop that uses it.
+    """
+
+    def __init__(self, maximum, minimum=1, cooldown=2.0):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.cooldown = cooldown
+        self.limit = float(self.maximum)
+        self.lowest = self.maximum
+        self.in_flight = 0
+        self._last_decrease = float('-inf')
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def succeeded(self):
+        """Additive increase: +1 per `limit` successes"""
+        if self.limit >= self.maximum:
+            return
+        before = int(self.limit)
+        self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+        if int(self.limit) > before:
+            print(f"   📈 Concurrency limit raised to {int(self.limit)}")
+
+    def throttled(self):
+        """Multiplicative decrease: halve the limit (once per cooldown)"""
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        before = int(self.limit)
+        self.limit = max(float(self.minimum), self.limit / 2)
+        self.lowest = min(self.lowest, int(self.limit))
+        if int(self.limit) < before:
+            print(f"   📉 Throttled: concurrency limit {before} -> {int(self.limit)}")
@@ -3,19 +3,35 @@
 Warsoft API Client for invoice reconciliation
 """
 import os
+import sys
 import json
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
+from http_transport import http_session
 
 load_dotenv()
 
+# Attempts per probe in _fetch_pages_concurrently before a failing page ends the crawl
+PROBE_ATTEMPTS = 3
+
 
 class WarsoftClient:
     def __init__(self):
         self.access_token = os.getenv('WARSOFT_ACCESS_TOKEN') or os.getenv('ACCESS_TOKEN')
         self.read_url = os.getenv('WARSOFT_READ_URL', 'https://hbinvoiceapi.staysimplyfied.com/api/ClientInvoice/UnPaidinvoicedata')
         self.write_url = os.getenv('WARSOFT_WRITE_URL', 'https://hbinvoiceapi.staysimplyfied.com/api/ClientInvoice/Push')
+        # Pooled keep-alive connections shared by page fetches and payment pushes
+        self.http = http_session('warsoft')
+        # Failed page requests (an error page reads as "no more data", so a crawl with errors is partial)
+        self.fetch_errors = 0
+        self.last_fetch_complete = False
+        self._errors_lock = threading.Lock()
+        # Errors of the current thread only (probes run while the pool fetches other pages)
+        self._thread_errors = threading.local()
         
         if not self.access_token:
             print("❌ Warsoft API access token not configured in .env file")
@@ -32,11 +48,12 @@ class WarsoftClient:
             'Content-Type': 'application/json'
         }
 
-    def fetch_unpaid_invoices(self, page_no=1):
+    def fetch_unpaid_invoices(self, page_no=1, verbose=True):
         """Fetch unpaid invoices from Warsoft for a specific page
         
         Args:
             page_no: Page number to fetch (starts from 1)
+            verbose: Print the request and response details (errors are always printed)
             
         Returns:
             list: List of unpaid invoices, or empty list if error/no data
@@ -46,38 +63,40 @@ class WarsoftClient:
             return []
 
         try:
-            print(f"🔍 Fetching Warsoft unpaid invoices (page {page_no})...")
-            
             json_data = {"pageNo": page_no}
             
-            print(f"   📤 Request URL: {self.read_url}")
-            print(f"   📤 Request Body: {json_data}")
+            if verbose:
+                print(f"🔍 Fetching Warsoft unpaid invoices (page {page_no})...")
+                print(f"   📤 Request URL: {self.read_url}")
+                print(f"   📤 Request Body: {json_data}")
             
-            response = requests.post(
+            response = self.http.post(
                 self.read_url,
                 headers=self.get_headers(),
-                json=json_data,
-                timeout=30
+                json=json_data
             )
             
-            print(f"   📥 Response Status: {response.status_code}")
+            if verbose:
+                print(f"   📥 Response Status: {response.status_code}")
             
             response.raise_for_status()
             
             # Get raw response text first
             response_text = response.text
-            print(f"   📥 Response (first 500 chars): {response_text[:500]}")
+            if verbose:
+                print(f"   📥 Response (first 500 chars): {response_text[:500]}")
             
             # Try to parse JSON
             try:
                 data = response.json()
             except json.JSONDecodeError as je:
+                self._count_error()
                 print(f"   ❌ Failed to parse JSON: {je}")
                 print(f"   📄 Full response: {response_text}")
                 return []
             
             # Debug: Print response structure
-            if isinstance(data, dict):
+            if verbose and isinstance(data, dict):
                 print(f"   📋 Response keys: {list(data.keys())}")
             
             # Extract invoices from response
@@ -86,7 +105,8 @@ class WarsoftClient:
             # Try direct list
             if isinstance(data, list):
                 invoices = data
-                print(f"   ✅ Response is direct list with {len(invoices)} invoices")
+                if verbose:
+                    print(f"   ✅ Response is direct list with {len(invoices)} invoices")
             
             # Try dict with various keys
             elif isinstance(data, dict):
@@ -94,48 +114,81 @@ class WarsoftClient:
                 for key in ['unpaidInvoices', 'unmappedInvoices', 'data', 'invoices', 'results', 'items', 'records']:
                     if key in data and isinstance(data[key], list):
                         invoices = data[key]
-                        print(f"   ✅ Found invoices in key '{key}': {len(invoices)} invoices")
+                        if verbose:
+                            print(f"   ✅ Found invoices in key '{key}': {len(invoices)} invoices")
                         break
                 
                 # If no list found, check if the dict itself is a single invoice
                 if not invoices and 'invoiceNumber' in data:
                     invoices = [data]
-                    print(f"   ✅ Response is single invoice object")
+                    if verbose:
+                        print(f"   ✅ Response is single invoice object")
             
-            if not invoices:
+            if verbose and not invoices:
                 print(f"   ⚠️  No invoices found in response")
                 print(f"   📄 Response structure: {type(data)}")
                 if isinstance(data, dict):
                     print(f"   📄 Available keys: {list(data.keys())}")
             
-            print(f"   ✅ Fetched {len(invoices)} unpaid invoices from page {page_no}")
+            if verbose:
+                print(f"   ✅ Fetched {len(invoices)} unpaid invoices from page {page_no}")
             return invoices
 
         except requests.exceptions.RequestException as e:
+            self._count_error()
             print(f"❌ Error fetching Warsoft invoices (page {page_no}): {e}")
             if hasattr(e, 'response') and e.response is not None:
                 print(f"   Status code: {e.response.status_code}")
                 print(f"   Response: {e.response.text[:1000]}")
             return []
         except Exception as e:
+            self._count_error()
             print(f"❌ Unexpected error: {type(e).__name__}: {e}")
             return []
 
-    def fetch_all_unpaid_invoices(self):
+    def _count_error(self):
+        with self._errors_lock:
+            self.fetch_errors += 1
+        self._thread_errors.count = self._thread_error_count() + 1
+
+    def _thread_error_count(self):
+        return getattr(self._thread_errors, 'count', 0)
+
+    def fetch_all_unpaid_invoices(self, verbose=True):
         """Fetch all unpaid invoices from Warsoft across all pages
         
+        Returns:
+            list: Combined list of all unpaid invoices (see fetch_all_unpaid_invoice_pages)
+        """
+        return [invoice for _, invoices in self.fetch_all_unpaid_invoice_pages(verbose) for invoice in invoices]
+
+    def fetch_all_unpaid_invoice_pages(self, verbose=True):
+        """Fetch all unpaid invoices from Warsoft across all pages, page by page
+        
         Supports page range via environment variables:
         - START_PAGE: Starting page number (default: 1)
         - END_PAGE: Ending page number (default: unlimited)
         - MAX_PAGES_TO_FETCH: Max pages from start (legacy support)
         
+        With WARSOFT_FETCH_WORKERS > 1 pages are fetched concurrently
+        (see _fetch_pages_concurrently); the result is the same, in page order.
+        
+        Afterwards last_fetch_complete is True if every page from 1 up to
+        the first empty one was fetched without an error, i.e. the result
+        is the whole unpaid list.
+        
+        Args:
+            verbose: Print each page request and response (sequential fetch)
+        
         Returns:
-            list: Combined list of all unpaid invoices
+            list: (page_no, invoices) for each page with data, in page order
         """
+        self.last_fetch_complete = False
         if not self.enabled:
             return []
 
         print("\n📥 Fetching all unpaid invoices from Warsoft...")
+        errors_before = self.fetch_errors
         
         # Check for page range from environment variables
         start_page = int(os.getenv('START_PAGE', '1'))
@@ -153,15 +206,22 @@ class WarsoftClient:
             pages_count = end_page - start_page + 1
             print(f"   📄 Fetching pages {start_page} to {end_page} ({pages_count} pages)")
         
-        all_invoices = []
+        all_pages = []
         page_no = start_page
         has_more_data = True
+        workers = int(os.getenv('WARSOFT_FETCH_WORKERS', '1'))
+        
+        if workers > 1:
+            pages = self._fetch_pages_concurrently(start_page, end_page, workers)
+            all_pages = [(start_page + offset, invoices) for offset, invoices in enumerate(pages)]
+            page_no = start_page + len(pages)
+            has_more_data = False
         
         while has_more_data and page_no <= end_page:
-            invoices = self.fetch_unpaid_invoices(page_no)
+            invoices = self.fetch_unpaid_invoices(page_no, verbose=verbose)
             
             if invoices and len(invoices) > 0:
-                all_invoices.extend(invoices)
+                all_pages.append((page_no, invoices))
                 page_no += 1
             else:
                 has_more_data = False
@@ -170,8 +230,127 @@ class WarsoftClient:
         if page_no > end_page:
             print(f"   ⚠️  Reached end page limit ({end_page})")
         
-        print(f"✅ Fetched {len(all_invoices)} unpaid invoices from pages {start_page}-{page_no - 1} ({pages_fetched} pages)")
-        return all_invoices
+        self.last_fetch_complete = start_page == 1 and page_no <= end_page and self.fetch_errors == errors_before
+        
+        invoice_count = sum(len(invoices) for _, invoices in all_pages)
+        print(f"✅ Fetched {invoice_count} unpaid invoices from pages {start_page}-{page_no - 1} ({pages_fetched} pages)")
+        return all_pages
+
+    def iter_unpaid_invoice_pages(self, max_pages=None, verbose=False):
+        """Yield (page_no, invoices) from page 1 on, one request at a time, until a page is empty
+        
+        The caller can stop early. last_fetch_complete becomes True only if
+        paging reached the empty page without an error.
+        
+        Args:
+            max_pages: Stop after this many pages
+        """
+        self.last_fetch_complete = False
+        if not self.enabled:
+            return
+        errors_before = self.fetch_errors
+        page_no = 1
+        while max_pages is None or page_no <= max_pages:
+            invoices = self.fetch_unpaid_invoices(page_no, verbose=verbose)
+            if not invoices:
+                self.last_fetch_complete = self.fetch_errors == errors_before
+                return
+            yield page_no, invoices
+            page_no += 1
+
+    def _fetch_pages_concurrently(self, start_page, end_page, workers):
+        """Fetch pages from start_page on with a pool of `workers` threads
+        
+        The last page is found by probing on this thread: end_page first
+        (if it has data, every page of the range does), otherwise
+        start_page, +2, +6, +14, ... until a page is empty, then a binary
+        search between the last full and the first empty probe. Every page
+        below a full probe exists, so the pool fetches those while probing
+        continues. Probed pages are kept, not fetched twice.
+        
+        A probe that fails (timeout, 5xx, bad JSON) is retried; only a page
+        that comes back empty without an error ends the data. If a probe
+        keeps failing, paging stops there - the error is counted, so
+        last_fetch_complete stays False and the result is partial.
+        
+        Returns:
+            list: Invoices of each page from start_page up to the first empty
+                  page (or end_page), in page order - what the sequential
+                  loop returns
+        """
+        print(f"   🧵 Fetching pages concurrently with {workers} workers")
+        results = {}
+        futures = {}
+        queued_through = start_page - 1
+        
+        def fetch(page_no):
+            invoices = self.fetch_unpaid_invoices(page_no, verbose=False)
+            print(f"   📄 Page {page_no}: {len(invoices)} invoices")
+            return invoices
+        
+        def probe(page_no):
+            """True if the page has data, False if it is empty (or still failing after retries)"""
+            if page_no in results:
+                return bool(results[page_no])
+            for attempt in range(1, PROBE_ATTEMPTS + 1):
+                errors = self._thread_error_count()
+                results[page_no] = fetch(page_no)
+                if results[page_no] or self._thread_error_count() == errors:
+                    return bool(results[page_no])
+                if attempt < PROBE_ATTEMPTS:
+                    print(f"   🔄 Probe of page {page_no} failed; retrying ({attempt}/{PROBE_ATTEMPTS - 1})")
+            print(f"   ⚠️  Probe of page {page_no} kept failing; stopping before it (partial fetch)")
+            return False
+        
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            def queue_through(page_no):
+                """Fetch every page up to page_no that is not probed or queued yet"""
+                nonlocal queued_through
+                for page in range(queued_through + 1, page_no + 1):
+                    if page not in results:
+                        futures[page] = pool.submit(fetch, page)
+                queued_through = max(queued_through, page_no)
+            
+            last_full, first_empty = start_page - 1, end_page + 1
+            if end_page < 999999 and end_page > start_page:
+                if probe(end_page):
+                    last_full = end_page
+                else:
+                    first_empty = end_page
+            
+            # Exponential probing, then binary search, for the last page with data
+            step = 1
+            while last_full + step < first_empty:
+                page = last_full + step
+                if not probe(page):
+                    first_empty = page
+                    break
+                queue_through(page)
+                last_full = page
+                step *= 2
+            while first_empty - last_full > 1:
+                page = (last_full + first_empty) // 2
+                if probe(page):
+                    queue_through(page)
+                    last_full = page
+                else:
+                    first_empty = page
+            
+            queue_through(last_full)
+            for page, future in futures.items():
+                results[page] = future.result()
+        
+        pages = []
+        for page in range(start_page, last_full + 1):
+            invoices = results.get(page)
+            if not invoices:
+                # An error (or the data shifted while paging): retry once, then stop here like the sequential loop
+                invoices = self.fetch_unpaid_invoices(page, verbose=False)
+                if not invoices:
+                    print(f"   ⚠️  Page {page} came back empty before the last page ({last_full}); stopping there")
+                    break
+            pages.append(invoices)
+        return pages
 
     def write_payment_data(self, payment_data):
         """Write/push payment data to Warsoft
@@ -244,11 +423,10 @@ class WarsoftClient:
             print(f"   ✅ Validation passed - all required fields present")
             print(f"   📋 Payload: {json.dumps(payload, indent=2)}")
             
-            response = requests.post(
+            response = self.http.post(
                 self.write_url,
                 headers=self.get_headers(),
-                json=payload,
-                timeout=30
+                json=payload
             )
             response.raise_for_status()
             
@@ -285,7 +463,41 @@ class WarsoftClient:
         }
 
 
+def benchmark_page_fetch(workers_list=(1, 4, 8)):
+    """Time fetch_all_unpaid_invoices with different WARSOFT_FETCH_WORKERS
+    
+    Point WARSOFT_READ_URL at mock_warsoft_server.py to benchmark locally.
+    """
+    import contextlib
+    import io
+    
+    client = WarsoftClient()
+    timings = []
+    baseline = None
+    for workers in workers_list:
+        os.environ['WARSOFT_FETCH_WORKERS'] = str(workers)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            invoices = client.fetch_all_unpaid_invoices()
+        elapsed = time.perf_counter() - started
+        numbers = [invoice.get('invoiceNumber') for invoice in invoices]
+        if baseline is None:
+            baseline = numbers
+        timings.append((workers, elapsed, len(invoices), numbers == baseline))
+    
+    print(f"\n📊 Warsoft page fetch benchmark")
+    for workers, elapsed, count, same in timings:
+        print(f"   ⏱️  {workers:3} worker(s) {elapsed:8.2f}s  {count:7} invoices  "
+              f"{'✅ same invoices, same order' if same else '⚠️  differs from the first run'}")
+
+
 if __name__ == "__main__":
+    # Usage: python warsoft_client.py [--benchmark [workers ...]]
+    if '--benchmark' in sys.argv:
+        workers_list = [int(arg) for arg in sys.argv[sys.argv.index('--benchmark') + 1:]] or [1, 4, 8]
+        benchmark_page_fetch(workers_list)
+        sys.exit(0)
+    
     # Test Warsoft client
     client = WarsoftClient()
     
@@ -7,6 +7,7 @@ import json
 import requests
 from datetime import datetime
 from dotenv import load_dotenv
+from http_transport import http_session
 
 load_dotenv()
 
@@ -18,6 +19,8 @@ class ZohoClient:
         self.refresh_token = os.getenv('ZOHO_REFRESH_TOKEN')
         self.organization_id = os.getenv('ZOHO_ORGANIZATION_ID')
         self.access_token = None
+        # Pooled keep-alive connections (token refreshes and API calls)
+        self.http = http_session('zoho')
 
         # Support multiple Zoho regions (.com, .in, .eu, .com.au)
         self.api_domain = os.getenv('ZOHO_API_DOMAIN', 'https://www.zohoapis.com')
@@ -44,7 +47,7 @@ class ZohoClient:
                 'grant_type': 'refresh_token'
             }
 
-            response = requests.post(url, params=params)
+            response = self.http.post(url, params=params)
             response.raise_for_status()
 
             data = response.json()
@@ -94,12 +97,12 @@ class ZohoClient:
                     'status': status
                 }
 
-                response = requests.get(url, headers=self.get_headers(), params=params)
+                response = self.http.get(url, headers=self.get_headers(), params=params)
 
                 if response.status_code == 401:
                     print("🔄 Token expired, refreshing...")
                     self.refresh_access_token()
-                    response = requests.get(url, headers=self.get_headers(), params=params)
+                    response = self.http.get(url, headers=self.get_headers(), params=params)
 
                 response.raise_for_status()
                 data = response.json()
@@ -154,12 +157,12 @@ class ZohoClient:
                 if status_filter:
                     params['status'] = status_filter
 
-                response = requests.get(url, headers=self.get_headers(), params=params)
+                response = self.http.get(url, headers=self.get_headers(), params=params)
 
                 if response.status_code == 401:
                     print("🔄 Token expired, refreshing...")
                     self.refresh_access_token()
-                    response = requests.get(url, headers=self.get_headers(), params=params)
+                    response = self.http.get(url, headers=self.get_headers(), params=params)
 
                 response.raise_for_status()
                 data = response.json()
@@ -222,7 +225,7 @@ class ZohoClient:
             if date_to:
                 params['date_end'] = date_to
 
-            response = requests.get(url, headers=self.get_headers(), params=params)
+            response = self.http.get(url, headers=self.get_headers(), params=params)
             response.raise_for_status()
 
             data = response.json()
@@ -243,7 +246,7 @@ class ZohoClient:
             url = f'{self.base_url}/invoices/{invoice_id}'
             params = {'organization_id': self.organization_id}
 
-            response = requests.get(url, headers=self.get_headers(), params=params)
+            response = self.http.get(url, headers=self.get_headers(), params=params)
             response.raise_for_status()
 
             data = response.json()
@@ -266,12 +269,12 @@ class ZohoClient:
             url = f'{self.base_url}/invoices/{invoice_id}/status/sent'
             params = {'organization_id': self.organization_id}
 
-            response = requests.post(url, headers=self.get_headers(), params=params)
+            response = self.http.post(url, headers=self.get_headers(), params=params)
 
             if response.status_code == 401:
                 print("🔄 Token expired, refreshing...")
                 self.refresh_access_token()
-                response = requests.post(url, headers=self.get_headers(), params=params)
+                response = self.http.post(url, headers=self.get_headers(), params=params)
 
             response.raise_for_status()
             print(f"   ✅ Marked invoice {invoice_id} as SENT")
@@ -324,12 +327,12 @@ class ZohoClient:
             print(f"   🔍 DEBUG - API URL: {url}")
             print(f"   🔍 DEBUG - Payment JSON: {payment_json}")
 
-            response = requests.post(url, headers=self.get_headers(), params=params)
+            response = self.http.post(url, headers=self.get_headers(), params=params)
 
             if response.status_code == 401:
                 print("🔄 Token expired, refreshing...")
                 self.refresh_access_token()
-                response = requests.post(url, headers=self.get_headers(), params=params)
+                response = self.http.post(url, headers=self.get_headers(), params=params)
 
             print(f"   🔍 DEBUG - Response Status: {response.status_code}")
             print(f"   🔍 DEBUG - Response Body: {response.text[:500]}")